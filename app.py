@@ -21,6 +21,10 @@ def nl2br_filter(value):
         return Markup(value.replace('\n', '<br>'))
     return ''
 
+# Enlaces de exportación CSV/Excel con los filtros de la página actual
+from utils.exportacion import url_exportacion
+app.add_template_global(url_exportacion)
+
 # Configuración de la clave secreta (usar variable de entorno en producción)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'tu-clave-secreta-aqui-cambiar-en-produccion')
 
@@ -78,6 +82,13 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 }
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Cambios al perfil de pragmas de cada conexión SQLite (ver utils/perfil_sqlite.py),
+# p. ej. "journal_mode=DELETE,mmap_size="
+app.config['SQLITE_PRAGMAS'] = os.environ.get('SQLITE_PRAGMAS', '')
+
+# Umbral (ms) a partir del cual una consulta SQL se registra como lenta
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
@@ -102,6 +113,30 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # Inicializar db con la aplicación
 db.init_app(app)
 
+# WAL, busy_timeout, caché, claves foráneas... en cada conexión nueva del pool
+from utils.perfil_sqlite import init_perfil_sqlite
+init_perfil_sqlite(app)
+
+# Contar consultas y tiempo de BD por petición (cabeceras X-DB-Queries / X-DB-Time)
+from utils.instrumentacion_sql import init_instrumentacion_sql
+init_instrumentacion_sql(app)
+
+# Métricas en formato Prometheus (/metrics), agregadas entre workers
+from utils.metricas import init_metricas
+init_metricas(app)
+
+# Mantener la tabla resumen_mensual al guardar facturas, facturas de proveedor y nóminas
+from utils.resumen_mensual import init_resumen_mensual
+init_resumen_mensual()
+
+# Invalidar el informe de clientes duplicados al guardar cambios en clientes
+from utils.duplicados import init_duplicados
+init_duplicados()
+
+# Copias de seguridad automáticas con rotación (un solo worker las hace)
+from utils.copias_programadas import init_copias_programadas
+init_copias_programadas(app)
+
 # Inicializar Mail con la aplicación
 mail.init_app(app)
 
@@ -161,6 +196,10 @@ app.register_blueprint(cliente_web_bp)
 app.register_blueprint(gastos_bp)
 app.register_blueprint(informes_bp)
 
+# Invalidar la caché del panel al renombrar clientes o usuarios
+from routes.index import init_cache_panel
+init_cache_panel()
+
 def migrate_database():
     """Migrar la base de datos agregando columnas faltantes"""
     with app.app_context():
@@ -613,6 +652,27 @@ def migrate_database():
                             print("Migración: Columna presupuesto_id agregada exitosamente a facturas")
                     except Exception as e:
                         print(f"Error al agregar columna presupuesto_id a facturas: {e}")
+                
+                # Añadir columna tipo_documento (albarán/factura) e índice si no existen
+                if 'tipo_documento' not in columns_facturas:
+                    try:
+                        with db.engine.connect() as conn:
+                            conn.execute(text("ALTER TABLE facturas ADD COLUMN tipo_documento VARCHAR(20) NOT NULL DEFAULT 'factura'"))
+                            # Hasta ahora los albaranes se distinguían por el número (formato A2601_001)
+                            conn.execute(text(
+                                "UPDATE facturas SET tipo_documento = 'albaran' "
+                                "WHERE substr(numero, 1, 1) = 'A' AND instr(numero, '_') > 0"
+                            ))
+                            conn.commit()
+                            print("Migración: Columna tipo_documento agregada exitosamente a facturas")
+                    except Exception as e:
+                        print(f"Error al agregar columna tipo_documento a facturas: {e}")
+                try:
+                    with db.engine.connect() as conn:
+                        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_facturas_tipo_documento ON facturas (tipo_documento)'))
+                        conn.commit()
+                except Exception as e:
+                    print(f"Error al crear índice tipo_documento en facturas: {e}")
             
             # Verificar si existe la tabla presupuestos, si no existe crearla
             if 'presupuestos' not in table_names:
@@ -1352,6 +1412,44 @@ Saludos cordiales,
                 except Exception as e:
                     print(f"Error al crear tabla dias_festivos: {e}")
             
+            # Crear tabla versiones_cache si no existe
+            if 'versiones_cache' not in table_names:
+                try:
+                    db.create_all()
+                    print("Migración: Tabla versiones_cache creada exitosamente")
+                except Exception as e:
+                    print(f"Error al crear tabla versiones_cache: {e}")
+            
+            # Crear tabla trabajos_importacion si no existe
+            if 'trabajos_importacion' not in table_names:
+                try:
+                    db.create_all()
+                    print("Migración: Tabla trabajos_importacion creada exitosamente")
+                except Exception as e:
+                    print(f"Error al crear tabla trabajos_importacion: {e}")
+            else:
+                # Contador de posibles duplicados (nombres parecidos)
+                columns_trabajos = [col['name'] for col in inspector.get_columns('trabajos_importacion')]
+                if 'similares' not in columns_trabajos:
+                    try:
+                        with db.engine.connect() as conn:
+                            conn.execute(text('ALTER TABLE trabajos_importacion ADD COLUMN similares INTEGER NOT NULL DEFAULT 0'))
+                            conn.commit()
+                            print("Migración: Columna similares agregada exitosamente a trabajos_importacion")
+                    except Exception as e:
+                        print(f"Error al agregar columna similares a trabajos_importacion: {e}")
+            
+            # Crear índice de búsqueda de clientes (FTS5) y sus triggers si no existen
+            if 'clientes' in table_names:
+                try:
+                    from utils.busqueda import asegurar_indice_clientes
+                    with db.engine.connect() as conn:
+                        if asegurar_indice_clientes(conn):
+                            print("Migración: Índice de búsqueda de clientes (FTS5) creado exitosamente")
+                        conn.commit()
+                except Exception as e:
+                    print(f"Error al crear índice de búsqueda de clientes: {e}")
+            
             # Migrar subestados de mockup a los nuevos nombres
             if 'presupuestos' in table_names:
                 try:
@@ -1472,6 +1570,35 @@ Saludos cordiales,
                     except Exception as e:
                         print(f"Error al agregar columna precio_final a lineas_factura: {e}")
             
+            # Crear índices usados por los informes y el cuadre de caja (rangos de fechas y sumas por factura)
+            indices_informes = [
+                ('ix_facturas_fecha_expedicion', 'facturas', 'fecha_expedicion'),
+                ('ix_lineas_factura_factura_id', 'lineas_factura', 'factura_id'),
+                ('ix_facturas_proveedor_fecha_factura', 'facturas_proveedor', 'fecha_factura'),
+                ('ix_nominas_año', 'nominas', '"año"'),
+                ('ix_tickets_fecha_expedicion', 'tickets', 'fecha_expedicion'),
+            ]
+            for nombre_indice, tabla, columna in indices_informes:
+                if tabla in table_names:
+                    try:
+                        with db.engine.connect() as conn:
+                            conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{nombre_indice}" ON {tabla} ({columna})'))
+                            conn.commit()
+                    except Exception as e:
+                        print(f"Error al crear índice {nombre_indice}: {e}")
+            
+            # Crear tabla resumen_mensual si no existe y calcularla con los datos actuales
+            if 'resumen_mensual' not in table_names:
+                try:
+                    db.create_all()
+                    from utils.resumen_mensual import reconstruir_resumen
+                    num_meses = reconstruir_resumen()
+                    db.session.commit()
+                    print(f"Migración: Tabla resumen_mensual creada con {num_meses} meses")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error al crear tabla resumen_mensual: {e}")
+            
             # Verificar si existe la tabla configuracion
             if 'configuracion' not in table_names:
                 try:
@@ -1501,6 +1628,11 @@ Saludos cordiales,
             except Exception:
                 pass
 
+# Importar o restaurar la BD en caliente: los workers detectan el cambio en cada petición
+# y la BD nueva se actualiza con migrate_database
+from utils.sustitucion_bd import init_sustitucion_bd
+init_sustitucion_bd(app, migrar=migrate_database)
+
 # Las rutas ahora están en los blueprints en routes/
 # ========== FUNCIONES DE UTILIDAD ==========
 
@@ -7,3 +7,11 @@ workers = 2
 threads = 2
 timeout = 120
 
+
+
+def on_starting(server):
+    """Vaciar el directorio de métricas compartido entre workers al arrancar"""
+    from utils.metricas import limpiar_directorio
+    from utils.instrumentacion_sql import PREFIJO_ARCHIVO as PREFIJO_LENTAS
+    limpiar_directorio()
+    limpiar_directorio(PREFIJO_LENTAS)
@@ -31,6 +31,7 @@ def importar_clientes():
         # Importar app para tener acceso a la base de datos SQLite
         from app import app, db
         from models import Cliente
+        from utils.importacion import cargar_claves_existentes, IMPORTACION_CLIENTES
         
         with app.app_context():
             # Crear tablas si no existen
@@ -40,6 +41,11 @@ def importar_clientes():
             clientes_importados = 0
             clientes_actualizados = 0
             errores = []
+            posibles_duplicados = []
+            
+            # Índice de NIF y nombres para avisar de clientes nuevos que parecen uno existente.
+            # Se importan igualmente: conservan su ID, al que pueden apuntar otros datos exportados
+            indice_duplicados = cargar_claves_existentes(IMPORTACION_CLIENTES)
             
             for cliente_data in clientes_data:
                 try:
@@ -67,6 +73,11 @@ def importar_clientes():
                                 setattr(cliente_existente, key, value)
                         clientes_actualizados += 1
                     else:
+                        coincidencia = indice_duplicados.buscar(cliente_data.get('nombre'), cliente_data.get('nif'))
+                        if coincidencia:
+                            posibles_duplicados.append((cliente_data.get('id'), cliente_data.get('nombre'), coincidencia))
+                        indice_duplicados.agregar(cliente_data.get('id'), cliente_data.get('nombre'), cliente_data.get('nif'))
+                        
                         # Crear nuevo cliente
                         cliente = Cliente()
                         for key, value in cliente_data.items():
@@ -100,6 +111,12 @@ def importar_clientes():
                 print(f"✓ Importados {clientes_importados} clientes nuevos")
                 print(f"✓ Actualizados {clientes_actualizados} clientes existentes")
                 
+                if posibles_duplicados:
+                    print(f"⚠ {len(posibles_duplicados)} clientes nuevos parecen duplicados (revisar en /clientes/duplicados):")
+                    for cliente_id, nombre, coincidencia in posibles_duplicados:
+                        print(f"  - Cliente ID {cliente_id} '{nombre}' ~ ID {coincidencia.registro.referencia} "
+                              f"'{coincidencia.registro.nombre}' ({coincidencia.tipo}, {coincidencia.similitud:.0%})")
+                
                 if errores:
                     print(f"⚠ {len(errores)} errores durante la importación")
                     for error in errores:
@@ -0,0 +1,222 @@
+"""Script para comparar perfiles de conexión SQLite con carga mixta de lecturas y escrituras
+
+Reproduce el despliegue (gunicorn con 2 workers x 2 threads): varios procesos con
+varios threads cada uno, cada thread con su conexión del pool, hacen durante un
+tiempo fijo consultas de lectura como las de los listados y transacciones de
+escritura cortas como las de un formulario. Cada perfil se mide sobre una copia
+nueva de la BD, así que la BD original no se modifica.
+
+Perfiles:
+- actual: la configuración anterior (journal DELETE, synchronous FULL, solo el
+  timeout de 5 s que pone por defecto el módulo sqlite3 de Python).
+- perfil: utils.perfil_sqlite con los cambios de SQLITE_PRAGMAS, si los hay.
+
+Para cada uno muestra operaciones por segundo, errores "database is locked" y
+latencias (mediana, p95 y máxima) de lecturas y escrituras.
+
+Uso:
+    python medir_perfil_sqlite.py                         # BD de la aplicación, 10 s por perfil
+    python medir_perfil_sqlite.py --segundos 30 --escrituras 0.5
+    python medir_perfil_sqlite.py --bd /ruta/a/pedidos.db --procesos 4 --hilos 4
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from utils.copias_seguridad import copiar_base_datos
+from utils.perfil_sqlite import aplicar_pragmas, leer_pragmas
+
+# Igual que gunicorn_config.py
+PROCESOS = 2
+HILOS = 2
+SEGUNDOS = 10
+# Fracción de operaciones que son transacciones de escritura
+PROPORCION_ESCRITURAS = 0.2
+
+PERFIL_ACTUAL = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+CONSULTAS_LECTURA = (
+    # Listado de presupuestos con su cliente
+    text('SELECT p.id, p.estado, c.nombre FROM presupuestos p JOIN clientes c ON c.id = p.cliente_id '
+         'ORDER BY p.id DESC LIMIT 50'),
+    # Listado de clientes paginado
+    text('SELECT id, nombre, nif, poblacion FROM clientes ORDER BY nombre LIMIT 50 OFFSET :desplazamiento'),
+    # Ficha de un cliente
+    text('SELECT * FROM clientes WHERE id = :cliente_id'),
+    # Agregado de un informe
+    text('SELECT poblacion, COUNT(*) FROM clientes GROUP BY poblacion ORDER BY 2 DESC LIMIT 20'),
+)
+
+
+def ruta_bd_aplicacion():
+    """Misma ruta que usa app.py (DATABASE_PATH o instance/pedidos.db)"""
+    ruta = os.environ.get('DATABASE_PATH', 'instance/pedidos.db')
+    if not os.path.isabs(ruta):
+        ruta = os.path.join(os.path.dirname(os.path.abspath(__file__)), ruta)
+    return os.path.normpath(ruta)
+
+
+def preparar_copia(origen, destino):
+    """Copiar la BD y crear la tabla en la que escriben las transacciones de prueba"""
+    copiar_base_datos(origen, destino)
+    conexion = sqlite3.connect(destino)
+    try:
+        conexion.execute('CREATE TABLE medicion_carga (id INTEGER PRIMARY KEY, proceso INTEGER, '
+                         'texto TEXT, fecha TEXT DEFAULT CURRENT_TIMESTAMP)')
+        ids_clientes = [fila[0] for fila in conexion.execute('SELECT id FROM clientes')]
+        conexion.commit()
+    finally:
+        conexion.close()
+    return ids_clientes
+
+
+def _es_bloqueo(error):
+    mensaje = str(error.orig if hasattr(error, 'orig') else error).lower()
+    return 'locked' in mensaje or 'busy' in mensaje
+
+
+def _hilo_carga(engine, ids_clientes, proporcion_escrituras, inicio, fin, resultados, indice):
+    aleatorio = random.Random(indice)
+    latencias = {'lectura': [], 'escritura': []}
+    errores = {'lectura': 0, 'escritura': 0}
+    while time.time() < inicio:
+        time.sleep(0.001)
+    while time.time() < fin:
+        tipo = 'escritura' if aleatorio.random() < proporcion_escrituras else 'lectura'
+        cliente_id = aleatorio.choice(ids_clientes) if ids_clientes else 0
+        empieza = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                if tipo == 'lectura':
+                    consulta = aleatorio.choice(CONSULTAS_LECTURA)
+                    conn.execute(consulta, {'desplazamiento': aleatorio.randrange(0, 700),
+                                            'cliente_id': cliente_id}).fetchall()
+                else:
+                    # Como un formulario: lee la ficha, escribe dos tablas y confirma
+                    conn.execute(text('SELECT * FROM clientes WHERE id = :id'), {'id': cliente_id}).fetchall()
+                    conn.execute(text('INSERT INTO medicion_carga (proceso, texto) VALUES (:p, :t)'),
+                                 {'p': indice, 't': 'x' * aleatorio.randrange(50, 500)})
+                    conn.execute(text('UPDATE clientes SET nombre = nombre WHERE id = :id'), {'id': cliente_id})
+                    conn.commit()
+        except OperationalError as e:
+            if not _es_bloqueo(e):
+                raise
+            errores[tipo] += 1
+            continue
+        latencias[tipo].append(time.perf_counter() - empieza)
+    resultados.append((latencias, errores))
+
+
+def _proceso_carga(ruta, pragmas, hilos, proporcion_escrituras, ids_clientes, inicio, fin, cola, numero):
+    engine = create_engine(f'sqlite:///{ruta}', connect_args={'check_same_thread': False},
+                           pool_size=hilos)
+    if pragmas:
+        event.listen(engine, 'connect', lambda conexion, registro: aplicar_pragmas(conexion, pragmas))
+    resultados = []
+    hilos_carga = [
+        threading.Thread(target=_hilo_carga, args=(engine, ids_clientes, proporcion_escrituras,
+                                                   inicio, fin, resultados, numero * 100 + i))
+        for i in range(hilos)
+    ]
+    for hilo in hilos_carga:
+        hilo.start()
+    for hilo in hilos_carga:
+        hilo.join()
+    engine.dispose()
+    cola.put(resultados)
+
+
+def _percentil(valores, fraccion):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * fraccion))]
+
+
+def medir_perfil(nombre, pragmas, origen, opciones):
+    """Ejecutar la carga sobre una copia nueva de la BD con el perfil indicado"""
+    directorio = tempfile.mkdtemp(prefix='medir_perfil_sqlite_')
+    try:
+        ruta = os.path.join(directorio, 'pedidos.db')
+        ids_clientes = preparar_copia(origen, ruta)
+        # journal_mode es persistente: se fija antes de arrancar la carga
+        conexion = sqlite3.connect(ruta)
+        aplicar_pragmas(conexion, {'journal_mode': pragmas.get('journal_mode', 'DELETE')})
+        conexion.close()
+
+        cola = multiprocessing.Queue()
+        inicio = time.time() + 1
+        fin = inicio + opciones.segundos
+        procesos = [
+            multiprocessing.Process(target=_proceso_carga, args=(ruta, pragmas, opciones.hilos, opciones.escrituras,
+                                                                 ids_clientes, inicio, fin, cola, i))
+            for i in range(opciones.procesos)
+        ]
+        for proceso in procesos:
+            proceso.start()
+        resultados = [resultado for _ in procesos for resultado in cola.get()]
+        for proceso in procesos:
+            proceso.join()
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    resumen = {'perfil': nombre}
+    for tipo in ('lectura', 'escritura'):
+        latencias = [latencia for hilo, _ in resultados for latencia in hilo[tipo]]
+        resumen[tipo] = {
+            'por_segundo': len(latencias) / opciones.segundos,
+            'errores': sum(errores[tipo] for _, errores in resultados),
+            'mediana_ms': _percentil(latencias, 0.5) * 1000,
+            'p95_ms': _percentil(latencias, 0.95) * 1000,
+            'max_ms': max(latencias, default=0) * 1000,
+        }
+    return resumen
+
+
+def informe(resumenes):
+    print(f"\n{'Perfil':<8} {'Tipo':<10} {'op/s':>9} {'bloqueos':>9} {'mediana ms':>11} {'p95 ms':>9} {'máx ms':>9}")
+    print('-' * 70)
+    for resumen in resumenes:
+        for tipo in ('lectura', 'escritura'):
+            datos = resumen[tipo]
+            print(f"{resumen['perfil']:<8} {tipo:<10} {datos['por_segundo']:>9.1f} {datos['errores']:>9} "
+                  f"{datos['mediana_ms']:>11.2f} {datos['p95_ms']:>9.2f} {datos['max_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Comparar perfiles de conexión SQLite con carga mixta')
+    parser.add_argument('--bd', default=ruta_bd_aplicacion(), help='BD de origen (se copia, no se modifica)')
+    parser.add_argument('--procesos', type=int, default=PROCESOS)
+    parser.add_argument('--hilos', type=int, default=HILOS)
+    parser.add_argument('--segundos', type=float, default=SEGUNDOS)
+    parser.add_argument('--escrituras', type=float, default=PROPORCION_ESCRITURAS,
+                        help='fracción de operaciones de escritura (0-1)')
+    opciones = parser.parse_args()
+
+    if not os.path.exists(opciones.bd):
+        print(f"Error: No se encontró la base de datos {opciones.bd}")
+        return 1
+
+    perfil = leer_pragmas(os.environ.get('SQLITE_PRAGMAS', ''))
+    print(f"BD: {opciones.bd}")
+    print(f"Carga: {opciones.procesos} procesos x {opciones.hilos} threads, {opciones.segundos:g} s por perfil, "
+          f"{opciones.escrituras:.0%} escrituras")
+    print(f"Perfil nuevo: {', '.join(f'{n}={v}' for n, v in perfil.items())}")
+
+    resumenes = []
+    for nombre, pragmas in (('actual', PERFIL_ACTUAL), ('perfil', perfil)):
+        print(f"Midiendo '{nombre}'...")
+        resumenes.append(medir_perfil(nombre, pragmas, opciones.bd, opciones))
+    informe(resumenes)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,4 +1,6 @@
 from datetime import datetime
+from sqlalchemy import select, func
+from sqlalchemy.orm import column_property
 from extensions import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -28,7 +30,11 @@ class Comercial(db.Model):
     @property
     def nombre(self):
         """Propiedad que devuelve el nombre del usuario asociado"""
-        if self.usuario:
+        # nombre_usuario se carga junto con la fila (ver column_property al final del módulo),
+        # así que no hace falta cargar la relación usuario; solo se usa en comerciales sin guardar
+        if self.nombre_usuario is not None:
+            return self.nombre_usuario
+        if self.id is None and self.usuario:
             return self.usuario.usuario
         return self._nombre or ''
     
@@ -379,7 +385,7 @@ class Ticket(db.Model):
     # Datos de la factura simplificada
     serie = db.Column(db.String(10), nullable=False, default='A')
     numero = db.Column(db.String(50), nullable=False)
-    fecha_expedicion = db.Column(db.Date, nullable=False)
+    fecha_expedicion = db.Column(db.Date, nullable=False, index=True)
     tipo_factura = db.Column(db.String(10), nullable=False, default='F2')  # F2 = Factura simplificada
     descripcion = db.Column(db.Text)
     
@@ -451,7 +457,12 @@ class Factura(db.Model):
     """Facturas formales (tipo F1)"""
     __tablename__ = 'facturas'
     
+    # Tipos de documento: los albaranes son facturas directas pendientes de formalizar
+    TIPO_FACTURA = 'factura'
+    TIPO_ALBARAN = 'albaran'
+    
     id = db.Column(db.Integer, primary_key=True)
+    tipo_documento = db.Column(db.String(20), nullable=False, default=TIPO_FACTURA, index=True)
     
     # Relación con pedido (opcional, puede ser None para facturas directas)
     pedido_id = db.Column(db.Integer, db.ForeignKey('pedidos.id'), nullable=True)
@@ -464,7 +475,7 @@ class Factura(db.Model):
     # Datos de la factura
     serie = db.Column(db.String(10), nullable=False, default='A')
     numero = db.Column(db.String(50), nullable=False)
-    fecha_expedicion = db.Column(db.Date, nullable=False)
+    fecha_expedicion = db.Column(db.Date, nullable=False, index=True)
     tipo_factura = db.Column(db.String(10), nullable=False, default='F1')  # F1 = Factura completa
     descripcion = db.Column(db.Text)
     
@@ -489,6 +500,11 @@ class Factura(db.Model):
     # Relación con líneas de factura
     lineas = db.relationship('LineaFactura', backref='factura', lazy=True, cascade='all, delete-orphan')
     
+    @property
+    def es_albaran(self):
+        """Indica si el documento es un albarán (formalizado o no)"""
+        return self.tipo_documento == Factura.TIPO_ALBARAN
+    
     def __repr__(self):
         return f'<Factura {self.serie}-{self.numero} - {self.nombre}>'
 
@@ -499,7 +515,7 @@ class LineaFactura(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     
     # Relación
-    factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=False)
+    factura_id = db.Column(db.Integer, db.ForeignKey('facturas.id'), nullable=False, index=True)
     
     # Relación con línea de pedido original
     linea_pedido_id = db.Column(db.Integer, db.ForeignKey('lineas_pedido.id'), nullable=True)
@@ -628,7 +644,7 @@ class FacturaProveedor(db.Model):
     
     # Datos de la factura
     numero_factura = db.Column(db.String(100), nullable=False)  # Número de factura del proveedor
-    fecha_factura = db.Column(db.Date, nullable=False)
+    fecha_factura = db.Column(db.Date, nullable=False, index=True)
     fecha_vencimiento = db.Column(db.Date)  # Fecha de vencimiento para pago
     
     # Importes
@@ -679,7 +695,7 @@ class Nomina(db.Model):
     
     # Datos de la nómina
     mes = db.Column(db.Integer, nullable=False)  # Mes (1-12)
-    año = db.Column(db.Integer, nullable=False)  # Año
+    año = db.Column(db.Integer, nullable=False, index=True)  # Año
     
     # Importe
     total_devengado = db.Column(db.Numeric(10, 2), nullable=False)
@@ -780,3 +796,109 @@ class RegistroEstadoSolicitud(db.Model):
     
     def __repr__(self):
         return f'<RegistroEstadoSolicitud {self.id} - {self.estado}/{self.subestado} - {self.fecha_cambio}>'
+
+class VersionCache(db.Model):
+    """Contadores de versión compartidos entre workers para invalidar cachés en memoria"""
+    __tablename__ = 'versiones_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    clave = db.Column(db.String(100), unique=True, nullable=False)  # Ej: 'panel_solicitudes'
+    version = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Timestamp
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<VersionCache {self.clave}={self.version}>'
+
+class ResumenMensual(db.Model):
+    """Totales financieros por mes, mantenidos al guardar facturas, facturas de proveedor y nóminas (ver utils/resumen_mensual.py)"""
+    __tablename__ = 'resumen_mensual'
+    __table_args__ = (db.UniqueConstraint('año', 'mes', name='uq_resumen_mensual_año_mes'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    año = db.Column(db.Integer, nullable=False)
+    mes = db.Column(db.Integer, nullable=False)  # Mes (1-12)
+
+    # Facturación emitida (facturas y albaranes); las líneas llevan el IVA incluido
+    num_facturas_emitidas = db.Column(db.Integer, nullable=False, default=0)
+    total_emitido = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # Suma de importe_total
+    importe_lineas_emitidas = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # Suma de importes de líneas
+    base_repercutida = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cuota_iva_repercutida = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    # Facturación soportada (facturas de proveedor)
+    num_facturas_proveedor = db.Column(db.Integer, nullable=False, default=0)
+    total_soportado = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    base_soportada = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cuota_iva_soportada = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    # Nóminas (por su mes y año, no por fecha de creación)
+    num_nominas = db.Column(db.Integer, nullable=False, default=0)
+    total_nominas = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    # Timestamp
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ResumenMensual {self.año}-{self.mes:02d}>'
+
+class TrabajoImportacion(db.Model):
+    """Importación de clientes o proveedores desde Excel en segundo plano (ver utils/trabajos_importacion.py)"""
+    __tablename__ = 'trabajos_importacion'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False)  # 'clientes' o 'proveedores'
+    nombre_archivo = db.Column(db.String(255), nullable=False)  # Nombre del archivo subido
+    ruta_archivo = db.Column(db.String(500), nullable=False)  # Copia del Excel (se borra al terminar)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, en_curso, completado, error
+
+    # Progreso: la última fila del Excel confirmada (1 = cabecera) y los contadores hasta ella
+    total_filas = db.Column(db.Integer, nullable=True)  # Filas de datos según la hoja (aproximado)
+    ultima_fila = db.Column(db.Integer, nullable=False, default=1)
+    importados = db.Column(db.Integer, nullable=False, default=0)
+    duplicados = db.Column(db.Integer, nullable=False, default=0)
+    similares = db.Column(db.Integer, nullable=False, default=0)  # Importados con nombre parecido a otro
+    errores = db.Column(db.Integer, nullable=False, default=0)
+    incidencias = db.Column(db.Text)  # JSON: filas omitidas (utils.importacion.anotar_incidencia)
+    mensaje_error = db.Column(db.Text)
+
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=True)
+
+    # Timestamps; latido se actualiza con cada lote confirmado
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    latido = db.Column(db.DateTime, nullable=True)
+    fecha_fin = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<TrabajoImportacion {self.id} {self.tipo} {self.estado}>'
+
+
+# ========== COLUMNAS CALCULADAS ==========
+# Se definen aquí porque dependen de modelos declarados más abajo que su clase
+
+# Nombre del comercial (nombre de su usuario) cargado en la misma consulta que el comercial
+Comercial.nombre_usuario = column_property(
+    select(Usuario.usuario)
+    .where(Usuario.id == Comercial.usuario_id)
+    .correlate_except(Usuario)
+    .scalar_subquery()
+)
+
+# Número de líneas sin cargar las líneas. Diferidas: solo se calculan en los listados
+# que las piden con undefer(...)
+Presupuesto.num_lineas = column_property(
+    select(func.count(LineaPresupuesto.id))
+    .where(LineaPresupuesto.presupuesto_id == Presupuesto.id)
+    .correlate_except(LineaPresupuesto)
+    .scalar_subquery(),
+    deferred=True
+)
+
+Factura.num_lineas = column_property(
+    select(func.count(LineaFactura.id))
+    .where(LineaFactura.factura_id == Factura.id)
+    .correlate_except(LineaFactura)
+    .scalar_subquery(),
+    deferred=True
+)
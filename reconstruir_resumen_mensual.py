@@ -0,0 +1,23 @@
+"""Script para recalcular la tabla resumen_mensual a partir de facturas, facturas de proveedor y nóminas
+
+Usar tras cargas masivas o cambios hechos con SQL directo, que no actualizan el resumen.
+"""
+from app import app, db
+from utils.resumen_mensual import reconstruir_resumen
+
+def reconstruir_resumen_mensual():
+    """Borrar y volver a calcular todas las filas de resumen_mensual"""
+    with app.app_context():
+        try:
+            db.create_all()
+            num_meses = reconstruir_resumen()
+            db.session.commit()
+            print(f"✓ Resumen mensual reconstruido: {num_meses} meses")
+        except Exception as e:
+            db.session.rollback()
+            print(f"✗ Error al reconstruir el resumen mensual: {e}")
+            import traceback
+            traceback.print_exc()
+
+if __name__ == '__main__':
+    reconstruir_resumen_mensual()
@@ -2,9 +2,10 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from flask_login import login_user, logout_user, login_required, current_user
 from extensions import db
-from models import Cliente, Presupuesto, Prenda, Comercial, Usuario, Factura
+from models import Cliente, Presupuesto, Pedido, Prenda, Comercial, Usuario, Factura
 from datetime import datetime
 from werkzeug.utils import secure_filename
+from utils.datos_referencia import obtener_prendas
 import os
 
 cliente_web_bp = Blueprint('cliente_web', __name__, url_prefix='/cliente')
@@ -153,8 +154,10 @@ def ver_factura(factura_id):
     cliente = current_user
     factura = Factura.query.get_or_404(factura_id)
     
-    # Verificar que la factura pertenece al cliente
-    if factura.pedido.cliente_id != cliente.id:
+    # Verificar que la factura pertenece al cliente (por su pedido o su solicitud;
+    # las facturas directas no tienen ninguno de los dos)
+    origen = factura.pedido or factura.presupuesto
+    if origen is None or origen.cliente_id != cliente.id:
         flash('No tienes permiso para ver esta factura', 'error')
         return redirect(url_for('cliente_web.ver_facturas'))
     
@@ -253,7 +256,7 @@ def nuevo_pedido():
             db.session.rollback()
             flash(f'Error al crear pedido: {str(e)}', 'error')
     
-    prendas = Prenda.query.all()
+    prendas = obtener_prendas()
     return render_template('cliente_web/nuevo_pedido.html', 
                          cliente=cliente,
                          prendas=prendas)
@@ -4,9 +4,13 @@ from flask_login import login_required
 from extensions import db
 from models import Cliente, Presupuesto, Factura, Pedido, Comercial, Usuario, CategoriaCliente, DireccionEnvio, PersonaContacto
 from sqlalchemy import or_
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload, raiseload
 from datetime import datetime
 from utils.auth import not_usuario_required
+from utils.paginacion import paginar_desde_request
+from utils.busqueda import filtrar_clientes, buscar_clientes
+from utils.datos_referencia import obtener_comerciales, obtener_categorias, invalidar_categorias
+from utils.duplicados import informe_clientes_duplicados
 
 clientes_bp = Blueprint('clientes', __name__)
 
@@ -118,20 +122,12 @@ def gestion_clientes():
     categoria_filtro = request.args.get('categoria_filtro', '').strip()
     orden = request.args.get('orden', 'id')  # 'id' o 'nombre'
     
-    # Construir consulta
-    query = Cliente.query
+    # Construir consulta (la categoría se carga en la misma consulta)
+    query = Cliente.query.options(joinedload(Cliente.categoria_obj), raiseload('*'))
     
-    # Aplicar filtro de búsqueda
+    # Aplicar filtro de búsqueda (índice de texto completo)
     if busqueda:
-        query = query.filter(
-            db.or_(
-                Cliente.nombre.ilike(f'%{busqueda}%'),
-                Cliente.alias.ilike(f'%{busqueda}%'),
-                Cliente.nif.ilike(f'%{busqueda}%'),
-                Cliente.poblacion.ilike(f'%{busqueda}%'),
-                Cliente.provincia.ilike(f'%{busqueda}%')
-            )
-        )
+        query = filtrar_clientes(query, busqueda)
     
     # Aplicar filtro por categoría
     if categoria_filtro:
@@ -143,27 +139,74 @@ def gestion_clientes():
     
     # Aplicar ordenamiento
     if orden == 'nombre':
-        clientes = query.order_by(Cliente.nombre.asc()).all()
+        pagina = paginar_desde_request(query, [(Cliente.nombre, False), (Cliente.id, False)])
     else:
-        clientes = query.order_by(Cliente.id.asc()).all()
+        pagina = paginar_desde_request(query, [(Cliente.id, False)])
+    clientes = pagina.items
     
     # Obtener comerciales para el formulario
-    comerciales = Comercial.query.join(Usuario).filter(
-        Usuario.activo == True,
-        Usuario.rol.in_(['comercial', 'administracion'])
-    ).all()
+    comerciales = obtener_comerciales(solo_asignables=True)
     
     # Obtener categorías activas
-    categorias = CategoriaCliente.query.filter_by(activo=True).order_by(CategoriaCliente.nombre).all()
+    categorias = obtener_categorias()
     
     return render_template('clientes.html', 
                          clientes=clientes,
+                         pagina=pagina,
                          busqueda=busqueda,
                          categoria_filtro=categoria_filtro,
                          orden=orden,
                          comerciales=comerciales,
                          categorias=categorias)
 
+@clientes_bp.route('/api/clientes/buscar')
+@login_required
+def api_buscar_clientes():
+    """Buscar clientes por texto (ordenados por relevancia) y devolverlos en JSON"""
+    termino = request.args.get('q', '').strip()
+    try:
+        limite = min(max(int(request.args.get('limite', 20)), 1), 100)
+    except ValueError:
+        limite = 20
+
+    clientes = buscar_clientes(termino, limite=limite, query=Cliente.query.options(
+        selectinload(Cliente.direcciones_envio),
+        raiseload('*')
+    ))
+
+    # Incluye los datos que necesitan los formularios al seleccionar el cliente
+    return jsonify({
+        'success': True,
+        'clientes': [{
+            'id': cliente.id,
+            'nombre': cliente.nombre,
+            'alias': cliente.alias or '',
+            'nif': cliente.nif or '',
+            'direccion': cliente.direccion or '',
+            'poblacion': cliente.poblacion or '',
+            'provincia': cliente.provincia or '',
+            'codigo_postal': cliente.codigo_postal or '',
+            'telefono': cliente.telefono or '',
+            'email': cliente.email or '',
+            'direcciones_envio': [{
+                'id': direccion.id,
+                'nombre': direccion.nombre,
+                'direccion': direccion.direccion or '',
+                'poblacion': direccion.poblacion or '',
+                'provincia': direccion.provincia or '',
+                'codigo_postal': direccion.codigo_postal or '',
+                'pais': direccion.pais or ''
+            } for direccion in cliente.direcciones_envio]
+        } for cliente in clientes]
+    })
+
+@clientes_bp.route('/clientes/duplicados')
+@login_required
+@not_usuario_required
+def clientes_duplicados():
+    """Informe de posibles clientes duplicados con sugerencias de fusión"""
+    return render_template('clientes_duplicados.html', grupos=informe_clientes_duplicados())
+
 @clientes_bp.route('/clientes/<int:id>')
 @login_required
 @not_usuario_required
@@ -293,13 +336,10 @@ def editar_cliente(id):
             flash(f'Error al actualizar cliente: {str(e)}', 'error')
     
     # Obtener comerciales para el formulario
-    comerciales = Comercial.query.join(Usuario).filter(
-        Usuario.activo == True,
-        Usuario.rol.in_(['comercial', 'administracion'])
-    ).all()
+    comerciales = obtener_comerciales(solo_asignables=True)
     
     # Obtener categorías activas
-    categorias = CategoriaCliente.query.filter_by(activo=True).order_by(CategoriaCliente.nombre).all()
+    categorias = obtener_categorias()
     
     return render_template('editar_cliente.html', cliente=cliente, comerciales=comerciales, categorias=categorias)
 
@@ -457,6 +497,7 @@ def gestion_categorias():
                     else:
                         nueva_categoria = CategoriaCliente(nombre=nombre, activo=True)
                         db.session.add(nueva_categoria)
+                        invalidar_categorias()
                         db.session.commit()
                         flash('Categoría creada correctamente', 'success')
                 except Exception as e:
@@ -478,6 +519,7 @@ def gestion_categorias():
                         flash('Ya existe una categoría con ese nombre', 'error')
                     else:
                         categoria.nombre = nombre
+                        invalidar_categorias()
                         db.session.commit()
                         flash('Categoría actualizada correctamente', 'success')
                 except Exception as e:
@@ -495,6 +537,7 @@ def gestion_categorias():
                         flash(f'No se puede eliminar la categoría porque hay {clientes_con_categoria} cliente(s) asignado(s)', 'error')
                     else:
                         db.session.delete(categoria)
+                        invalidar_categorias()
                         db.session.commit()
                         flash('Categoría eliminada correctamente', 'success')
                 except Exception as e:
@@ -507,12 +550,13 @@ def gestion_categorias():
                 try:
                     categoria = CategoriaCliente.query.get_or_404(categoria_id)
                     categoria.activo = (accion == 'activar')
+                    invalidar_categorias()
                     db.session.commit()
                     flash('Categoría actualizada correctamente', 'success')
                 except Exception as e:
                     db.session.rollback()
                     flash(f'Error al actualizar categoría: {str(e)}', 'error')
     
-    categorias = CategoriaCliente.query.order_by(CategoriaCliente.nombre).all()
+    categorias = obtener_categorias(solo_activas=False)
     return render_template('categorias_cliente.html', categorias=categorias)
 
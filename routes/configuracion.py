@@ -1,27 +1,70 @@
 """Rutas de configuración (solo supervisor)"""
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, jsonify, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, jsonify, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
 from extensions import db
-from models import Usuario, Comercial, Cliente, Prenda, Pedido, LineaPedido, Presupuesto, LineaPresupuesto, Ticket, LineaTicket, Factura, LineaFactura, PlantillaEmail, Proveedor, Configuracion, DiaFestivo
+from models import Usuario, Comercial, Cliente, Prenda, Pedido, LineaPedido, Presupuesto, LineaPresupuesto, Ticket, LineaTicket, Factura, LineaFactura, PlantillaEmail, Proveedor, Configuracion, DiaFestivo, TrabajoImportacion
 from utils.auth import supervisor_required, not_usuario_required
-from datetime import datetime
+from utils.instrumentacion_sql import obtener_consultas_lentas, limpiar_consultas_lentas, obtener_umbral_lento_ms
+from utils.copias_seguridad import ruta_base_datos, crear_copia_temporal
+from utils.copias_programadas import listar_copias, buscar_copia
+from utils.sustitucion_bd import sustituir_bd, ruta_temporal_importacion
+from utils.importacion import IMPORTACION_CLIENTES, IMPORTACION_PROVEEDORES
+from utils.trabajos_importacion import (
+    crear_trabajo, lanzar_trabajo, trabajos_recientes, estado_trabajo, resultado_trabajo
+)
+from utils.exportacion import (
+    fichero_temporal, respuesta_fichero_temporal, comprimir_gzip, TIPOS_MIME, FORMATO_XLSX, TAMANO_BLOQUE_ENVIO
+)
+from utils.datos_referencia import (
+    invalidar_usuarios, invalidar_plantillas_email, invalidar_configuracion,
+    invalidar_dias_festivos, configuracion_activa
+)
+from datetime import datetime, date
+from decimal import Decimal
+from sqlalchemy import select
 import io
 import csv
-from openpyxl import Workbook, load_workbook
+import itertools
+import json
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
-from werkzeug.utils import secure_filename
+from openpyxl.utils import get_column_letter
 import os
 import shutil
 
 configuracion_bp = Blueprint('configuracion', __name__)
 
+# Tablas incluidas en las copias de la base de datos (nombre de hoja/sección y modelo)
+TABLAS_BACKUP = [
+    ('Comerciales', Comercial),
+    ('Clientes', Cliente),
+    ('Prendas', Prenda),
+    ('Pedidos', Pedido),
+    ('LineasPedido', LineaPedido),
+    ('Presupuestos', Presupuesto),
+    ('LineasPresupuesto', LineaPresupuesto),
+    ('Tickets', Ticket),
+    ('LineasTicket', LineaTicket),
+    ('Facturas', Factura),
+    ('LineasFactura', LineaFactura),
+    ('Usuarios', Usuario),
+]
+
+# Filas leídas de la BD en cada lote al exportar
+LOTE_EXPORTACION = 1000
+# Filas de cada tabla con las que se estima el ancho de las columnas en Excel
+FILAS_MUESTRA_ANCHO = 200
+ANCHO_MAXIMO_COLUMNA = 50
+
 @configuracion_bp.route('/configuracion')
 @login_required
 @supervisor_required
 def index():
     """Panel de configuración principal"""
     usuarios = Usuario.query.all()
-    return render_template('configuracion/index.html', usuarios=usuarios)
+    copias = listar_copias(current_app.config.get('COPIAS_DIR'))
+    return render_template('configuracion/index.html', usuarios=usuarios, copias=copias)
 
 @configuracion_bp.route('/configuracion/usuarios', methods=['GET', 'POST'])
 @login_required
@@ -62,6 +105,7 @@ def gestion_usuarios():
                 comercial = Comercial(usuario_id=nuevo_usuario.id, _nombre=nuevo_usuario.usuario)
                 db.session.add(comercial)
             
+            invalidar_usuarios()
             db.session.commit()
             
             flash('Usuario creado correctamente', 'success')
@@ -105,6 +149,7 @@ def editar_usuario(id):
             if comercial_existente:
                 db.session.delete(comercial_existente)
         
+        invalidar_usuarios()
         db.session.commit()
         flash('Usuario actualizado correctamente', 'success')
     except Exception as e:
@@ -127,6 +172,7 @@ def eliminar_usuario(id):
     
     try:
         usuario.activo = False
+        invalidar_usuarios()
         db.session.commit()
         flash('Usuario desactivado correctamente', 'success')
     except Exception as e:
@@ -155,6 +201,7 @@ def verifactu_info():
             config.valor = 'true' if request.form.get('verifactu_enviar_activo') == 'on' else 'false'
             config.fecha_actualizacion = datetime.utcnow()
             
+            invalidar_configuracion()
             db.session.commit()
             flash('Configuración de Verifactu actualizada correctamente', 'success')
             return redirect(url_for('configuracion.verifactu_info'))
@@ -163,10 +210,7 @@ def verifactu_info():
             flash(f'Error al actualizar configuración: {str(e)}', 'error')
     
     # Obtener la configuración actual
-    config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-    verifactu_activo = True  # Por defecto activado
-    if config:
-        verifactu_activo = config.valor.lower() == 'true'
+    verifactu_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
     
     return render_template('configuracion/verifactu.html', verifactu_activo=verifactu_activo)
 
@@ -179,157 +223,183 @@ def exportar_bd():
     
     if formato == 'excel':
         return exportar_excel()
-    elif formato == 'txt':
-        return exportar_txt()
+    elif formato in ('txt', 'ndjson'):
+        return exportar_txt(formato, comprimir=request.args.get('comprimir') == '1')
     else:
         flash('Formato no válido', 'error')
         return redirect(url_for('configuracion.index'))
 
+def _filas_tabla(modelo):
+    """Filas de la tabla de un modelo como tuplas (sin crear objetos ORM), leídas por lotes"""
+    tabla = modelo.__table__
+    return db.session.execute(
+        select(*tabla.columns)
+        .order_by(*tabla.primary_key.columns)
+        .execution_options(yield_per=LOTE_EXPORTACION)
+    )
+
+
+def _valor_excel(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    return valor
+
+
+def _anchos_columnas(columnas, muestra):
+    """Ancho de cada columna estimado con la cabecera y las filas de muestra"""
+    anchos = [len(col) for col in columnas]
+    for fila in muestra:
+        for idx, valor in enumerate(fila):
+            if valor is not None:
+                anchos[idx] = max(anchos[idx], len(str(valor)))
+    return [min(ancho + 2, ANCHO_MAXIMO_COLUMNA) for ancho in anchos]
+
+
+def _escribir_hoja_backup(wb, nombre_hoja, modelo):
+    ws = wb.create_sheet(title=nombre_hoja)
+    columnas = [col.name for col in modelo.__table__.columns]
+    filas = (tuple(_valor_excel(v) for v in fila) for fila in _filas_tabla(modelo))
+
+    # En modo write_only los anchos se fijan antes de la primera fila: se estiman con una muestra
+    muestra = list(itertools.islice(filas, FILAS_MUESTRA_ANCHO))
+    if not muestra:
+        return
+    for idx, ancho in enumerate(_anchos_columnas(columnas, muestra), 1):
+        ws.column_dimensions[get_column_letter(idx)].width = ancho
+
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    cabecera = []
+    for col in columnas:
+        cell = WriteOnlyCell(ws, value=col)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal="center")
+        cabecera.append(cell)
+    ws.append(cabecera)
+
+    for fila in itertools.chain(muestra, filas):
+        ws.append(fila)
+
+
 def exportar_excel():
-    """Exportar base de datos a Excel"""
-    wb = Workbook()
-    
-    # Lista de modelos y sus nombres de hoja
-    modelos = [
-        ('Comerciales', Comercial),
-        ('Clientes', Cliente),
-        ('Prendas', Prenda),
-        ('Pedidos', Pedido),
-        ('LineasPedido', LineaPedido),
-        ('Presupuestos', Presupuesto),
-        ('LineasPresupuesto', LineaPresupuesto),
-        ('Tickets', Ticket),
-        ('LineasTicket', LineaTicket),
-        ('Facturas', Factura),
-        ('LineasFactura', LineaFactura),
-        ('Usuarios', Usuario),
-    ]
-    
-    for nombre_hoja, modelo in modelos:
-        ws = wb.create_sheet(title=nombre_hoja)
-        
-        # Obtener todos los registros
-        registros = modelo.query.all()
-        
-        if not registros:
-            continue
-        
-        # Obtener columnas del modelo
-        columnas = [col.name for col in modelo.__table__.columns]
-        
-        # Escribir encabezados
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        
-        for idx, col in enumerate(columnas, 1):
-            cell = ws.cell(row=1, column=idx, value=col)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center")
-        
-        # Escribir datos
-        for row_idx, registro in enumerate(registros, 2):
-            for col_idx, col in enumerate(columnas, 1):
-                valor = getattr(registro, col)
-                if isinstance(valor, datetime):
-                    valor = valor.strftime('%Y-%m-%d %H:%M:%S')
-                elif valor is None:
-                    valor = ''
-                ws.cell(row=row_idx, column=col_idx, value=valor)
-        
-        # Ajustar ancho de columnas
-        for col in ws.columns:
-            max_length = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[col_letter].width = adjusted_width
-    
-    # Eliminar hoja por defecto
-    if 'Sheet' in wb.sheetnames:
-        wb.remove(wb['Sheet'])
-    
-    # Guardar en memoria
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
+    """
+    Exportar base de datos a Excel
+
+    Las hojas se escriben en modo write_only (las filas van a disco según se añaden) a
+    un fichero temporal que se envía por bloques: la memoria no depende del tamaño de la BD.
+    """
+    wb = Workbook(write_only=True)
+    ruta = fichero_temporal('.xlsx')
+    try:
+        for nombre_hoja, modelo in TABLAS_BACKUP:
+            _escribir_hoja_backup(wb, nombre_hoja, modelo)
+        wb.save(ruta)
+    except Exception:
+        os.remove(ruta)
+        raise
+
     fecha = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'backup_bd_{fecha}.xlsx'
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return respuesta_fichero_temporal(ruta, f'backup_bd_{fecha}.xlsx', TIPOS_MIME[FORMATO_XLSX])
+
+def _valor_texto(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    if valor is None:
+        return ''
+    return str(valor)
+
+
+def _generar_txt():
+    """Bloques del volcado TXT: por cada tabla, un título y sus filas en CSV"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def volcar():
+        texto = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return texto.encode('utf-8')
+
+    for nombre_tabla, modelo in TABLAS_BACKUP:
+        buffer.write(f'\n{"="*80}\n')
+        buffer.write(f'TABLA: {nombre_tabla}\n')
+        buffer.write(f'{"="*80}\n\n')
+
+        hay_registros = False
+        for fila in _filas_tabla(modelo):
+            if not hay_registros:
+                writer.writerow([col.name for col in modelo.__table__.columns])
+                hay_registros = True
+            writer.writerow([_valor_texto(v) for v in fila])
+            if buffer.tell() >= TAMANO_BLOQUE_ENVIO:
+                yield volcar()
+
+        buffer.write('\n' if hay_registros else '(Sin registros)\n\n')
+        yield volcar()
+
+
+def _valor_json(valor):
+    """Tipos que json no serializa: fechas en ISO 8601 y decimales como texto (sin perder precisión)"""
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    if isinstance(valor, bytes):
+        return valor.hex()
+    raise TypeError(f'Tipo no exportable a JSON: {type(valor).__name__}')
+
+
+def _generar_ndjson():
+    """
+    Bloques del volcado NDJSON: una línea JSON por fila
+
+    Cada línea es {"tabla": <nombre de la tabla en la BD>, "fila": {columna: valor}},
+    pensada para volver a importarse.
+    """
+    lineas = []
+    tamano = 0
+    for _, modelo in TABLAS_BACKUP:
+        tabla = modelo.__table__
+        columnas = [col.name for col in tabla.columns]
+        for fila in _filas_tabla(modelo):
+            linea = json.dumps({'tabla': tabla.name, 'fila': dict(zip(columnas, fila))},
+                               ensure_ascii=False, default=_valor_json)
+            lineas.append(linea)
+            tamano += len(linea)
+            if tamano >= TAMANO_BLOQUE_ENVIO:
+                yield ('\n'.join(lineas) + '\n').encode('utf-8')
+                lineas = []
+                tamano = 0
+    if lineas:
+        yield ('\n'.join(lineas) + '\n').encode('utf-8')
+
+
+def exportar_txt(formato='txt', comprimir=False):
+    """
+    Exportar base de datos a TXT (CSV por tablas) o NDJSON, opcionalmente en gzip
+
+    El volcado se genera tabla a tabla mientras se envía (las filas se leen por lotes),
+    así que la memoria usada no depende del tamaño de la BD.
+    """
+    if formato == 'ndjson':
+        bloques = _generar_ndjson()
+        mimetype = 'application/x-ndjson'
+    else:
+        bloques = _generar_txt()
+        mimetype = 'text/plain; charset=utf-8'
 
-def exportar_txt():
-    """Exportar base de datos a TXT (CSV)"""
-    output = io.StringIO()
-    
-    modelos = [
-        ('Comerciales', Comercial),
-        ('Clientes', Cliente),
-        ('Prendas', Prenda),
-        ('Pedidos', Pedido),
-        ('LineasPedido', LineaPedido),
-        ('Presupuestos', Presupuesto),
-        ('LineasPresupuesto', LineaPresupuesto),
-        ('Tickets', Ticket),
-        ('LineasTicket', LineaTicket),
-        ('Facturas', Factura),
-        ('LineasFactura', LineaFactura),
-        ('Usuarios', Usuario),
-    ]
-    
-    for nombre_tabla, modelo in modelos:
-        output.write(f'\n{"="*80}\n')
-        output.write(f'TABLA: {nombre_tabla}\n')
-        output.write(f'{"="*80}\n\n')
-        
-        registros = modelo.query.all()
-        
-        if not registros:
-            output.write('(Sin registros)\n\n')
-            continue
-        
-        # Obtener columnas
-        columnas = [col.name for col in modelo.__table__.columns]
-        
-        # Escribir encabezados
-        writer = csv.writer(output)
-        writer.writerow(columnas)
-        
-        # Escribir datos
-        for registro in registros:
-            fila = []
-            for col in columnas:
-                valor = getattr(registro, col)
-                if isinstance(valor, datetime):
-                    valor = valor.strftime('%Y-%m-%d %H:%M:%S')
-                elif valor is None:
-                    valor = ''
-                fila.append(str(valor))
-            writer.writerow(fila)
-        
-        output.write('\n')
-    
-    output.seek(0)
-    
     fecha = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'backup_bd_{fecha}.txt'
-    
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        mimetype='text/plain',
-        as_attachment=True,
-        download_name=filename
+    filename = f'backup_bd_{fecha}.{formato}'
+    if comprimir:
+        bloques = comprimir_gzip(bloques)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+
+    return Response(
+        stream_with_context(bloques),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
     )
 
 @configuracion_bp.route('/configuracion/importar', methods=['GET', 'POST'])
@@ -387,6 +457,7 @@ def editar_plantilla_email(id):
             plantilla.enviar_activo = request.form.get('enviar_activo') == 'on'
             plantilla.fecha_actualizacion = datetime.utcnow()
             
+            invalidar_plantillas_email()
             db.session.commit()
             flash('Plantilla actualizada correctamente', 'success')
             return redirect(url_for('configuracion.plantillas_email'))
@@ -406,6 +477,7 @@ def toggle_plantilla_email(id):
         # Invertir el estado actual
         plantilla.enviar_activo = not plantilla.enviar_activo
         plantilla.fecha_actualizacion = datetime.utcnow()
+        invalidar_plantillas_email()
         db.session.commit()
         
         estado = 'activada' if plantilla.enviar_activo else 'desactivada'
@@ -416,45 +488,56 @@ def toggle_plantilla_email(id):
     
     return redirect(url_for('configuracion.plantillas_email'))
 
+@configuracion_bp.route('/configuracion/consultas-lentas', methods=['GET', 'POST'])
+@login_required
+@supervisor_required
+def consultas_lentas():
+    """Consultas SQL lentas de todos los workers agregadas por sentencia normalizada"""
+    if request.method == 'POST':
+        limpiar_consultas_lentas()
+        flash('Estadísticas de consultas lentas reiniciadas', 'success')
+        return redirect(url_for('configuracion.consultas_lentas'))
+    
+    return render_template('configuracion/consultas_lentas.html',
+                         consultas=obtener_consultas_lentas(),
+                         umbral_ms=obtener_umbral_lento_ms())
+
 @configuracion_bp.route('/configuracion/descargar-bd')
 @login_required
 @supervisor_required
 def descargar_bd():
-    """Descargar el archivo de base de datos SQLite"""
+    """
+    Descargar una copia de la base de datos SQLite (?comprimir=1 para gzip)
+
+    La copia se hace con la API de backup de SQLite en un fichero temporal, que se
+    envía desde disco y se borra al terminar.
+    """
     try:
-        # Obtener la ruta de la base de datos desde la configuración
-        database_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
-        
-        # Extraer la ruta del archivo desde sqlite:///ruta
-        if database_uri.startswith('sqlite:///'):
-            db_path = database_uri.replace('sqlite:///', '')
-            # En Windows, puede venir con barras normales, convertir a barras del sistema
-            db_path = os.path.normpath(db_path)
-        else:
+        if ruta_base_datos() is None:
             flash('No se pudo determinar la ruta de la base de datos', 'error')
             return redirect(url_for('configuracion.index'))
         
-        # Verificar que el archivo existe
-        if not os.path.exists(db_path):
+        comprimir = request.args.get('comprimir') == '1'
+        try:
+            ruta_copia = crear_copia_temporal(comprimir=comprimir)
+        except FileNotFoundError:
             flash('El archivo de base de datos no existe', 'error')
             return redirect(url_for('configuracion.index'))
         
-        # Crear una copia temporal con nombre con fecha
         fecha = datetime.now().strftime('%Y%m%d_%H%M%S')
-        nombre_archivo = f'pedidos_backup_{fecha}.db'
-        
-        # Crear un archivo temporal en memoria
-        temp_file = io.BytesIO()
-        with open(db_path, 'rb') as f:
-            temp_file.write(f.read())
-        temp_file.seek(0)
+        nombre_archivo = f'pedidos_backup_{fecha}.db' + ('.gz' if comprimir else '')
         
-        return send_file(
-            temp_file,
-            mimetype='application/x-sqlite3',
+        respuesta = send_file(
+            ruta_copia,
+            mimetype='application/gzip' if comprimir else 'application/x-sqlite3',
             as_attachment=True,
             download_name=nombre_archivo
         )
+        # send_file marca la respuesta como direct_passthrough y entonces el servidor no
+        # llama a close(): se desactiva para que se ejecute el borrado de la copia
+        respuesta.direct_passthrough = False
+        respuesta.call_on_close(lambda: os.remove(ruta_copia))
+        return respuesta
         
     except Exception as e:
         flash(f'Error al descargar la base de datos: {str(e)}', 'error')
@@ -464,44 +547,42 @@ def descargar_bd():
 @login_required
 @supervisor_required
 def importar_bd_sqlite():
-    """Importar/cargar un archivo SQLite para reemplazar la base de datos actual"""
+    """
+    Importar/cargar un archivo SQLite para reemplazar la base de datos actual
+
+    En lugar de un archivo subido puede restaurarse una copia automática (campo 'copia'
+    con su nombre, desde el listado de copias de /configuracion).
+    """
     if request.method == 'POST':
         try:
-            # Verificar que se subió un archivo
-            if 'archivo' not in request.files:
-                flash('No se seleccionó ningún archivo', 'error')
-                return redirect(url_for('configuracion.importar_bd_sqlite'))
-            
-            archivo = request.files['archivo']
-            if archivo.filename == '':
-                flash('No se seleccionó ningún archivo', 'error')
-                return redirect(url_for('configuracion.importar_bd_sqlite'))
-            
-            # Verificar extensión
-            if not archivo.filename.lower().endswith('.db'):
-                flash('El archivo debe ser un archivo SQLite (.db)', 'error')
-                return redirect(url_for('configuracion.importar_bd_sqlite'))
-            
-            # Obtener la ruta de la base de datos actual
-            database_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+            copia = None
+            archivo = None
+            if request.form.get('copia'):
+                copia = buscar_copia(current_app.config.get('COPIAS_DIR'), request.form.get('copia'))
+                if copia is None:
+                    flash('La copia de seguridad no existe', 'error')
+                    return redirect(url_for('configuracion.index'))
+            else:
+                # Verificar que se subió un archivo
+                if 'archivo' not in request.files:
+                    flash('No se seleccionó ningún archivo', 'error')
+                    return redirect(url_for('configuracion.importar_bd_sqlite'))
+                
+                archivo = request.files['archivo']
+                if archivo.filename == '':
+                    flash('No se seleccionó ningún archivo', 'error')
+                    return redirect(url_for('configuracion.importar_bd_sqlite'))
+                
+                # Verificar extensión
+                if not archivo.filename.lower().endswith('.db'):
+                    flash('El archivo debe ser un archivo SQLite (.db)', 'error')
+                    return redirect(url_for('configuracion.importar_bd_sqlite'))
             
-            if not database_uri.startswith('sqlite:///'):
+            db_path = ruta_base_datos()
+            if db_path is None:
                 flash('No se pudo determinar la ruta de la base de datos', 'error')
                 return redirect(url_for('configuracion.importar_bd_sqlite'))
             
-            db_path = database_uri.replace('sqlite:///', '')
-            db_path = os.path.normpath(db_path)
-            
-            # Validar que el archivo subido es SQLite válido (verificar header)
-            archivo.seek(0)
-            header = archivo.read(16)
-            archivo.seek(0)
-            
-            # SQLite tiene un header específico: "SQLite format 3\000"
-            if not header.startswith(b'SQLite format 3\x00'):
-                flash('El archivo no es un archivo SQLite válido', 'error')
-                return redirect(url_for('configuracion.importar_bd_sqlite'))
-            
             # Verificar que el directorio destino existe y es escribible
             db_dir = os.path.dirname(db_path)
             if db_dir and not os.path.exists(db_dir):
@@ -516,57 +597,30 @@ def importar_bd_sqlite():
                 flash(f'Error: No se tienen permisos de escritura en el directorio destino', 'error')
                 return redirect(url_for('configuracion.importar_bd_sqlite'))
             
-            # Cerrar todas las conexiones de la base de datos antes de reemplazar
-            db.session.close()
-            db.engine.dispose()
-            
-            # Hacer backup de la base de datos actual antes de reemplazarla
-            backup_path = None
-            if os.path.exists(db_path):
-                fecha_backup = datetime.now().strftime('%Y%m%d_%H%M%S')
-                backup_path = db_path.replace('.db', f'_backup_{fecha_backup}.db')
-                try:
-                    shutil.copy2(db_path, backup_path)
-                    flash(f'Backup creado: {os.path.basename(backup_path)}', 'info')
-                except Exception as e:
-                    flash(f'Advertencia: No se pudo crear backup automático: {str(e)}', 'warning')
-            
-            # Guardar el nuevo archivo usando shutil para mayor robustez
-            # Primero guardar en un archivo temporal y luego moverlo
-            temp_path = db_path + '.tmp'
+            # El archivo nuevo se guarda (por bloques) junto a la BD y se valida y coloca
+            # de forma atómica; el resto de workers cambian de BD en su siguiente petición
+            temp_path = ruta_temporal_importacion(db_path)
             try:
-                archivo.save(temp_path)
-                # Verificar que el archivo temporal se guardó correctamente
-                if not os.path.exists(temp_path):
-                    raise Exception('No se pudo guardar el archivo temporal')
-                
-                # Si existe la BD actual, eliminarla antes de mover el nuevo
-                if os.path.exists(db_path):
-                    os.remove(db_path)
-                
-                # Mover el archivo temporal a la ubicación final
-                shutil.move(temp_path, db_path)
-                
-                # Verificar que el archivo final existe y tiene contenido
-                if not os.path.exists(db_path) or os.path.getsize(db_path) == 0:
-                    raise Exception('El archivo no se guardó correctamente')
-                
-            except Exception as e:
-                # Si hay error, intentar restaurar el backup si existe
-                if backup_path and os.path.exists(backup_path):
-                    try:
-                        shutil.copy2(backup_path, db_path)
-                        flash(f'Error al guardar. Se restauró el backup automático.', 'warning')
-                    except:
-                        pass
-                raise e
+                if copia is not None:
+                    shutil.copy2(copia['ruta'], temp_path)
+                else:
+                    archivo.save(temp_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
             
-            # Reinicializar la conexión de la base de datos
-            db.engine.dispose()
-            db.create_all()
+            try:
+                backup_path = sustituir_bd(temp_path)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return redirect(url_for('configuracion.importar_bd_sqlite'))
+            if backup_path:
+                flash(f'Backup creado: {os.path.basename(backup_path)}', 'info')
             
-            # Mostrar información sobre dónde se guardó
-            flash(f'Base de datos importada correctamente en: {db_path}', 'success')
+            if copia is not None:
+                flash(f"Copia de seguridad del {copia['fecha'].strftime('%d/%m/%Y %H:%M')} restaurada", 'success')
+            else:
+                flash(f'Base de datos importada correctamente en: {db_path}', 'success')
             return redirect(url_for('configuracion.index'))
             
         except Exception as e:
@@ -604,163 +658,23 @@ def importar_clientes():
             flash('El archivo debe ser Excel (.xlsx o .xls)', 'error')
             return redirect(url_for('configuracion.importar_clientes'))
         
-        temp_path = None
         try:
-            # Guardar archivo temporalmente
-            filename = secure_filename(archivo.filename)
-            temp_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-            archivo.save(temp_path)
-            
-            # Cargar el archivo Excel
-            wb = load_workbook(temp_path, data_only=True)
-            ws = wb.active
-            
-            # Leer la primera fila para obtener los encabezados
-            headers = []
-            for cell in ws[1]:
-                headers.append(str(cell.value) if cell.value else '')
-            
-            # Mapeo de columnas del Excel a campos de la base de datos
-            column_map = {}
-            for idx, header in enumerate(headers):
-                if header and header.strip():
-                    header_upper = header.upper()
-                    if 'NOMBRE FISCAL' in header_upper or ('NOMBRE' in header_upper and 'FISCAL' in header_upper):
-                        column_map['nombre'] = idx
-                    elif 'ALIAS' in header_upper:
-                        column_map['alias'] = idx
-                    elif ('TEL' in header_upper or 'TELEFONO' in header_upper) and 'MOVIL' not in header_upper:
-                        column_map['telefono'] = idx
-                    elif 'MOVIL' in header_upper or ('M' in header_upper and 'VIL' in header_upper):
-                        column_map['movil'] = idx
-                    elif 'E-MAIL' in header_upper or 'EMAIL' in header_upper:
-                        column_map['email'] = idx
-                    elif 'PERSONA' in header_upper and 'CONTACTO' in header_upper:
-                        column_map['personas_contacto'] = idx
-                    elif 'N.I.F' in header_upper or ('NIF' in header_upper and '.' in header):
-                        column_map['nif'] = idx
-                    elif 'DOMICILIO' in header_upper or 'DIRECCION' in header_upper:
-                        column_map['direccion'] = idx
-                    elif 'POBLACI' in header_upper:
-                        column_map['poblacion'] = idx
-                    elif ('C' in header_upper or 'COD' in header_upper) and 'POSTAL' in header_upper:
-                        column_map['codigo_postal'] = idx
-                    elif 'PROVINCIA' in header_upper:
-                        column_map['provincia'] = idx
-                    elif 'ANOTACIONES' in header_upper:
-                        column_map['anotaciones'] = idx
-            
-            # Verificar que tenemos al menos nombre
-            if 'nombre' not in column_map:
-                flash('No se encontró la columna "NOMBRE FISCAL" en el archivo', 'error')
-                os.remove(temp_path)
-                return redirect(url_for('configuracion.importar_clientes'))
-            
-            # Leer datos desde la fila 2 en adelante
-            clientes_importados = 0
-            clientes_duplicados = 0
-            errores = 0
-            
-            for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=False), start=2):
-                try:
-                    # Obtener valores de las celdas según el mapeo
-                    valores = {}
-                    for campo, col_idx in column_map.items():
-                        if col_idx < len(row):
-                            valor = row[col_idx].value
-                            if valor is not None and str(valor).strip() != '':
-                                if isinstance(valor, (int, float)):
-                                    if campo in ['telefono', 'movil', 'codigo_postal']:
-                                        valor = str(int(valor))
-                                    else:
-                                        valor = str(int(valor))
-                                else:
-                                    valor = str(valor).strip()
-                                
-                                if campo != 'email' and valor:
-                                    valor = valor.upper()
-                                
-                                # Procesar código postal
-                                if campo == 'codigo_postal' and valor:
-                                    valor_str = ''.join(filter(str.isdigit, str(valor)))
-                                    if valor_str.isdigit() and len(valor_str) == 4:
-                                        valor = '0' + valor_str
-                                
-                                valores[campo] = valor if valor else None
-                            else:
-                                valores[campo] = None
-                        else:
-                            valores[campo] = None
-                    
-                    # Verificar que al menos tenga nombre
-                    if not valores.get('nombre'):
-                        continue
-                    
-                    # Verificar si el cliente ya existe
-                    cliente_existente = None
-                    if valores.get('nif'):
-                        cliente_existente = Cliente.query.filter_by(nif=valores['nif']).first()
-                    
-                    if not cliente_existente:
-                        cliente_existente = Cliente.query.filter_by(nombre=valores['nombre']).first()
-                    
-                    if cliente_existente:
-                        clientes_duplicados += 1
-                        continue
-                    
-                    # Preparar email en minúsculas
-                    email = valores.get('email')
-                    if email:
-                        email = email.lower()
-                    
-                    # Crear nuevo cliente
-                    cliente = Cliente(
-                        nombre=valores.get('nombre'),
-                        alias=valores.get('alias'),
-                        nif=valores.get('nif'),
-                        direccion=valores.get('direccion'),
-                        poblacion=valores.get('poblacion'),
-                        provincia=valores.get('provincia'),
-                        codigo_postal=valores.get('codigo_postal'),
-                        pais='España',
-                        telefono=valores.get('telefono'),
-                        movil=valores.get('movil'),
-                        email=email,
-                        personas_contacto=valores.get('personas_contacto'),
-                        anotaciones=valores.get('anotaciones'),
-                        fecha_alta=datetime.now().date()
-                    )
-                    
-                    db.session.add(cliente)
-                    clientes_importados += 1
-                    
-                    if clientes_importados % 50 == 0:
-                        db.session.commit()
-                        
-                except Exception as e:
-                    errores += 1
-                    continue
-            
-            # Hacer commit final
-            db.session.commit()
-            
-            # Eliminar archivo temporal
-            os.remove(temp_path)
-            
-            flash(f'Importación completada: {clientes_importados} clientes importados, {clientes_duplicados} duplicados omitidos, {errores} errores', 'success')
-            return redirect(url_for('configuracion.index'))
+            # El Excel se guarda y se importa en segundo plano (utils/trabajos_importacion.py)
+            trabajo = crear_trabajo(IMPORTACION_CLIENTES, archivo, current_user.id)
+            lanzar_trabajo(trabajo.id)
+            return redirect(url_for('configuracion.ver_importacion', id=trabajo.id))
             
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('configuracion.importar_clientes'))
         except Exception as e:
             db.session.rollback()
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
             flash(f'Error al importar clientes: {str(e)}', 'error')
             import traceback
             traceback.print_exc()
             return redirect(url_for('configuracion.importar_clientes'))
     
-    return render_template('configuracion/importar_clientes.html')
+    return render_template('configuracion/importar_clientes.html', trabajos=trabajos_recientes(IMPORTACION_CLIENTES))
 
 @configuracion_bp.route('/configuracion/importar-proveedores', methods=['GET', 'POST'])
 @login_required
@@ -782,138 +696,56 @@ def importar_proveedores():
             flash('El archivo debe ser Excel (.xlsx o .xls)', 'error')
             return redirect(url_for('configuracion.importar_proveedores'))
         
-        temp_path = None
         try:
-            # Guardar archivo temporalmente
-            filename = secure_filename(archivo.filename)
-            temp_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-            archivo.save(temp_path)
-            
-            # Cargar el archivo Excel
-            wb = load_workbook(temp_path, data_only=True)
-            ws = wb.active
-            
-            # Leer la primera fila para obtener los encabezados
-            headers = []
-            for cell in ws[1]:
-                headers.append(str(cell.value) if cell.value else '')
-            
-            # Mapeo de columnas del Excel a campos de la base de datos
-            column_map = {}
-            for idx, header in enumerate(headers):
-                if header and header.strip():
-                    header_upper = header.upper()
-                    if 'NOMBRE' in header_upper and 'FISCAL' not in header_upper:
-                        column_map['nombre'] = idx
-                    elif 'CIF' in header_upper or 'NIF' in header_upper:
-                        column_map['cif'] = idx
-                    elif ('TEL' in header_upper or 'TELEFONO' in header_upper) and 'MOVIL' not in header_upper:
-                        column_map['telefono'] = idx
-                    elif 'MOVIL' in header_upper or ('M' in header_upper and 'VIL' in header_upper):
-                        column_map['movil'] = idx
-                    elif 'E-MAIL' in header_upper or 'EMAIL' in header_upper or 'CORREO' in header_upper:
-                        column_map['correo'] = idx
-                    elif 'PERSONA' in header_upper and 'CONTACTO' in header_upper:
-                        column_map['persona_contacto'] = idx
-            
-            # Verificar que tenemos al menos nombre
-            if 'nombre' not in column_map:
-                flash('No se encontró la columna "NOMBRE" en el archivo', 'error')
-                os.remove(temp_path)
-                return redirect(url_for('configuracion.importar_proveedores'))
-            
-            # Leer datos desde la fila 2 en adelante
-            proveedores_importados = 0
-            proveedores_duplicados = 0
-            errores = 0
-            
-            for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=False), start=2):
-                try:
-                    # Obtener valores de las celdas según el mapeo
-                    valores = {}
-                    for campo, col_idx in column_map.items():
-                        if col_idx < len(row):
-                            valor = row[col_idx].value
-                            if valor is not None and str(valor).strip() != '':
-                                if isinstance(valor, (int, float)):
-                                    if campo in ['telefono', 'movil']:
-                                        valor = str(int(valor))
-                                    else:
-                                        valor = str(int(valor))
-                                else:
-                                    valor = str(valor).strip()
-                                
-                                if campo not in ['correo', 'email'] and valor:
-                                    valor = valor.upper()
-                                
-                                valores[campo] = valor if valor else None
-                            else:
-                                valores[campo] = None
-                        else:
-                            valores[campo] = None
-                    
-                    # Verificar que al menos tenga nombre
-                    if not valores.get('nombre'):
-                        continue
-                    
-                    # Verificar si el proveedor ya existe
-                    proveedor_existente = None
-                    if valores.get('cif'):
-                        proveedor_existente = Proveedor.query.filter_by(cif=valores['cif']).first()
-                    
-                    if not proveedor_existente:
-                        proveedor_existente = Proveedor.query.filter_by(nombre=valores['nombre']).first()
-                    
-                    if proveedor_existente:
-                        proveedores_duplicados += 1
-                        continue
-                    
-                    # Preparar correo en minúsculas
-                    correo = valores.get('correo')
-                    if correo:
-                        correo = correo.lower()
-                    
-                    # Crear nuevo proveedor
-                    proveedor = Proveedor(
-                        nombre=valores.get('nombre'),
-                        cif=valores.get('cif'),
-                        telefono=valores.get('telefono'),
-                        movil=valores.get('movil'),
-                        correo=correo,
-                        persona_contacto=valores.get('persona_contacto'),
-                        activo=True
-                    )
-                    
-                    db.session.add(proveedor)
-                    proveedores_importados += 1
-                    
-                    if proveedores_importados % 50 == 0:
-                        db.session.commit()
-                        
-                except Exception as e:
-                    errores += 1
-                    continue
-            
-            # Hacer commit final
-            db.session.commit()
-            
-            # Eliminar archivo temporal
-            os.remove(temp_path)
-            
-            flash(f'Importación completada: {proveedores_importados} proveedores importados, {proveedores_duplicados} duplicados omitidos, {errores} errores', 'success')
-            return redirect(url_for('configuracion.index'))
+            # El Excel se guarda y se importa en segundo plano (utils/trabajos_importacion.py)
+            trabajo = crear_trabajo(IMPORTACION_PROVEEDORES, archivo, current_user.id)
+            lanzar_trabajo(trabajo.id)
+            return redirect(url_for('configuracion.ver_importacion', id=trabajo.id))
             
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('configuracion.importar_proveedores'))
         except Exception as e:
             db.session.rollback()
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
             flash(f'Error al importar proveedores: {str(e)}', 'error')
             import traceback
             traceback.print_exc()
             return redirect(url_for('configuracion.importar_proveedores'))
     
-    return render_template('configuracion/importar_proveedores.html')
+    return render_template('configuracion/importar_proveedores.html', trabajos=trabajos_recientes(IMPORTACION_PROVEEDORES))
+
+@configuracion_bp.route('/configuracion/importaciones/<int:id>')
+@login_required
+@supervisor_required
+def ver_importacion(id):
+    """Progreso e informe de un trabajo de importación"""
+    trabajo = TrabajoImportacion.query.get_or_404(id)
+    return render_template('configuracion/trabajo_importacion.html',
+                           trabajo=trabajo,
+                           estado=estado_trabajo(trabajo),
+                           resultado=resultado_trabajo(trabajo))
+
+@configuracion_bp.route('/configuracion/importaciones/<int:id>/estado')
+@login_required
+@supervisor_required
+def estado_importacion(id):
+    """Progreso de un trabajo de importación (JSON, para la página del trabajo)"""
+    trabajo = TrabajoImportacion.query.get_or_404(id)
+    return jsonify(estado_trabajo(trabajo))
+
+@configuracion_bp.route('/configuracion/importaciones/<int:id>/reanudar', methods=['POST'])
+@login_required
+@supervisor_required
+def reanudar_importacion(id):
+    """Reanudar un trabajo interrumpido o con error desde su último lote confirmado"""
+    trabajo = TrabajoImportacion.query.get_or_404(id)
+    if trabajo.estado == 'completado':
+        flash('La importación ya está completada', 'info')
+    elif lanzar_trabajo(trabajo.id):
+        flash(f'Importación reanudada desde la fila {trabajo.ultima_fila + 1}', 'success')
+    else:
+        flash('La importación ya se está ejecutando', 'info')
+    return redirect(url_for('configuracion.ver_importacion', id=id))
 
 @configuracion_bp.route('/configuracion/dias-festivos', methods=['GET', 'POST'])
 @login_required
@@ -943,6 +775,7 @@ def gestion_dias_festivos():
             config_domingos.valor = 'true' if excluir_domingos else 'false'
             config_domingos.fecha_actualizacion = datetime.utcnow()
             
+            invalidar_configuracion()
             db.session.commit()
             flash('Configuración guardada correctamente', 'success')
         
@@ -960,6 +793,7 @@ def gestion_dias_festivos():
                     else:
                         nuevo_dia = DiaFestivo(fecha=fecha, nombre=nombre, activo=True)
                         db.session.add(nuevo_dia)
+                        invalidar_dias_festivos()
                         db.session.commit()
                         flash('Día festivo creado correctamente', 'success')
                 except ValueError:
@@ -985,6 +819,7 @@ def gestion_dias_festivos():
                     else:
                         dia.fecha = fecha
                         dia.nombre = nombre
+                        invalidar_dias_festivos()
                         db.session.commit()
                         flash('Día festivo actualizado correctamente', 'success')
                 except ValueError:
@@ -999,6 +834,7 @@ def gestion_dias_festivos():
                 try:
                     dia = DiaFestivo.query.get_or_404(dia_id)
                     db.session.delete(dia)
+                    invalidar_dias_festivos()
                     db.session.commit()
                     flash('Día festivo eliminado correctamente', 'success')
                 except Exception as e:
@@ -1011,6 +847,7 @@ def gestion_dias_festivos():
                 try:
                     dia = DiaFestivo.query.get_or_404(dia_id)
                     dia.activo = (accion == 'activar')
+                    invalidar_dias_festivos()
                     db.session.commit()
                     flash('Día festivo actualizado correctamente', 'success')
                 except Exception as e:
@@ -1020,11 +857,8 @@ def gestion_dias_festivos():
         return redirect(url_for('configuracion.gestion_dias_festivos'))
     
     # Obtener configuración de sábados y domingos
-    config_sabados = Configuracion.query.filter_by(clave='excluir_sabados').first()
-    excluir_sabados = config_sabados.valor.lower() == 'true' if config_sabados else False
-    
-    config_domingos = Configuracion.query.filter_by(clave='excluir_domingos').first()
-    excluir_domingos = config_domingos.valor.lower() == 'true' if config_domingos else False
+    excluir_sabados = configuracion_activa('excluir_sabados', defecto=False)
+    excluir_domingos = configuracion_activa('excluir_domingos', defecto=False)
     
     # Obtener días festivos
     dias_festivos = DiaFestivo.query.order_by(DiaFestivo.fecha).all()
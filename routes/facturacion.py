@@ -9,15 +9,103 @@ import json
 import tempfile
 import base64
 from io import BytesIO
-from sqlalchemy import not_
+from sqlalchemy.orm import raiseload
 from extensions import db
-from models import Factura, LineaFactura, Cliente, Presupuesto, LineaPresupuesto
+from models import Factura, LineaFactura, Cliente, Pedido, Presupuesto, LineaPresupuesto
 from utils.numeracion import obtener_siguiente_numero_factura, obtener_siguiente_numero_albaran
 from playwright.sync_api import sync_playwright
 from utils.auth import not_usuario_required
+from utils.paginacion import paginar_desde_request
+from utils.metricas import registrar_pdf_generado
+from utils.exportacion import respuesta_exportacion, filas_consulta
 
 facturacion_bp = Blueprint('facturacion', __name__)
 
+# Tipos de fila en el listado de prefacturas
+PREFACTURA_SOLICITUD = 'solicitud'
+PREFACTURA_ALBARAN = 'albaran'
+
+
+def consulta_prefacturas(estado_filtro='', fecha_desde=None, fecha_hasta=None):
+    """
+    Subconsulta con las prefacturas pendientes de formalizar
+
+    Une (UNION ALL) las solicitudes aceptadas que no tienen factura (anti-join con
+    NOT EXISTS) y los albaranes pendientes, proyectados a las mismas columnas:
+    tipo, id, cliente_nombre, descripcion, estado, fecha, num_lineas y fecha_orden.
+    El filtro de estado solo se aplica a las solicitudes.
+    """
+    tiene_factura = db.select(Factura.id).where(Factura.presupuesto_id == Presupuesto.id).exists()
+    solicitudes = db.select(
+        db.literal(PREFACTURA_SOLICITUD).label('tipo'),
+        Presupuesto.id.label('id'),
+        Cliente.nombre.label('cliente_nombre'),
+        Presupuesto.tipo_pedido.label('descripcion'),
+        Presupuesto.estado.label('estado'),
+        Presupuesto.fecha_aceptado.label('fecha'),
+        Presupuesto.num_lineas.expression.label('num_lineas'),
+        Presupuesto.fecha_creacion.label('fecha_orden')
+    ).select_from(Presupuesto).outerjoin(Cliente, Presupuesto.cliente_id == Cliente.id).where(
+        Presupuesto.estado == 'aceptado',
+        ~tiene_factura
+    )
+    if estado_filtro:
+        solicitudes = solicitudes.where(Presupuesto.estado == estado_filtro)
+    if fecha_desde:
+        solicitudes = solicitudes.where(Presupuesto.fecha_creacion >= datetime.combine(fecha_desde, datetime.min.time()))
+    if fecha_hasta:
+        solicitudes = solicitudes.where(Presupuesto.fecha_creacion <= datetime.combine(fecha_hasta, datetime.max.time()))
+    
+    # Los albaranes son facturas directas (sin presupuesto_id ni pedido_id) con estado='pendiente'
+    albaranes = db.select(
+        db.literal(PREFACTURA_ALBARAN).label('tipo'),
+        Factura.id.label('id'),
+        Factura.nombre.label('cliente_nombre'),
+        Factura.numero.label('descripcion'),
+        Factura.estado.label('estado'),
+        Factura.fecha_expedicion.label('fecha'),
+        Factura.num_lineas.expression.label('num_lineas'),
+        db.func.coalesce(Factura.fecha_creacion, Factura.fecha_expedicion, type_=db.DateTime).label('fecha_orden')
+    ).where(
+        Factura.tipo_documento == Factura.TIPO_ALBARAN,
+        Factura.estado == 'pendiente'
+    )
+    if fecha_desde:
+        albaranes = albaranes.where(Factura.fecha_expedicion >= fecha_desde)
+    if fecha_hasta:
+        albaranes = albaranes.where(Factura.fecha_expedicion <= fecha_hasta)
+    
+    return db.union_all(solicitudes, albaranes).subquery('prefacturas')
+
+
+def fechas_filtro_facturacion():
+    """Fechas desde/hasta de los filtros GET de facturación (None si faltan o no son válidas)"""
+    fecha_desde_obj = fecha_hasta_obj = None
+    try:
+        if request.args.get('fecha_desde', ''):
+            fecha_desde_obj = datetime.strptime(request.args['fecha_desde'], '%Y-%m-%d').date()
+    except ValueError:
+        pass
+    try:
+        if request.args.get('fecha_hasta', ''):
+            fecha_hasta_obj = datetime.strptime(request.args['fecha_hasta'], '%Y-%m-%d').date()
+    except ValueError:
+        pass
+    return fecha_desde_obj, fecha_hasta_obj
+
+
+def filtros_facturas_formalizadas(estado_filtro='', fecha_desde=None, fecha_hasta=None):
+    """Condiciones del listado de facturas formalizadas (sin albaranes)"""
+    filtros = [Factura.tipo_documento == Factura.TIPO_FACTURA]
+    if estado_filtro:
+        filtros.append(Factura.estado == estado_filtro)
+    if fecha_desde:
+        filtros.append(Factura.fecha_expedicion >= fecha_desde)
+    if fecha_hasta:
+        filtros.append(Factura.fecha_expedicion <= fecha_hasta)
+    return filtros
+
+
 @facturacion_bp.route('/facturacion')
 @login_required
 @not_usuario_required
@@ -32,119 +120,37 @@ def facturacion():
     # Filtros de fecha
     fecha_desde = request.args.get('fecha_desde', '')
     fecha_hasta = request.args.get('fecha_hasta', '')
+    fecha_desde_obj, fecha_hasta_obj = fechas_filtro_facturacion()
     
     prefacturas = []
     facturas = []
+    pagina = None
     
     if tipo_vista == 'pendientes':
-        # Obtener prefacturas: solicitudes aceptadas que aún no tienen factura formalizada
-        # Filtrar solo facturas con presupuesto_id (excluir facturas directas)
-        presupuestos_con_factura_ids = [f.presupuesto_id for f in Factura.query.with_entities(Factura.presupuesto_id).filter(Factura.presupuesto_id.isnot(None)).all()]
-        
-        # Obtener solicitudes (presupuestos) aceptadas sin factura
-        query_solicitudes = Presupuesto.query.filter(Presupuesto.estado == 'aceptado')
-        if presupuestos_con_factura_ids:
-            query_solicitudes = query_solicitudes.filter(not_(Presupuesto.id.in_(presupuestos_con_factura_ids)))
-        
-        # Aplicar filtro de estado a solicitudes
-        if estado_filtro:
-            query_solicitudes = query_solicitudes.filter(Presupuesto.estado == estado_filtro)
-        
-        # Aplicar filtros de fecha a solicitudes
-        if fecha_desde:
-            try:
-                fecha_desde_obj = datetime.strptime(fecha_desde, '%Y-%m-%d').date()
-                query_solicitudes = query_solicitudes.filter(Presupuesto.fecha_creacion >= datetime.combine(fecha_desde_obj, datetime.min.time()))
-            except ValueError:
-                pass
-        
-        if fecha_hasta:
-            try:
-                fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d').date()
-                query_solicitudes = query_solicitudes.filter(Presupuesto.fecha_creacion <= datetime.combine(fecha_hasta_obj, datetime.max.time()))
-            except ValueError:
-                pass
-        
-        solicitudes = query_solicitudes.order_by(Presupuesto.id.desc()).all()
-        
-        # Obtener albaranes: facturas pendientes con número que empieza con 'A' seguido de año y mes (formato A2601_XXX)
-        # Los albaranes son facturas directas (sin presupuesto_id ni pedido_id) con estado='pendiente'
-        from sqlalchemy import and_
-        
-        query_albaranes = Factura.query.filter(
-            and_(
-                Factura.estado == 'pendiente',
-                Factura.presupuesto_id.is_(None),
-                Factura.pedido_id.is_(None),
-                Factura.numero.like('A%_%')  # Formato: A2601_001, A2601_002, etc.
-            )
-        )
-        
-        # Aplicar filtros de fecha a albaranes
-        if fecha_desde:
-            try:
-                fecha_desde_obj = datetime.strptime(fecha_desde, '%Y-%m-%d').date()
-                query_albaranes = query_albaranes.filter(Factura.fecha_expedicion >= fecha_desde_obj)
-            except ValueError:
-                pass
-        
-        if fecha_hasta:
-            try:
-                fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d').date()
-                query_albaranes = query_albaranes.filter(Factura.fecha_expedicion <= fecha_hasta_obj)
-            except ValueError:
-                pass
-        
-        albaranes = query_albaranes.order_by(Factura.fecha_creacion.desc()).all()
-        
-        # Las solicitudes son las prefacturas
-        prefacturas = list(solicitudes)
-        # Agregar albaranes a las prefacturas
-        prefacturas.extend(albaranes)
-        # Ordenar por fecha de creación descendente
-        def obtener_fecha_ordenacion(item):
-            if hasattr(item, 'fecha_creacion') and item.fecha_creacion:
-                return item.fecha_creacion
-            elif hasattr(item, 'fecha_expedicion') and item.fecha_expedicion:
-                return datetime.combine(item.fecha_expedicion, datetime.min.time())
-            elif hasattr(item, 'fecha_aceptado') and item.fecha_aceptado:
-                return datetime.combine(item.fecha_aceptado, datetime.min.time())
-            else:
-                return datetime.min
-        
-        prefacturas.sort(key=obtener_fecha_ordenacion, reverse=True)
+        # Prefacturas: solicitudes aceptadas sin factura y albaranes pendientes, en una
+        # sola consulta (UNION ALL) ordenada y paginada en la BD
+        prefacturas_union = consulta_prefacturas(estado_filtro, fecha_desde_obj, fecha_hasta_obj)
+        pagina = paginar_desde_request(db.session.query(prefacturas_union), [
+            (prefacturas_union.c.fecha_orden, True),
+            (prefacturas_union.c.tipo, True),
+            (prefacturas_union.c.id, True)
+        ])
+        prefacturas = pagina.items
         
         # Obtener estados únicos de presupuestos para el filtro
         estados_presupuestos = db.session.query(Presupuesto.estado).distinct().all()
         estados_list = list(set([estado[0] for estado in estados_presupuestos if estado[0]]))
     else:
         # Obtener facturas formalizadas (excluir albaranes)
-        from sqlalchemy import and_
-        query = Factura.query.filter(
-            # Excluir albaranes: facturas con número en formato A2601_XXX
-            not_(Factura.numero.like('A%_%'))
+        query = Factura.query.options(raiseload('*')).filter(
+            *filtros_facturas_formalizadas(estado_filtro, fecha_desde_obj, fecha_hasta_obj)
         )
         
-        # Aplicar filtro de estado
-        if estado_filtro:
-            query = query.filter(Factura.estado == estado_filtro)
-        
-        # Aplicar filtros de fecha
-        if fecha_desde:
-            try:
-                fecha_desde_obj = datetime.strptime(fecha_desde, '%Y-%m-%d').date()
-                query = query.filter(Factura.fecha_expedicion >= fecha_desde_obj)
-            except ValueError:
-                pass
-        
-        if fecha_hasta:
-            try:
-                fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d').date()
-                query = query.filter(Factura.fecha_expedicion <= fecha_hasta_obj)
-            except ValueError:
-                pass
-        
-        facturas = query.order_by(Factura.fecha_creacion.desc()).all()
+        pagina = paginar_desde_request(query, [
+            (Factura.fecha_creacion, True),
+            (Factura.id, True)
+        ])
+        facturas = pagina.items
         
         # Obtener estados únicos de facturas para el filtro
         estados = db.session.query(Factura.estado).distinct().all()
@@ -153,12 +159,54 @@ def facturacion():
     return render_template('facturacion.html', 
                          prefacturas=prefacturas, 
                          facturas=facturas,
+                         pagina=pagina,
                          estados=estados_list,
                          tipo_vista=tipo_vista,
                          estado_filtro=estado_filtro,
                          fecha_desde=fecha_desde,
                          fecha_hasta=fecha_hasta)
 
+@facturacion_bp.route('/facturacion/exportar')
+@login_required
+@not_usuario_required
+def exportar_facturacion():
+    """Exportar a CSV o Excel las prefacturas o facturas del listado con los filtros aplicados"""
+    tipo_vista = request.args.get('tipo_vista', 'pendientes')
+    estado_filtro = request.args.get('estado', '')
+    fecha_desde_obj, fecha_hasta_obj = fechas_filtro_facturacion()
+    
+    if tipo_vista == 'pendientes':
+        prefacturas_union = consulta_prefacturas(estado_filtro, fecha_desde_obj, fecha_hasta_obj)
+        consulta = db.session.query(
+            prefacturas_union.c.tipo, prefacturas_union.c.id, prefacturas_union.c.cliente_nombre,
+            prefacturas_union.c.descripcion, prefacturas_union.c.estado, prefacturas_union.c.fecha,
+            prefacturas_union.c.num_lineas
+        ).order_by(
+            prefacturas_union.c.fecha_orden.desc(), prefacturas_union.c.tipo.desc(), prefacturas_union.c.id.desc()
+        )
+        return respuesta_exportacion(
+            'prefacturas',
+            ['Tipo', 'ID', 'Cliente', 'Descripción', 'Estado', 'Fecha', 'Líneas'],
+            filas_consulta(consulta)
+        )
+    
+    consulta = db.session.query(
+        Factura.serie, Factura.numero, Factura.fecha_expedicion, Factura.nombre, Factura.nif,
+        Factura.importe_total, Factura.estado
+    ).filter(
+        *filtros_facturas_formalizadas(estado_filtro, fecha_desde_obj, fecha_hasta_obj)
+    ).order_by(Factura.fecha_creacion.desc(), Factura.id.desc())
+    
+    def convertir(fila):
+        serie, numero, *resto = fila
+        return (f'{serie}-{numero}', *resto)
+    
+    return respuesta_exportacion(
+        'facturas',
+        ['Serie-Nº', 'Fecha Expedición', 'Cliente', 'NIF', 'Importe Total', 'Estado'],
+        filas_consulta(consulta, convertir)
+    )
+
 @facturacion_bp.route('/facturacion/solicitud/<int:presupuesto_id>')
 @login_required
 @not_usuario_required
@@ -287,11 +335,8 @@ def formalizar_factura_solicitud(presupuesto_id):
             db.session.add(linea_factura)
         
         # Verificar si el envío a Verifactu está activado
-        from models import Configuracion
-        config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-        verifactu_enviar_activo = True  # Por defecto activado
-        if config:
-            verifactu_enviar_activo = config.valor.lower() == 'true'
+        from utils.datos_referencia import configuracion_activa
+        verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
         
         # Enviar a Verifactu solo si está activado y hay token
         verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
@@ -475,11 +520,8 @@ def formalizar_factura(pedido_id):
             db.session.add(linea_factura)
         
         # Verificar si el envío a Verifactu está activado
-        from models import Configuracion
-        config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-        verifactu_enviar_activo = True  # Por defecto activado
-        if config:
-            verifactu_enviar_activo = config.valor.lower() == 'true'
+        from utils.datos_referencia import configuracion_activa
+        verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
         
         # Enviar a Verifactu solo si está activado y hay token
         verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
@@ -779,11 +821,8 @@ def nueva_factura():
                 db.session.add(linea_factura)
             
             # Verificar si el envío a Verifactu está activado
-            from models import Configuracion
-            config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-            verifactu_enviar_activo = True  # Por defecto activado
-            if config:
-                verifactu_enviar_activo = config.valor.lower() == 'true'
+            from utils.datos_referencia import configuracion_activa
+            verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
             
             # Enviar a Verifactu solo si está activado y hay token
             verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
@@ -869,11 +908,10 @@ def nueva_factura():
             import traceback
             traceback.print_exc()
     
-    # GET: mostrar formulario
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    # GET: mostrar formulario (el cliente se elige por autocompletado)
     # Establecer fecha de hoy por defecto
     fecha_hoy = datetime.now().strftime('%Y-%m-%d')
-    return render_template('facturacion/nueva_factura.html', clientes=clientes, fecha_hoy=fecha_hoy)
+    return render_template('facturacion/nueva_factura.html', fecha_hoy=fecha_hoy)
 
 @facturacion_bp.route('/facturacion/nuevo_albaran', methods=['GET', 'POST'])
 @login_required
@@ -1017,6 +1055,7 @@ def nuevo_albaran():
             
             # Crear albarán (factura pendiente de formalizar)
             factura = Factura(
+                tipo_documento=Factura.TIPO_ALBARAN,
                 pedido_id=None,  # Albarán directo sin pedido
                 presupuesto_id=None,  # Albarán directo sin presupuesto
                 serie=serie,
@@ -1061,11 +1100,10 @@ def nuevo_albaran():
             import traceback
             traceback.print_exc()
     
-    # GET: mostrar formulario
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
+    # GET: mostrar formulario (el cliente se elige por autocompletado)
     # Establecer fecha de hoy por defecto
     fecha_hoy = datetime.now().strftime('%Y-%m-%d')
-    return render_template('facturacion/nuevo_albaran.html', clientes=clientes, fecha_hoy=fecha_hoy)
+    return render_template('facturacion/nuevo_albaran.html', fecha_hoy=fecha_hoy)
 
 @facturacion_bp.route('/facturacion/albaran/<int:factura_id>/editar', methods=['GET', 'POST'])
 @login_required
@@ -1074,8 +1112,8 @@ def editar_albaran(factura_id):
     """Editar un albarán existente"""
     factura = Factura.query.get_or_404(factura_id)
     
-    # Verificar que es un albarán (número que empieza con 'A' y contiene '_', estado='pendiente')
-    if not (factura.numero.startswith('A') and '_' in factura.numero and factura.estado == 'pendiente'):
+    # Verificar que es un albarán pendiente de formalizar
+    if not (factura.es_albaran and factura.estado == 'pendiente'):
         flash('Esta factura no es un albarán pendiente de formalizar', 'error')
         return redirect(url_for('facturacion.facturacion', tipo_vista='pendientes'))
     
@@ -1256,9 +1294,7 @@ def editar_albaran(factura_id):
             import traceback
             traceback.print_exc()
     
-    # GET: mostrar formulario con datos del albarán
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    
+    # GET: mostrar formulario con datos del albarán (el cliente se elige por autocompletado)
     # Preparar datos del albarán para el formulario
     fecha_hoy = factura.fecha_expedicion.strftime('%Y-%m-%d') if factura.fecha_expedicion else datetime.now().strftime('%Y-%m-%d')
     
@@ -1287,7 +1323,6 @@ def editar_albaran(factura_id):
     
     return render_template('facturacion/editar_albaran.html', 
                          factura=factura,
-                         clientes=clientes, 
                          fecha_hoy=fecha_hoy,
                          cliente_seleccionado=cliente_seleccionado,
                          datos_cliente=datos_cliente)
@@ -1362,13 +1397,8 @@ def preparar_datos_imprimir_factura(factura_id):
     logo_path = os.path.join(current_app.static_folder, 'logo1.png')
     logo_base64 = convertir_imagen_a_base64(logo_path)
     
-    # Detectar si es un albarán: número que empieza con 'A' seguido de año y mes (formato A2601_XXX)
-    # y estado='pendiente' (aún no formalizado)
-    es_albaran = (factura.numero.startswith('A') and 
-                  '_' in factura.numero and 
-                  factura.estado == 'pendiente' and
-                  factura.presupuesto_id is None and
-                  factura.pedido_id is None)
+    # Detectar si es un albarán pendiente (aún no formalizado)
+    es_albaran = factura.es_albaran and factura.estado == 'pendiente'
     
     return {
         'factura': factura,
@@ -1485,6 +1515,7 @@ def descargar_pdf_factura(factura_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -1560,6 +1591,7 @@ def descargar_pdf_albaran_factura(factura_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -1636,6 +1668,7 @@ def descargar_pdf_albaran_pedido(pedido_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -1683,15 +1716,10 @@ def facturar_albaranes():
         cliente = Cliente.query.get_or_404(cliente_id)
         
         # Obtener albaranes pendientes del cliente (por NIF)
-        from sqlalchemy import and_
         albaranes = Factura.query.filter(
-            and_(
-                Factura.estado == 'pendiente',
-                Factura.presupuesto_id.is_(None),
-                Factura.pedido_id.is_(None),
-                Factura.numero.like('A%_%'),
-                Factura.nif == cliente.nif
-            )
+            Factura.tipo_documento == Factura.TIPO_ALBARAN,
+            Factura.estado == 'pendiente',
+            Factura.nif == cliente.nif
         ).order_by(Factura.fecha_expedicion.asc()).all()
         
         if not albaranes:
@@ -1742,8 +1770,8 @@ def procesar_facturacion_albaranes():
         # Obtener albaranes seleccionados
         albaranes = Factura.query.filter(
             Factura.id.in_([int(id) for id in albaranes_ids]),
-            Factura.estado == 'pendiente',
-            Factura.numero.like('A%_%')
+            Factura.tipo_documento == Factura.TIPO_ALBARAN,
+            Factura.estado == 'pendiente'
         ).all()
         
         if not albaranes:
@@ -1842,11 +1870,8 @@ def procesar_facturacion_albaranes():
             albaran.estado = 'confirmado'
         
         # Verificar si el envío a Verifactu está activado
-        from models import Configuracion
-        config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-        verifactu_enviar_activo = True
-        if config:
-            verifactu_enviar_activo = config.valor.lower() == 'true'
+        from utils.datos_referencia import configuracion_activa
+        verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
         
         # Enviar a Verifactu solo si está activado y hay token
         verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
@@ -5,7 +5,9 @@ from datetime import datetime
 from decimal import Decimal
 from extensions import db
 from models import Proveedor, FacturaProveedor, Empleado, Nomina
+from sqlalchemy.orm import joinedload, raiseload
 from utils.auth import not_usuario_required
+from utils.paginacion import paginar_desde_request
 
 gastos_bp = Blueprint('gastos', __name__)
 
@@ -16,8 +18,8 @@ gastos_bp = Blueprint('gastos', __name__)
 @not_usuario_required
 def listado_proveedores():
     """Listado de proveedores"""
-    proveedores = Proveedor.query.order_by(Proveedor.nombre).all()
-    return render_template('gastos/listado_proveedores.html', proveedores=proveedores)
+    pagina = paginar_desde_request(Proveedor.query.options(raiseload('*')), [(Proveedor.nombre, False), (Proveedor.id, False)])
+    return render_template('gastos/listado_proveedores.html', proveedores=pagina.items, pagina=pagina)
 
 @gastos_bp.route('/gastos/proveedores/nuevo', methods=['GET', 'POST'])
 @login_required
@@ -113,7 +115,7 @@ def toggle_proveedor(proveedor_id):
 @not_usuario_required
 def listado_facturas_proveedor():
     """Listado de facturas de proveedor"""
-    query = FacturaProveedor.query
+    query = FacturaProveedor.query.options(joinedload(FacturaProveedor.proveedor), raiseload('*'))
     
     # Filtro por estado
     estado_filtro = request.args.get('estado', '')
@@ -138,7 +140,11 @@ def listado_facturas_proveedor():
         except ValueError:
             pass
     
-    facturas = query.order_by(FacturaProveedor.fecha_factura.desc()).all()
+    pagina = paginar_desde_request(query, [
+        (FacturaProveedor.fecha_factura, True),
+        (FacturaProveedor.id, True)
+    ])
+    facturas = pagina.items
     
     # Obtener estados únicos para el filtro
     estados = db.session.query(FacturaProveedor.estado).distinct().all()
@@ -146,6 +152,7 @@ def listado_facturas_proveedor():
     
     return render_template('gastos/listado_facturas_proveedor.html', 
                          facturas=facturas,
+                         pagina=pagina,
                          estados=estados_list,
                          estado_filtro=estado_filtro,
                          fecha_desde=fecha_desde,
@@ -357,7 +364,7 @@ def eliminar_empleado(empleado_id):
 @not_usuario_required
 def listado_nominas():
     """Listado de nóminas"""
-    query = Nomina.query
+    query = Nomina.query.options(joinedload(Nomina.empleado), raiseload('*'))
     
     # Filtro por fecha desde (año-mes)
     año_desde = request.args.get('año_desde', '')
@@ -399,7 +406,12 @@ def listado_nominas():
         except ValueError:
             pass
     
-    nominas = query.order_by(Nomina.año.desc(), Nomina.mes.desc()).all()
+    pagina = paginar_desde_request(query, [
+        (Nomina.año, True),
+        (Nomina.mes, True),
+        (Nomina.id, True)
+    ])
+    nominas = pagina.items
     
     # Obtener años únicos para el filtro
     años = db.session.query(Nomina.año).distinct().order_by(Nomina.año.desc()).all()
@@ -407,6 +419,7 @@ def listado_nominas():
     
     return render_template('gastos/listado_nominas.html', 
                          nominas=nominas,
+                         pagina=pagina,
                          años=años_list,
                          año_desde=año_desde,
                          mes_desde=mes_desde,
@@ -1,11 +1,232 @@
 """Rutas para el panel de control (index)"""
-from flask import Blueprint, render_template, flash, request
+from flask import Blueprint, render_template, flash, request, jsonify, Response, stream_with_context
 from flask_login import login_required
 from datetime import datetime, timedelta
-from models import Presupuesto
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session, joinedload
+import json
+import os
+import threading
+import time
+from extensions import db
+from models import Cliente, Presupuesto, RegistroEstadoSolicitud, Usuario
+from utils.auth import supervisor_required
+from utils.cache import CacheVersionada, VERSION_PANEL_SOLICITUDES, incrementar_version, obtener_estadisticas
 
 index_bp = Blueprint('index', __name__)
 
+# Estados que se muestran en el panel: desde aceptado hasta entregado al cliente
+ESTADOS_PANEL = ['aceptado', 'mockup', 'en preparacion', 'revision y empaquetado', 'entregado al cliente']
+
+# Filtros válidos del panel (cualquier otro valor muestra todas las solicitudes)
+FILTROS_PANEL = ['solo_mockup', 'solo_en_preparacion']
+
+# Caché de las solicitudes del panel por filtro y día (se invalida al cambiar una solicitud
+# o uno de los nombres que copia _snapshot_solicitud)
+cache_panel = CacheVersionada('panel_solicitudes', VERSION_PANEL_SOLICITUDES)
+
+# Atributos de otros modelos que se copian en las tarjetas del panel
+ATRIBUTOS_PANEL = {
+    Cliente: 'nombre',
+    Usuario: 'usuario',
+}
+
+# Configuración del canal de cambios en vivo del panel
+# Cada conexión SSE o long-poll ocupa un hilo de gunicorn mientras espera, así que se limita
+# el número de esperas simultáneas por worker; el resto de pantallas sondean sin esperar.
+PANEL_MAX_ESPERAS = int(os.environ.get('PANEL_MAX_ESPERAS', 1))
+PANEL_DURACION_STREAM = int(os.environ.get('PANEL_DURACION_STREAM', 25))  # Segundos por conexión SSE
+PANEL_INTERVALO_SONDEO = float(os.environ.get('PANEL_INTERVALO_SONDEO', 2))  # Segundos entre comprobaciones
+PANEL_LIMITE_REGISTROS = 200  # Registros de estado procesados como máximo por lote
+_esperas_panel = threading.BoundedSemaphore(max(PANEL_MAX_ESPERAS, 1))
+
+def _clasificar_fecha_objetivo(solicitud, hoy):
+    """Clase CSS del panel según los días que faltan para la fecha objetivo más próxima"""
+    # Clasificar según la fecha objetivo más próxima (17 días)
+    if solicitud.fecha_objetivo_17:
+        # Calcular días restantes hasta la fecha objetivo de 17 días
+        dias_restantes = (solicitud.fecha_objetivo_17 - hoy).days
+    elif solicitud.fecha_objetivo_25:
+        # Si solo tiene la de 25 días, usar esa
+        dias_restantes = (solicitud.fecha_objetivo_25 - hoy).days
+    else:
+        return ''
+
+    # Clasificar fecha objetivo según días restantes
+    if dias_restantes <= 5:
+        # 5 días o menos (incluye vencidos): Rojo
+        return 'urgente'
+    elif dias_restantes <= 10:
+        # Entre 6 y 10 días: Naranja
+        return 'proxima'
+    # Más de 10 días: Verde
+    return 'ok'
+
+def _clave_orden(solicitud):
+    """Clave de ordenación del panel: fecha objetivo más próxima (17 días primero, luego 25), después fecha de aceptación"""
+    return (
+        solicitud.fecha_objetivo_17 if solicitud.fecha_objetivo_17 else (solicitud.fecha_objetivo_25 if solicitud.fecha_objetivo_25 else datetime.max.date()),
+        solicitud.fecha_aceptado if solicitud.fecha_aceptado else datetime.max.date()
+    )
+
+def _snapshot_solicitud(solicitud, hoy):
+    """Copia de los datos de una solicitud que muestra el panel de control (independiente de la sesión)"""
+    fecha_objetivo, fecha_aceptado = _clave_orden(solicitud)
+    return {
+        'id': solicitud.id,
+        'numero_solicitud': solicitud.numero_solicitud,
+        'tipo_pedido': solicitud.tipo_pedido,
+        'estado': solicitud.estado,
+        'subestado': solicitud.subestado,
+        'fecha_aceptado': solicitud.fecha_aceptado,
+        'fecha_objetivo_25': solicitud.fecha_objetivo_25,
+        'fecha_objetivo_17': solicitud.fecha_objetivo_17,
+        'fecha_limite_mockup': solicitud.fecha_limite_mockup,
+        'fecha_class': _clasificar_fecha_objetivo(solicitud, hoy),
+        # Misma ordenación que el listado, como texto para poder reordenar las tarjetas en el navegador
+        'orden': f'{fecha_objetivo.isoformat()}|{fecha_aceptado.isoformat()}|{solicitud.id:010d}',
+        'cliente': {'nombre': solicitud.cliente.nombre} if solicitud.cliente else None,
+        'mockup_encargado_a': {'usuario': solicitud.mockup_encargado_a.usuario} if solicitud.mockup_encargado_a else None,
+        'marcada_encargado_a': {'usuario': solicitud.marcada_encargado_a.usuario} if solicitud.marcada_encargado_a else None
+    }
+
+def _cambia_panel(obj):
+    atributo = ATRIBUTOS_PANEL.get(type(obj))
+    return atributo is not None and inspect(obj).attrs[atributo].history.has_changes()
+
+def _antes_de_flush(session, contexto, instancias):
+    # Renombrar o borrar un cliente o un usuario cambia las tarjetas sin tocar ninguna solicitud
+    if (any(type(obj) in ATRIBUTOS_PANEL for obj in session.deleted)
+            or any(_cambia_panel(obj) for obj in session.dirty)):
+        incrementar_version(VERSION_PANEL_SOLICITUDES, session.connection())
+
+def init_cache_panel():
+    """Registrar el evento que invalida la caché del panel al renombrar clientes o usuarios"""
+    if not event.contains(Session, 'before_flush', _antes_de_flush):
+        event.listen(Session, 'before_flush', _antes_de_flush)
+
+def _visible_en_panel(solicitud, filtro_activo):
+    """Indica si una solicitud aparece en el panel con el filtro indicado"""
+    if solicitud.estado not in ESTADOS_PANEL:
+        return False
+    if filtro_activo == 'solo_mockup':
+        return solicitud.estado == 'mockup'
+    if filtro_activo == 'solo_en_preparacion':
+        return solicitud.estado == 'en preparacion'
+    return True
+
+def obtener_cursor_panel():
+    """Último id de RegistroEstadoSolicitud (posición actual del canal de cambios)"""
+    return db.session.query(func.max(RegistroEstadoSolicitud.id)).scalar() or 0
+
+def cargar_solicitudes_panel(filtro_activo, hoy):
+    """Consultar, clasificar y ordenar las solicitudes del panel (solo aceptadas hasta entregadas)"""
+    # Obtener solicitudes con estado entre "aceptado" y "entregado al cliente"
+    query = Presupuesto.query.filter(
+        Presupuesto.estado.in_(ESTADOS_PANEL)
+    )
+
+    # Aplicar filtro si está seleccionado
+    if filtro_activo == 'solo_mockup':
+        query = query.filter(Presupuesto.estado == 'mockup')
+    elif filtro_activo == 'solo_en_preparacion':
+        query = query.filter(Presupuesto.estado == 'en preparacion')
+
+    solicitudes = query.options(
+        joinedload(Presupuesto.cliente),
+        joinedload(Presupuesto.mockup_encargado_a),
+        joinedload(Presupuesto.marcada_encargado_a)
+    ).all()
+
+    # Calcular fechas objetivo de entrega (25 y 17 días desde aceptación del mockup)
+    necesita_commit = False
+
+    for solicitud in solicitudes:
+        # Las fechas objetivo se calculan cuando se acepta el mockup (subestado "aceptado" del estado "mockup")
+        # Este código solo es un fallback para solicitudes antiguas que ya tenían fecha_aceptado pero no fechas objetivo
+        # Solo calcular si el mockup ya fue aceptado (tiene fecha_aceptado) pero no tiene fechas objetivo
+        if solicitud.fecha_aceptado and not solicitud.fecha_objetivo_25 and not solicitud.fecha_objetivo_17:
+            # Verificar que realmente pasó por mockup y fue aceptado
+            # Solo calcular como fallback si no tiene fechas objetivo
+            from utils.fechas import calcular_fecha_saltando_festivos
+            if not solicitud.fecha_objetivo_25:
+                solicitud.fecha_objetivo_25 = calcular_fecha_saltando_festivos(solicitud.fecha_aceptado, 25)
+                necesita_commit = True
+            if not solicitud.fecha_objetivo_17:
+                solicitud.fecha_objetivo_17 = calcular_fecha_saltando_festivos(solicitud.fecha_aceptado, 17)
+                necesita_commit = True
+
+    # Ordenar por fecha objetivo más próxima (17 días primero, luego 25), los que no tienen fecha objetivo al final
+    solicitudes.sort(key=_clave_orden)
+
+    # Copiar los datos antes del commit (el commit expira los objetos de la sesión)
+    resultado = tuple(_snapshot_solicitud(s, hoy) for s in solicitudes)
+
+    # Guardar cambios si se calcularon fechas objetivo
+    if necesita_commit:
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al guardar fechas objetivo: {e}")
+
+    return resultado
+
+def obtener_cambios_panel(cursor, filtro_activo, hoy):
+    """
+    Solicitudes del panel que han cambiado desde el cursor indicado
+
+    Args:
+        cursor: último id de RegistroEstadoSolicitud que ya tiene el cliente
+        filtro_activo: filtro del panel del cliente
+        hoy: fecha usada para clasificar las fechas objetivo
+
+    Returns:
+        dict con el nuevo cursor, las tarjetas a insertar/reemplazar y los ids a quitar,
+        o None si no hay cambios
+    """
+    registros = db.session.query(
+        RegistroEstadoSolicitud.id,
+        RegistroEstadoSolicitud.presupuesto_id
+    ).filter(
+        RegistroEstadoSolicitud.id > cursor
+    ).order_by(RegistroEstadoSolicitud.id).limit(PANEL_LIMITE_REGISTROS).all()
+
+    if not registros:
+        return None
+
+    ids_cambiados = {registro.presupuesto_id for registro in registros}
+    solicitudes = Presupuesto.query.options(
+        joinedload(Presupuesto.cliente),
+        joinedload(Presupuesto.mockup_encargado_a),
+        joinedload(Presupuesto.marcada_encargado_a)
+    ).filter(Presupuesto.id.in_(ids_cambiados)).all()
+
+    actualizadas = []
+    for solicitud in solicitudes:
+        if _visible_en_panel(solicitud, filtro_activo):
+            datos = _snapshot_solicitud(solicitud, hoy)
+            actualizadas.append({
+                'id': datos['id'],
+                'orden': datos['orden'],
+                'html': render_template('panel/tarjeta_solicitud.html', solicitud=datos, hoy=hoy)
+            })
+    ids_visibles = {item['id'] for item in actualizadas}
+
+    return {
+        'cursor': registros[-1].id,
+        'actualizadas': actualizadas,
+        'eliminadas': sorted(ids_cambiados - ids_visibles)
+    }
+
+def _leer_cursor():
+    """Cursor del cliente: cabecera Last-Event-ID (reconexión SSE) o parámetro cursor"""
+    valor = request.headers.get('Last-Event-ID') or request.args.get('cursor', '')
+    try:
+        return max(int(valor), 0)
+    except (TypeError, ValueError):
+        return None
+
 @index_bp.route('/')
 @login_required
 def index():
@@ -13,93 +234,19 @@ def index():
     try:
         # Obtener filtro de la URL
         filtro_activo = request.args.get('filtro', '')
-        
-        # Obtener solicitudes con estado entre "aceptado" y "entregado al cliente"
-        from sqlalchemy.orm import joinedload
-        from models import LineaPresupuesto
-        from sqlalchemy import or_
-        
-        # Estados que se muestran en el panel: desde aceptado hasta entregado al cliente
-        estados_mostrar = ['aceptado', 'mockup', 'en preparacion', 'revision y empaquetado', 'entregado al cliente']
-        
-        query = Presupuesto.query.filter(
-            Presupuesto.estado.in_(estados_mostrar)
-        )
-        
-        # Aplicar filtro si está seleccionado
-        if filtro_activo == 'solo_mockup':
-            query = query.filter(Presupuesto.estado == 'mockup')
-        elif filtro_activo == 'solo_en_preparacion':
-            query = query.filter(Presupuesto.estado == 'en preparacion')
-        
-        solicitudes = query.options(
-            joinedload(Presupuesto.cliente),
-            joinedload(Presupuesto.mockup_encargado_a),
-            joinedload(Presupuesto.marcada_encargado_a)
-        ).all()
-        
-        # Calcular fechas objetivo de entrega (25 y 17 días desde aceptación del mockup) y clasificar
+        filtro_clave = filtro_activo if filtro_activo in FILTROS_PANEL else ''
+
+        # Leer el cursor antes que los datos: un cambio intermedio se vuelve a enviar, nunca se pierde
+        cursor_panel = obtener_cursor_panel()
+
+        # La clasificación por colores depende del día, así que forma parte de la clave
         hoy = datetime.now().date()
-        from extensions import db
-        necesita_commit = False
-        
-        for solicitud in solicitudes:
-            # Las fechas objetivo se calculan cuando se acepta el mockup (subestado "aceptado" del estado "mockup")
-            # Este código solo es un fallback para solicitudes antiguas que ya tenían fecha_aceptado pero no fechas objetivo
-            # Solo calcular si el mockup ya fue aceptado (tiene fecha_aceptado) pero no tiene fechas objetivo
-            if solicitud.fecha_aceptado and not solicitud.fecha_objetivo_25 and not solicitud.fecha_objetivo_17:
-                # Verificar que realmente pasó por mockup y fue aceptado
-                # Solo calcular como fallback si no tiene fechas objetivo
-                from utils.fechas import calcular_fecha_saltando_festivos
-                if not solicitud.fecha_objetivo_25:
-                    solicitud.fecha_objetivo_25 = calcular_fecha_saltando_festivos(solicitud.fecha_aceptado, 25)
-                    necesita_commit = True
-                if not solicitud.fecha_objetivo_17:
-                    solicitud.fecha_objetivo_17 = calcular_fecha_saltando_festivos(solicitud.fecha_aceptado, 17)
-                    necesita_commit = True
-            
-            # Clasificar según la fecha objetivo más próxima (17 días)
-            if solicitud.fecha_objetivo_17:
-                # Calcular días restantes hasta la fecha objetivo de 17 días
-                dias_restantes = (solicitud.fecha_objetivo_17 - hoy).days
-                
-                # Clasificar fecha objetivo según días restantes
-                if dias_restantes <= 5:
-                    # 5 días o menos (incluye vencidos): Rojo
-                    solicitud.fecha_class = 'urgente'
-                elif dias_restantes <= 10:
-                    # Entre 6 y 10 días: Naranja
-                    solicitud.fecha_class = 'proxima'
-                else:
-                    # Más de 10 días: Verde
-                    solicitud.fecha_class = 'ok'
-            elif solicitud.fecha_objetivo_25:
-                # Si solo tiene la de 25 días, usar esa
-                dias_restantes = (solicitud.fecha_objetivo_25 - hoy).days
-                if dias_restantes <= 5:
-                    solicitud.fecha_class = 'urgente'
-                elif dias_restantes <= 10:
-                    solicitud.fecha_class = 'proxima'
-                else:
-                    solicitud.fecha_class = 'ok'
-            else:
-                solicitud.fecha_class = ''
-        
-        # Guardar cambios si se calcularon fechas objetivo
-        if necesita_commit:
-            try:
-                db.session.commit()
-            except Exception as e:
-                db.session.rollback()
-                print(f"Error al guardar fechas objetivo: {e}")
-        
-        # Ordenar por fecha objetivo más próxima (17 días primero, luego 25), los que no tienen fecha objetivo al final
-        solicitudes.sort(key=lambda s: (
-            s.fecha_objetivo_17 if s.fecha_objetivo_17 else (s.fecha_objetivo_25 if s.fecha_objetivo_25 else datetime.max.date()),
-            s.fecha_aceptado if s.fecha_aceptado else datetime.max.date()
-        ))
-        
-        return render_template('index.html', solicitudes=solicitudes, hoy=hoy, filtro_activo=filtro_activo)
+        solicitudes = cache_panel.obtener(
+            (filtro_clave, hoy),
+            lambda: cargar_solicitudes_panel(filtro_clave, hoy)
+        )
+
+        return render_template('index.html', solicitudes=solicitudes, hoy=hoy, filtro_activo=filtro_activo, cursor_panel=cursor_panel)
     except Exception as e:
         import traceback
         error_msg = f"Error en index: {str(e)}\n{traceback.format_exc()}"
@@ -107,5 +254,79 @@ def index():
         flash(f'Error al cargar el panel de control: {str(e)}', 'error')
         hoy = datetime.now().date()
         filtro_activo = request.args.get('filtro', '')
-        return render_template('index.html', solicitudes=[], hoy=hoy, filtro_activo=filtro_activo)
+        return render_template('index.html', solicitudes=[], hoy=hoy, filtro_activo=filtro_activo, cursor_panel=None)
 
+@index_bp.route('/panel/cambios')
+@login_required
+def cambios_panel():
+    """Long-poll de cambios del panel: espera hasta 'espera' segundos a que haya cambios desde el cursor"""
+    cursor = _leer_cursor()
+    if cursor is None:
+        return jsonify({'error': 'Cursor no válido'}), 400
+    filtro_activo = request.args.get('filtro', '')
+    try:
+        espera = min(max(float(request.args.get('espera', 0)), 0), PANEL_DURACION_STREAM)
+    except ValueError:
+        espera = 0
+
+    # Si no quedan huecos de espera en este worker, responder sin esperar
+    esperando = espera > 0 and _esperas_panel.acquire(blocking=False)
+    try:
+        limite = time.monotonic() + (espera if esperando else 0)
+        while True:
+            cambios = obtener_cambios_panel(cursor, filtro_activo, datetime.now().date())
+            if cambios or time.monotonic() >= limite:
+                break
+            # Devolver la conexión al pool mientras se espera
+            db.session.close()
+            time.sleep(PANEL_INTERVALO_SONDEO)
+    finally:
+        if esperando:
+            _esperas_panel.release()
+
+    if not cambios:
+        cambios = {'cursor': cursor, 'actualizadas': [], 'eliminadas': []}
+    cambios['espero'] = bool(esperando)
+    return jsonify(cambios)
+
+@index_bp.route('/panel/cambios/stream')
+@login_required
+def stream_cambios_panel():
+    """Canal Server-Sent Events con los cambios del panel (el navegador reconecta con Last-Event-ID)"""
+    cursor = _leer_cursor()
+    if cursor is None:
+        return jsonify({'error': 'Cursor no válido'}), 400
+    filtro_activo = request.args.get('filtro', '')
+
+    # Sin hueco libre: 204 hace que EventSource no reconecte y el panel pase a sondeo
+    if not _esperas_panel.acquire(blocking=False):
+        return '', 204
+
+    def generar():
+        cursor_actual = cursor
+        yield f'retry: {int(PANEL_INTERVALO_SONDEO * 1000)}\n\n'
+        limite = time.monotonic() + PANEL_DURACION_STREAM
+        while time.monotonic() < limite:
+            cambios = obtener_cambios_panel(cursor_actual, filtro_activo, datetime.now().date())
+            db.session.close()
+            if cambios:
+                cursor_actual = cambios['cursor']
+                yield f"id: {cursor_actual}\nevent: cambios\ndata: {json.dumps(cambios)}\n\n"
+            else:
+                # Comentario SSE: mantiene viva la conexión y detecta clientes desconectados
+                yield ': ping\n\n'
+            time.sleep(PANEL_INTERVALO_SONDEO)
+
+    response = Response(stream_with_context(generar()), mimetype='text/event-stream')
+    # Liberar el hueco al cerrar la respuesta (también si el cliente se desconecta antes de empezar)
+    response.call_on_close(_esperas_panel.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@index_bp.route('/panel/estadisticas-cache')
+@login_required
+@supervisor_required
+def estadisticas_cache():
+    """Estadísticas de aciertos/fallos de las cachés de este worker"""
+    return jsonify(obtener_estadisticas())
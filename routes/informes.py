@@ -1,15 +1,150 @@
 """Rutas para informes y reportes"""
 from flask import Blueprint, render_template, request, jsonify
 from flask_login import login_required
-from datetime import datetime
+from werkzeug.utils import secure_filename
+from datetime import datetime, date
 from decimal import Decimal
+from itertools import chain
 from extensions import db
-from models import Factura, FacturaProveedor, Nomina, Empleado, LineaFactura
-from sqlalchemy import func, extract
+from models import Factura, FacturaProveedor, Nomina, Empleado, LineaFactura, Proveedor
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from utils.auth import not_usuario_required
+from utils.paginacion import paginar_desde_request
+from utils.fechas import MESES
+from utils.resumen_mensual import obtener_resumen, TIPO_IVA, CENTIMOS
+from utils.exportacion import respuesta_exportacion, filas_consulta
 
 informes_bp = Blueprint('informes', __name__)
 
+
+def _periodo_desde_request():
+    """
+    Leer los filtros tipo/año/periodo de la petición
+
+    Devuelve (tipo_filtro, año, periodo, desde, hasta, periodo_label) con el rango de
+    fechas [desde, hasta). Los informes filtran con fecha >= desde AND fecha < hasta,
+    que puede usar el índice de la columna (extract('year', ...) no puede). Los
+    periodos son siempre meses completos, así que los totales salen de resumen_mensual.
+    """
+    tipo_filtro = request.args.get('tipo', 'mes')  # 'mes' o 'trimestre'
+    año = request.args.get('año', datetime.now().year, type=int)
+    periodo = request.args.get('periodo', None, type=int)
+
+    if tipo_filtro == 'mes' and periodo and 1 <= periodo <= 12:
+        desde = date(año, periodo, 1)
+        hasta = date(año + 1, 1, 1) if periodo == 12 else date(año, periodo + 1, 1)
+        periodo_label = f"{MESES[periodo]} {año}"
+    elif tipo_filtro == 'trimestre' and periodo and 1 <= periodo <= 4:
+        mes_inicio = (periodo - 1) * 3 + 1
+        desde = date(año, mes_inicio, 1)
+        hasta = date(año + 1, 1, 1) if periodo == 4 else date(año, mes_inicio + 3, 1)
+        periodo_label = f"{periodo}T {año}"
+    else:
+        desde = date(año, 1, 1)
+        hasta = date(año + 1, 1, 1)
+        periodo_label = f"Año {año}"
+
+    return tipo_filtro, año, periodo, desde, hasta, periodo_label
+
+
+def _centimos(columna):
+    """
+    Importe redondeado a céntimos en SQL
+
+    SQLite guarda los Numeric como REAL y algunos importes tienen más decimales; al
+    leerlos el ORM los redondea a 2, así que se suman ya redondeados para obtener los
+    mismos totales que sumando fila a fila.
+    """
+    return func.round(columna, 2)
+
+
+def _a_decimal(valor):
+    """Convertir una suma de SQL (REAL en SQLite) a Decimal en céntimos"""
+    return Decimal(str(valor or 0)).quantize(CENTIMOS)
+
+
+def _filtro_facturas(desde, hasta):
+    return (Factura.fecha_expedicion >= desde, Factura.fecha_expedicion < hasta)
+
+
+def _filtro_facturas_proveedor(desde, hasta):
+    return (FacturaProveedor.fecha_factura >= desde, FacturaProveedor.fecha_factura < hasta)
+
+
+def _consulta_filas_facturas(desde, hasta):
+    """
+    Filas del listado de facturas emitidas: solo las columnas mostradas y la suma de
+    importes de sus líneas (subconsulta por factura, que usa el índice de factura_id)
+    """
+    importe_lineas = db.session.query(
+        func.coalesce(func.sum(_centimos(LineaFactura.importe)), 0)
+    ).filter(LineaFactura.factura_id == Factura.id).correlate(Factura).scalar_subquery()
+    return db.session.query(
+        Factura.id, Factura.serie, Factura.numero, Factura.fecha_expedicion, Factura.nif,
+        Factura.nombre, Factura.importe_total, importe_lineas.label('importe_lineas')
+    ).filter(*_filtro_facturas(desde, hasta))
+
+
+def _base_e_iva(importe_lineas):
+    """Base imponible e IVA de un importe de líneas con el IVA incluido"""
+    base = _a_decimal(importe_lineas) / (Decimal('1') + TIPO_IVA / Decimal('100'))
+    return base, base * TIPO_IVA / Decimal('100')
+
+
+def _desglose_iva(filas):
+    """Añadir a cada fila la base imponible y el IVA de sus líneas (importes con IVA incluido)"""
+    resultado = []
+    for fila in filas:
+        datos = fila._asdict()
+        datos['base_imponible'], datos['iva'] = _base_e_iva(fila.importe_lineas)
+        resultado.append(datos)
+    return resultado
+
+
+def _fila_exportacion_factura(fila):
+    base, iva = _base_e_iva(fila.importe_lineas)
+    return (f'{fila.serie}-{fila.numero}', fila.fecha_expedicion, fila.nombre, fila.nif,
+            fila.importe_total, base.quantize(CENTIMOS), iva.quantize(CENTIMOS))
+
+
+def _fila_exportacion_factura_proveedor(fila):
+    return (fila.numero_factura, fila.fecha_factura, fila.proveedor_nombre, fila.base_imponible,
+            fila.tipo_iva, fila.importe_iva, fila.total, fila.estado)
+
+
+COLUMNAS_EXPORTACION_FACTURAS = ['Número', 'Fecha', 'Cliente', 'NIF', 'Importe Total', 'Base Imponible', 'IVA']
+COLUMNAS_EXPORTACION_FACTURAS_PROVEEDOR = ['Número Factura', 'Fecha', 'Proveedor', 'Base Imponible',
+                                           'Tipo IVA', 'IVA', 'Total', 'Estado']
+
+
+def _filtros_nominas():
+    """Filtros año/empleado de los informes de nóminas: (filtros, año, empleado_id)"""
+    empleado_id = request.args.get('empleado_id', None, type=int)
+    año = request.args.get('año', datetime.now().year, type=int)
+    
+    filtros = [Nomina.año == año]
+    if empleado_id:
+        filtros.append(Nomina.empleado_id == empleado_id)
+    return filtros, año, empleado_id
+
+
+def _nombre_exportacion(nombre, periodo_label):
+    """Nombre de fichero con el periodo (p. ej. facturacion_emitida_1T_2025)"""
+    return f"{nombre}_{secure_filename(periodo_label)}"
+
+
+def _consulta_filas_facturas_proveedor(desde, hasta):
+    """Filas del listado de facturas de proveedor con el nombre del proveedor en la misma consulta"""
+    return db.session.query(
+        FacturaProveedor.id, FacturaProveedor.numero_factura, FacturaProveedor.fecha_factura,
+        FacturaProveedor.base_imponible, FacturaProveedor.tipo_iva, FacturaProveedor.importe_iva,
+        FacturaProveedor.total, FacturaProveedor.estado, Proveedor.nombre.label('proveedor_nombre')
+    ).outerjoin(Proveedor, FacturaProveedor.proveedor_id == Proveedor.id).filter(
+        *_filtro_facturas_proveedor(desde, hasta)
+    )
+
+
 @informes_bp.route('/informes')
 @login_required
 @not_usuario_required
@@ -22,48 +157,21 @@ def index():
 @not_usuario_required
 def facturacion_emitida():
     """Informe de facturación emitida con filtros por mes o trimestre"""
-    # Obtener parámetros de filtro
-    tipo_filtro = request.args.get('tipo', 'mes')  # 'mes' o 'trimestre'
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    # Base query
-    query = Factura.query.filter(extract('year', Factura.fecha_expedicion) == año)
+    # Totales del periodo desde el resumen mensual
+    resumen = obtener_resumen(desde, hasta)
     
-    if tipo_filtro == 'mes' and periodo:
-        query = query.filter(extract('month', Factura.fecha_expedicion) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query = query.filter(extract('month', Factura.fecha_expedicion).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
-    
-    facturas = query.order_by(Factura.fecha_expedicion.desc()).all()
-    
-    # Calcular totales
-    total_facturacion = sum(f.importe_total for f in facturas)
-    total_iva_repercutido = Decimal('0')
-    tipo_iva = Decimal('21')  # IVA estándar al 21%
-    
-    # Calcular IVA repercutido desde las líneas de factura
-    # Asumimos que el importe incluye IVA al 21%
-    for factura in facturas:
-        for linea in factura.lineas:
-            importe_con_iva = Decimal(str(linea.importe))
-            # Calcular base imponible: importe / (1 + tipo_iva/100)
-            base_imponible = importe_con_iva / (Decimal('1') + tipo_iva / Decimal('100'))
-            # Calcular IVA repercutido: base_imponible * (tipo_iva/100)
-            iva_linea = base_imponible * tipo_iva / Decimal('100')
-            total_iva_repercutido += iva_linea.quantize(Decimal('0.01'))
+    # Listado paginado: solo se leen las filas que se muestran
+    consulta = _consulta_filas_facturas(desde, hasta)
+    pagina = paginar_desde_request(consulta, [(Factura.fecha_expedicion, True), (Factura.id, True)])
     
     return render_template('informes/facturacion_emitida.html', 
-                         facturas=facturas,
-                         total_facturacion=total_facturacion,
-                         total_iva_repercutido=total_iva_repercutido,
+                         facturas=_desglose_iva(pagina.items),
+                         pagina=pagina,
+                         num_facturas=resumen['num_facturas_emitidas'],
+                         total_facturacion=resumen['total_emitido'],
+                         total_iva_repercutido=resumen['cuota_iva_repercutida'],
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
@@ -74,38 +182,22 @@ def facturacion_emitida():
 @not_usuario_required
 def facturacion_soportada():
     """Informe de facturación soportada (facturas de proveedor) con filtros por mes o trimestre"""
-    # Obtener parámetros de filtro
-    tipo_filtro = request.args.get('tipo', 'mes')  # 'mes' o 'trimestre'
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    # Base query
-    query = FacturaProveedor.query.filter(extract('year', FacturaProveedor.fecha_factura) == año)
+    # Totales del periodo desde el resumen mensual
+    resumen = obtener_resumen(desde, hasta)
     
-    if tipo_filtro == 'mes' and periodo:
-        query = query.filter(extract('month', FacturaProveedor.fecha_factura) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query = query.filter(extract('month', FacturaProveedor.fecha_factura).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
-    
-    facturas = query.order_by(FacturaProveedor.fecha_factura.desc()).all()
-    
-    # Calcular totales
-    total_facturacion = sum(f.total for f in facturas)
-    total_base_imponible = sum(f.base_imponible for f in facturas)
-    total_iva_soportado = sum(f.importe_iva for f in facturas)
+    # Listado paginado: solo se leen las filas que se muestran
+    consulta = _consulta_filas_facturas_proveedor(desde, hasta)
+    pagina = paginar_desde_request(consulta, [(FacturaProveedor.fecha_factura, True), (FacturaProveedor.id, True)])
     
     return render_template('informes/facturacion_soportada.html',
-                         facturas=facturas,
-                         total_facturacion=total_facturacion,
-                         total_base_imponible=total_base_imponible,
-                         total_iva_soportado=total_iva_soportado,
+                         facturas=pagina.items,
+                         pagina=pagina,
+                         num_facturas=resumen['num_facturas_proveedor'],
+                         total_facturacion=resumen['total_soportado'],
+                         total_base_imponible=resumen['base_soportada'],
+                         total_iva_soportado=resumen['cuota_iva_soportada'],
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
@@ -116,28 +208,25 @@ def facturacion_soportada():
 @not_usuario_required
 def nominas():
     """Informe de nóminas por empleado y global"""
-    # Obtener parámetros de filtro
-    empleado_id = request.args.get('empleado_id', None, type=int)
-    año = request.args.get('año', datetime.now().year, type=int)
-    
-    # Base query
-    query = Nomina.query.filter(Nomina.año == año)
-    
-    if empleado_id:
-        query = query.filter(Nomina.empleado_id == empleado_id)
+    filtros, año, empleado_id = _filtros_nominas()
     
-    nominas = query.order_by(Nomina.mes.desc(), Nomina.empleado_id).all()
+    # Nóminas con su empleado cargado en la misma consulta
+    nominas = Nomina.query.options(joinedload(Nomina.empleado)).filter(*filtros).order_by(
+        Nomina.mes.desc(), Nomina.empleado_id
+    ).all()
     
-    # Calcular totales
-    total_global = sum(n.total_devengado for n in nominas)
+    # Totales por empleado agrupados en SQL
+    filas_totales = db.session.query(
+        Empleado.nombre, func.sum(_centimos(Nomina.total_devengado))
+    ).select_from(Nomina).outerjoin(Empleado, Nomina.empleado_id == Empleado.id).filter(
+        *filtros
+    ).group_by(Nomina.empleado_id, Empleado.nombre).order_by(Empleado.nombre).all()
     
-    # Totales por empleado
     totales_por_empleado = {}
-    for nomina in nominas:
-        empleado_nombre = nomina.empleado.nombre if nomina.empleado else 'Sin empleado'
-        if empleado_nombre not in totales_por_empleado:
-            totales_por_empleado[empleado_nombre] = Decimal('0')
-        totales_por_empleado[empleado_nombre] += nomina.total_devengado
+    for empleado_nombre, total in filas_totales:
+        empleado_nombre = empleado_nombre or 'Sin empleado'
+        totales_por_empleado[empleado_nombre] = totales_por_empleado.get(empleado_nombre, Decimal('0')) + _a_decimal(total)
+    total_global = sum(totales_por_empleado.values(), Decimal('0'))
     
     # Obtener lista de empleados para el filtro
     empleados = Empleado.query.order_by(Empleado.nombre).all()
@@ -155,101 +244,47 @@ def nominas():
 @not_usuario_required
 def iva():
     """Informe de IVA: contrastar IVA repercutido vs IVA soportado"""
-    # Obtener parámetros de filtro
-    tipo_filtro = request.args.get('tipo', 'mes')  # 'mes' o 'trimestre'
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
-    
-    # Calcular IVA repercutido (de facturas emitidas)
-    query_facturas = Factura.query.filter(extract('year', Factura.fecha_expedicion) == año)
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    if tipo_filtro == 'mes' and periodo:
-        query_facturas = query_facturas.filter(extract('month', Factura.fecha_expedicion) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query_facturas = query_facturas.filter(extract('month', Factura.fecha_expedicion).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
-    
-    facturas_emitidas = query_facturas.all()
-    iva_repercutido = Decimal('0')
-    base_repercutida = Decimal('0')
-    tipo_iva = Decimal('21')  # IVA estándar al 21%
-    
-    for factura in facturas_emitidas:
-        for linea in factura.lineas:
-            importe_con_iva = Decimal(str(linea.importe))
-            # Calcular base imponible: importe / (1 + tipo_iva/100)
-            base_imponible = importe_con_iva / (Decimal('1') + tipo_iva / Decimal('100'))
-            base_imponible = base_imponible.quantize(Decimal('0.01'))
-            base_repercutida += base_imponible
-            # Calcular IVA repercutido: base_imponible * (tipo_iva/100)
-            iva_linea = base_imponible * tipo_iva / Decimal('100')
-            iva_repercutido += iva_linea.quantize(Decimal('0.01'))
-    
-    # Calcular IVA soportado (de facturas de proveedor)
-    query_facturas_prov = FacturaProveedor.query.filter(extract('year', FacturaProveedor.fecha_factura) == año)
-    
-    if tipo_filtro == 'mes' and periodo:
-        query_facturas_prov = query_facturas_prov.filter(extract('month', FacturaProveedor.fecha_factura) == periodo)
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query_facturas_prov = query_facturas_prov.filter(extract('month', FacturaProveedor.fecha_factura).between(mes_inicio, mes_fin))
-    
-    facturas_proveedor = query_facturas_prov.all()
-    iva_soportado = sum(f.importe_iva for f in facturas_proveedor)
-    base_soportada = sum(f.base_imponible for f in facturas_proveedor)
+    # IVA repercutido (facturas emitidas) y soportado (facturas de proveedor) del resumen mensual
+    resumen = obtener_resumen(desde, hasta)
     
     # Calcular diferencia
-    diferencia_iva = iva_repercutido - iva_soportado
+    diferencia_iva = resumen['cuota_iva_repercutida'] - resumen['cuota_iva_soportada']
     
     return render_template('informes/iva.html',
-                         iva_repercutido=iva_repercutido,
-                         base_repercutida=base_repercutida,
-                         iva_soportado=iva_soportado,
-                         base_soportada=base_soportada,
+                         iva_repercutido=resumen['cuota_iva_repercutida'],
+                         base_repercutida=resumen['base_repercutida'],
+                         iva_soportado=resumen['cuota_iva_soportada'],
+                         base_soportada=resumen['base_soportada'],
                          diferencia_iva=diferencia_iva,
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
                          periodo_label=periodo_label,
-                         num_facturas_emitidas=len(facturas_emitidas),
-                         num_facturas_proveedor=len(facturas_proveedor))
+                         num_facturas_emitidas=resumen['num_facturas_emitidas'],
+                         num_facturas_proveedor=resumen['num_facturas_proveedor'])
 
 @informes_bp.route('/informes/facturacion-emitida/detalle')
 @login_required
 @not_usuario_required
 def facturacion_emitida_detalle():
     """Detalle de facturación emitida con listado completo de facturas"""
-    # Obtener parámetros de filtro (mismos que en el informe principal)
-    tipo_filtro = request.args.get('tipo', 'mes')
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
-    
-    # Base query
-    query = Factura.query.filter(extract('year', Factura.fecha_expedicion) == año)
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    if tipo_filtro == 'mes' and periodo:
-        query = query.filter(extract('month', Factura.fecha_expedicion) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query = query.filter(extract('month', Factura.fecha_expedicion).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
+    filas = _consulta_filas_facturas(desde, hasta).order_by(
+        Factura.fecha_expedicion.desc(), Factura.id.desc()
+    ).all()
     
-    facturas = query.order_by(Factura.fecha_expedicion.desc()).all()
+    # Totales del pie desde el resumen mensual
+    resumen = obtener_resumen(desde, hasta)
+    total_base = resumen['importe_lineas_emitidas'] / (Decimal('1') + TIPO_IVA / Decimal('100'))
     
     return render_template('informes/detalle_facturacion_emitida.html',
-                         facturas=facturas,
+                         facturas=_desglose_iva(filas),
+                         total_facturacion=resumen['total_emitido'],
+                         total_base=total_base,
+                         total_iva=total_base * TIPO_IVA / Decimal('100'),
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
@@ -260,30 +295,18 @@ def facturacion_emitida_detalle():
 @not_usuario_required
 def facturacion_soportada_detalle():
     """Detalle de facturación soportada con listado completo de facturas de proveedor"""
-    # Obtener parámetros de filtro
-    tipo_filtro = request.args.get('tipo', 'mes')
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
-    
-    # Base query
-    query = FacturaProveedor.query.filter(extract('year', FacturaProveedor.fecha_factura) == año)
-    
-    if tipo_filtro == 'mes' and periodo:
-        query = query.filter(extract('month', FacturaProveedor.fecha_factura) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query = query.filter(extract('month', FacturaProveedor.fecha_factura).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    facturas = query.order_by(FacturaProveedor.fecha_factura.desc()).all()
+    facturas = _consulta_filas_facturas_proveedor(desde, hasta).order_by(
+        FacturaProveedor.fecha_factura.desc(), FacturaProveedor.id.desc()
+    ).all()
+    resumen = obtener_resumen(desde, hasta)
     
     return render_template('informes/detalle_facturacion_soportada.html',
                          facturas=facturas,
+                         total_facturacion=resumen['total_soportado'],
+                         total_base=resumen['base_soportada'],
+                         total_iva=resumen['cuota_iva_soportada'],
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
@@ -294,24 +317,21 @@ def facturacion_soportada_detalle():
 @not_usuario_required
 def nominas_detalle():
     """Detalle de nóminas con listado completo"""
-    # Obtener parámetros de filtro
-    empleado_id = request.args.get('empleado_id', None, type=int)
-    año = request.args.get('año', datetime.now().year, type=int)
-    
-    # Base query
-    query = Nomina.query.filter(Nomina.año == año)
-    
-    if empleado_id:
-        query = query.filter(Nomina.empleado_id == empleado_id)
+    filtros, año, empleado_id = _filtros_nominas()
     
-    nominas = query.order_by(Nomina.mes.desc(), Nomina.empleado_id).all()
+    nominas = Nomina.query.options(joinedload(Nomina.empleado)).filter(*filtros).order_by(
+        Nomina.mes.desc(), Nomina.empleado_id
+    ).all()
+    # El detalle muestra todas las nóminas del filtro: el total sale de las filas ya leídas
+    total_global = sum((n.total_devengado for n in nominas), Decimal('0'))
     
     # Obtener lista de empleados para el filtro
     empleados = Empleado.query.order_by(Empleado.nombre).all()
-    empleado_seleccionado = Empleado.query.get(empleado_id) if empleado_id else None
+    empleado_seleccionado = next((e for e in empleados if e.id == empleado_id), None) if empleado_id else None
     
     return render_template('informes/detalle_nominas.html',
                          nominas=nominas,
+                         total_global=total_global,
                          empleados=empleados,
                          empleado_id=empleado_id,
                          empleado_seleccionado=empleado_seleccionado,
@@ -322,72 +342,106 @@ def nominas_detalle():
 @not_usuario_required
 def iva_detalle():
     """Detalle de IVA con listado completo de facturas emitidas y de proveedor"""
-    # Obtener parámetros de filtro
-    tipo_filtro = request.args.get('tipo', 'mes')
-    año = request.args.get('año', datetime.now().year, type=int)
-    periodo = request.args.get('periodo', None, type=int)
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
     
-    # Calcular IVA repercutido (de facturas emitidas)
-    query_facturas = Factura.query.filter(extract('year', Factura.fecha_expedicion) == año)
-    
-    if tipo_filtro == 'mes' and periodo:
-        query_facturas = query_facturas.filter(extract('month', Factura.fecha_expedicion) == periodo)
-        periodo_label = f"{['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'][periodo]} {año}"
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query_facturas = query_facturas.filter(extract('month', Factura.fecha_expedicion).between(mes_inicio, mes_fin))
-        trimestres = {1: '1T', 2: '2T', 3: '3T', 4: '4T'}
-        periodo_label = f"{trimestres.get(periodo, '')} {año}"
-    else:
-        periodo_label = f"Año {año}"
-    
-    facturas_emitidas = query_facturas.order_by(Factura.fecha_expedicion.desc()).all()
-    
-    # Calcular IVA soportado (de facturas de proveedor)
-    query_facturas_prov = FacturaProveedor.query.filter(extract('year', FacturaProveedor.fecha_factura) == año)
-    
-    if tipo_filtro == 'mes' and periodo:
-        query_facturas_prov = query_facturas_prov.filter(extract('month', FacturaProveedor.fecha_factura) == periodo)
-    elif tipo_filtro == 'trimestre' and periodo:
-        mes_inicio = (periodo - 1) * 3 + 1
-        mes_fin = periodo * 3
-        query_facturas_prov = query_facturas_prov.filter(extract('month', FacturaProveedor.fecha_factura).between(mes_inicio, mes_fin))
+    facturas_emitidas = _consulta_filas_facturas(desde, hasta).order_by(
+        Factura.fecha_expedicion.desc(), Factura.id.desc()
+    ).all()
+    facturas_proveedor = _consulta_filas_facturas_proveedor(desde, hasta).order_by(
+        FacturaProveedor.fecha_factura.desc(), FacturaProveedor.id.desc()
+    ).all()
     
-    facturas_proveedor = query_facturas_prov.order_by(FacturaProveedor.fecha_factura.desc()).all()
-    
-    # Precalcular totales para evitar problemas de tipo en las plantillas
-    tipo_iva_decimal = Decimal('21')
-    total_base_emitida = Decimal('0')
-    total_iva_emitido = Decimal('0')
-    total_facturacion_emitida = Decimal('0')
-    
-    for factura in facturas_emitidas:
-        total_facturacion_emitida += Decimal(str(factura.importe_total))
-        for linea in factura.lineas:
-            importe_con_iva = Decimal(str(linea.importe))
-            base_imponible = importe_con_iva / (Decimal('1') + tipo_iva_decimal / Decimal('100'))
-            base_imponible = base_imponible.quantize(Decimal('0.01'))
-            total_base_emitida += base_imponible
-            iva_linea = base_imponible * tipo_iva_decimal / Decimal('100')
-            total_iva_emitido += iva_linea.quantize(Decimal('0.01'))
-    
-    total_base_soportada = sum(Decimal(str(f.base_imponible)) for f in facturas_proveedor)
-    total_iva_soportado = sum(Decimal(str(f.importe_iva)) for f in facturas_proveedor)
-    total_facturacion_soportada = sum(Decimal(str(f.total)) for f in facturas_proveedor)
+    # Totales desde el resumen mensual
+    resumen = obtener_resumen(desde, hasta)
     
     return render_template('informes/detalle_iva.html',
-                         facturas_emitidas=facturas_emitidas,
+                         facturas_emitidas=_desglose_iva(facturas_emitidas),
                          facturas_proveedor=facturas_proveedor,
                          tipo_filtro=tipo_filtro,
                          año=año,
                          periodo=periodo,
                          periodo_label=periodo_label,
-                         tipo_iva_decimal=tipo_iva_decimal,
-                         total_base_emitida=total_base_emitida,
-                         total_iva_emitido=total_iva_emitido,
-                         total_facturacion_emitida=total_facturacion_emitida,
-                         total_base_soportada=total_base_soportada,
-                         total_iva_soportado=total_iva_soportado,
-                         total_facturacion_soportada=total_facturacion_soportada)
+                         tipo_iva_decimal=TIPO_IVA,
+                         total_base_emitida=resumen['base_repercutida'],
+                         total_iva_emitido=resumen['cuota_iva_repercutida'],
+                         total_facturacion_emitida=resumen['total_emitido'],
+                         total_base_soportada=resumen['base_soportada'],
+                         total_iva_soportado=resumen['cuota_iva_soportada'],
+                         total_facturacion_soportada=resumen['total_soportado'])
+
+# ========== EXPORTACIÓN (CSV / EXCEL) ==========
+# Mismos filtros que los detalles; las filas se leen y escriben por lotes
 
+@informes_bp.route('/informes/facturacion-emitida/exportar')
+@login_required
+@not_usuario_required
+def exportar_facturacion_emitida():
+    """Exportar las facturas emitidas del periodo"""
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
+    consulta = _consulta_filas_facturas(desde, hasta).order_by(
+        Factura.fecha_expedicion.desc(), Factura.id.desc()
+    )
+    return respuesta_exportacion(
+        _nombre_exportacion('facturacion_emitida', periodo_label),
+        COLUMNAS_EXPORTACION_FACTURAS,
+        filas_consulta(consulta, _fila_exportacion_factura)
+    )
+
+@informes_bp.route('/informes/facturacion-soportada/exportar')
+@login_required
+@not_usuario_required
+def exportar_facturacion_soportada():
+    """Exportar las facturas de proveedor del periodo"""
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
+    consulta = _consulta_filas_facturas_proveedor(desde, hasta).order_by(
+        FacturaProveedor.fecha_factura.desc(), FacturaProveedor.id.desc()
+    )
+    return respuesta_exportacion(
+        _nombre_exportacion('facturacion_soportada', periodo_label),
+        COLUMNAS_EXPORTACION_FACTURAS_PROVEEDOR,
+        filas_consulta(consulta, _fila_exportacion_factura_proveedor)
+    )
+
+@informes_bp.route('/informes/nominas/exportar')
+@login_required
+@not_usuario_required
+def exportar_nominas():
+    """Exportar las nóminas del año (y empleado) filtrados"""
+    filtros, año, empleado_id = _filtros_nominas()
+    consulta = db.session.query(
+        Nomina.id, Empleado.nombre, Nomina.mes, Nomina.año, Nomina.total_devengado, Nomina.observaciones
+    ).select_from(Nomina).outerjoin(Empleado, Nomina.empleado_id == Empleado.id).filter(
+        *filtros
+    ).order_by(Nomina.mes.desc(), Nomina.empleado_id)
+    return respuesta_exportacion(
+        f'nominas_{año}',
+        ['ID', 'Empleado', 'Mes', 'Año', 'Total Devengado', 'Observaciones'],
+        filas_consulta(consulta)
+    )
+
+@informes_bp.route('/informes/iva/exportar')
+@login_required
+@not_usuario_required
+def exportar_iva():
+    """Exportar en una sola tabla las facturas emitidas (IVA repercutido) y de proveedor (IVA soportado)"""
+    tipo_filtro, año, periodo, desde, hasta, periodo_label = _periodo_desde_request()
+    emitidas = _consulta_filas_facturas(desde, hasta).order_by(
+        Factura.fecha_expedicion.desc(), Factura.id.desc()
+    )
+    proveedor = _consulta_filas_facturas_proveedor(desde, hasta).order_by(
+        FacturaProveedor.fecha_factura.desc(), FacturaProveedor.id.desc()
+    )
+    
+    def fila_emitida(fila):
+        numero, fecha, nombre, nif, total, base, iva = _fila_exportacion_factura(fila)
+        return ('Repercutido', numero, fecha, nombre, nif, base, TIPO_IVA, iva, total)
+    
+    def fila_proveedor(fila):
+        return ('Soportado', fila.numero_factura, fila.fecha_factura, fila.proveedor_nombre, None,
+                fila.base_imponible, fila.tipo_iva, fila.importe_iva, fila.total)
+    
+    return respuesta_exportacion(
+        _nombre_exportacion('iva', periodo_label),
+        ['IVA', 'Número', 'Fecha', 'Cliente / Proveedor', 'NIF', 'Base Imponible', 'Tipo IVA', 'Cuota IVA', 'Total'],
+        chain(filas_consulta(emitidas, fila_emitida), filas_consulta(proveedor, fila_proveedor))
+    )
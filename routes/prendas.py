@@ -1,10 +1,11 @@
 """Rutas para gestión de prendas"""
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required
 from extensions import db
 from models import Prenda
 from decimal import Decimal
 from utils.auth import not_usuario_required
+from utils.datos_referencia import obtener_prendas, invalidar_prendas
 
 prendas_bp = Blueprint('prendas', __name__)
 
@@ -24,6 +25,7 @@ def gestion_prendas():
                 precio_venta=Decimal(precio_venta)
             )
             db.session.add(prenda)
+            invalidar_prendas()
             db.session.commit()
             flash('Prenda creada correctamente', 'success')
             return redirect(url_for('prendas.gestion_prendas'))
@@ -31,7 +33,7 @@ def gestion_prendas():
             db.session.rollback()
             flash(f'Error: {str(e)}', 'error')
     
-    prendas = Prenda.query.order_by(Prenda.nombre).all()
+    prendas = obtener_prendas()
     return render_template('prendas.html', prendas=prendas)
 
 @prendas_bp.route('/prendas/<int:id>/editar', methods=['POST'])
@@ -46,6 +48,7 @@ def editar_prenda(id):
         precio_venta = request.form.get('precio_venta', '0') or '0'
         prenda.precio_coste = Decimal(precio_coste)
         prenda.precio_venta = Decimal(precio_venta)
+        invalidar_prendas()
         db.session.commit()
         flash('Prenda actualizada correctamente', 'success')
     except Exception as e:
@@ -60,6 +63,7 @@ def eliminar_prenda(id):
     prenda = Prenda.query.get_or_404(id)
     try:
         db.session.delete(prenda)
+        invalidar_prendas()
         db.session.commit()
         flash('Prenda eliminada', 'success')
     except Exception as e:
@@ -67,3 +71,34 @@ def eliminar_prenda(id):
         flash(f'Error al eliminar prenda: {str(e)}', 'error')
     return redirect(url_for('prendas.gestion_prendas'))
 
+
+@prendas_bp.route('/api/prendas/buscar')
+@login_required
+def api_buscar_prendas():
+    """Buscar prendas por nombre para el autocompletado de las líneas"""
+    termino = request.args.get('q', '').strip()
+    try:
+        limite = min(max(int(request.args.get('limite', 20)), 1), 100)
+    except ValueError:
+        limite = 20
+    
+    query = Prenda.query
+    if termino:
+        # Primero las que empiezan por el texto, después las que lo contienen
+        empieza = Prenda.nombre.ilike(f'{termino}%')
+        query = query.filter(Prenda.nombre.ilike(f'%{termino}%')).order_by(
+            db.case((empieza, 0), else_=1), Prenda.nombre
+        )
+    else:
+        query = query.order_by(Prenda.nombre)
+    prendas = query.limit(limite).all()
+    
+    return jsonify({
+        'success': True,
+        'prendas': [{
+            'id': prenda.id,
+            'nombre': prenda.nombre,
+            'tipo': prenda.tipo,
+            'precio_venta': float(prenda.precio_venta or 0)
+        } for prenda in prendas]
+    })
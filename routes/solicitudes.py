@@ -8,13 +8,19 @@ import tempfile
 from io import BytesIO
 from extensions import db
 from models import Comercial, Cliente, Prenda, Presupuesto, LineaPresupuesto, Usuario, RegistroEstadoSolicitud
-from sqlalchemy.orm import joinedload
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, raiseload
 from flask import jsonify
 from playwright.sync_api import sync_playwright
 from decimal import Decimal
 import base64
 from utils.sftp_upload import upload_file_to_sftp, download_file_from_sftp, get_file_url, file_exists_on_sftp
 from utils.numeracion import obtener_siguiente_numero_solicitud
+from utils.cache import incrementar_version, VERSION_PANEL_SOLICITUDES
+from utils.paginacion import paginar_desde_request
+from utils.datos_referencia import obtener_comerciales, obtener_usuarios_activos
+from utils.metricas import registrar_pdf_generado
+from utils.exportacion import respuesta_exportacion, filas_consulta
 
 solicitudes_bp = Blueprint('solicitudes', __name__)
 
@@ -60,23 +66,21 @@ ESTADOS_FECHAS = {
     'entregado al cliente': 'fecha_entregado_cliente'
 }
 
-@solicitudes_bp.route('/solicitudes')
-@login_required
-def listado_solicitudes():
-    """Listado de solicitudes con filtros"""
-    query = Presupuesto.query
+def filtros_listado_solicitudes():
+    """Condiciones de los filtros GET del listado de solicitudes (las usa también la exportación)"""
+    filtros = []
     
     # Filtro por estado específico
     estado_filtro = request.args.get('estado', '')
     if estado_filtro:
-        query = query.filter(Presupuesto.estado == estado_filtro)
+        filtros.append(Presupuesto.estado == estado_filtro)
     
     # Filtro por fecha desde
     fecha_desde = request.args.get('fecha_desde', '')
     if fecha_desde:
         try:
             fecha_desde_obj = datetime.strptime(fecha_desde, '%Y-%m-%d').date()
-            query = query.filter(Presupuesto.fecha_creacion >= datetime.combine(fecha_desde_obj, datetime.min.time()))
+            filtros.append(Presupuesto.fecha_creacion >= datetime.combine(fecha_desde_obj, datetime.min.time()))
         except ValueError:
             pass
     
@@ -85,7 +89,7 @@ def listado_solicitudes():
     if fecha_hasta:
         try:
             fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d').date()
-            query = query.filter(Presupuesto.fecha_creacion <= datetime.combine(fecha_hasta_obj, datetime.max.time()))
+            filtros.append(Presupuesto.fecha_creacion <= datetime.combine(fecha_hasta_obj, datetime.max.time()))
         except ValueError:
             pass
     
@@ -93,7 +97,7 @@ def listado_solicitudes():
     cliente_id = request.args.get('cliente_id', '')
     if cliente_id:
         try:
-            query = query.filter(Presupuesto.cliente_id == int(cliente_id))
+            filtros.append(Presupuesto.cliente_id == int(cliente_id))
         except ValueError:
             pass
     
@@ -101,21 +105,50 @@ def listado_solicitudes():
     comercial_id = request.args.get('comercial_id', '')
     if comercial_id:
         try:
-            query = query.filter(Presupuesto.comercial_id == int(comercial_id))
+            filtros.append(Presupuesto.comercial_id == int(comercial_id))
         except ValueError:
             pass
     
-    solicitudes = query.order_by(Presupuesto.fecha_creacion.desc()).all()
+    return filtros
+
+@solicitudes_bp.route('/solicitudes')
+@login_required
+def listado_solicitudes():
+    """Listado de solicitudes con filtros"""
+    # Cliente y comercial se cargan en la misma consulta; cualquier otra relación
+    # que use la plantilla fallará en lugar de lanzar una consulta por fila
+    query = Presupuesto.query.options(
+        joinedload(Presupuesto.cliente),
+        joinedload(Presupuesto.comercial),
+        raiseload('*')
+    ).filter(*filtros_listado_solicitudes())
+    
+    estado_filtro = request.args.get('estado', '')
+    fecha_desde = request.args.get('fecha_desde', '')
+    fecha_hasta = request.args.get('fecha_hasta', '')
+    cliente_id = request.args.get('cliente_id', '')
+    comercial_id = request.args.get('comercial_id', '')
+    
+    pagina = paginar_desde_request(query, [
+        (Presupuesto.fecha_creacion, True),
+        (Presupuesto.id, True)
+    ])
+    solicitudes = pagina.items
     
-    # Obtener datos para filtros
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    # Comercial.nombre es una propiedad, necesitamos ordenar por Usuario.usuario
-    comerciales = Comercial.query.join(Usuario).order_by(Usuario.usuario).all()
+    # Obtener datos para filtros (el cliente se elige por autocompletado)
+    cliente_filtro = None
+    if cliente_id:
+        try:
+            cliente_filtro = Cliente.query.get(int(cliente_id))
+        except ValueError:
+            pass
+    comerciales = obtener_comerciales()
     
     return render_template('solicitudes/listado.html',
                          solicitudes=solicitudes,
+                         pagina=pagina,
                          estados=ESTADOS_SOLICITUD,
-                         clientes=clientes,
+                         cliente_filtro=cliente_filtro,
                          comerciales=comerciales,
                          estado_filtro=estado_filtro,
                          fecha_desde=fecha_desde,
@@ -123,6 +156,36 @@ def listado_solicitudes():
                          cliente_id=cliente_id,
                          comercial_id=comercial_id)
 
+@solicitudes_bp.route('/solicitudes/exportar')
+@login_required
+def exportar_solicitudes():
+    """Exportar a CSV o Excel las solicitudes del listado con los filtros aplicados"""
+    consulta = db.session.query(
+        Presupuesto.numero_solicitud, Presupuesto.id, Cliente.nombre,
+        func.coalesce(Usuario.usuario, Comercial._nombre), Presupuesto.tipo_pedido,
+        Presupuesto.estado, Presupuesto.subestado, Presupuesto.fecha_creacion,
+        Presupuesto.fecha_aceptado
+    ).select_from(Presupuesto).outerjoin(
+        Cliente, Presupuesto.cliente_id == Cliente.id
+    ).outerjoin(
+        Comercial, Presupuesto.comercial_id == Comercial.id
+    ).outerjoin(
+        Usuario, Comercial.usuario_id == Usuario.id
+    ).filter(*filtros_listado_solicitudes()).order_by(
+        Presupuesto.fecha_creacion.desc(), Presupuesto.id.desc()
+    )
+    
+    def convertir(fila):
+        numero, id_solicitud, *resto = fila
+        return (numero or id_solicitud, *resto)
+    
+    return respuesta_exportacion(
+        'solicitudes',
+        ['Nº Solicitud', 'Cliente', 'Comercial', 'Tipo', 'Estado', 'Subestado',
+         'Fecha', 'Fecha Aceptado'],
+        filas_consulta(consulta, convertir)
+    )
+
 @solicitudes_bp.route('/solicitudes/nueva', methods=['GET', 'POST'])
 @login_required
 def nueva_solicitud():
@@ -369,6 +432,8 @@ def nueva_solicitud():
                         setattr(solicitud, imagen_key, ruta_relativa)
                         setattr(solicitud, descripcion_key, request.form.get(descripcion_key, ''))
             
+            # Invalidar la caché del panel de control en todos los workers
+            incrementar_version(VERSION_PANEL_SOLICITUDES)
             db.session.commit()
             
             # Refrescar la solicitud para cargar las líneas
@@ -383,15 +448,11 @@ def nueva_solicitud():
             import traceback
             traceback.print_exc()
     
-    # GET: mostrar formulario
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    comerciales = Comercial.query.join(Usuario).order_by(Usuario.usuario).all()
-    prendas = Prenda.query.order_by(Prenda.nombre).all()
+    # GET: mostrar formulario (clientes y prendas se buscan por autocompletado)
+    comerciales = obtener_comerciales()
     
     return render_template('solicitudes/nueva.html',
-                         clientes=clientes,
-                         comerciales=comerciales,
-                         prendas=prendas)
+                         comerciales=comerciales)
 
 @solicitudes_bp.route('/solicitudes/<int:solicitud_id>')
 @login_required
@@ -406,26 +467,6 @@ def ver_solicitud(solicitud_id):
         joinedload(Presupuesto.marcada_encargado_a)
     ).get_or_404(solicitud_id)
     
-    # Debug: verificar si hay líneas
-    print(f"DEBUG ver_solicitud: Solicitud {solicitud_id} tiene {len(solicitud.lineas) if solicitud.lineas else 0} líneas")
-    if solicitud.lineas:
-        for linea in solicitud.lineas:
-            print(f"DEBUG ver_solicitud: Línea {linea.id} - nombre_mostrar: '{linea.nombre_mostrar}', nombre: '{linea.nombre}', prenda_id: {linea.prenda_id}")
-    else:
-        # Verificar directamente en la base de datos
-        lineas_directas = LineaPresupuesto.query.filter_by(presupuesto_id=solicitud_id).all()
-        print(f"DEBUG ver_solicitud: Consulta directa encontró {len(lineas_directas)} líneas")
-        for linea in lineas_directas:
-            print(f"DEBUG ver_solicitud: Línea directa {linea.id} - nombre_mostrar: '{linea.nombre_mostrar}', nombre: '{linea.nombre}'")
-        # Si hay líneas directas pero no en la relación, recargar
-        if lineas_directas:
-            db.session.refresh(solicitud)
-            solicitud = Presupuesto.query.options(
-                joinedload(Presupuesto.lineas).joinedload(LineaPresupuesto.prenda),
-                joinedload(Presupuesto.cliente),
-                joinedload(Presupuesto.comercial)
-            ).get(solicitud_id)
-    
     # Obtener registros de cambios de estado ordenados por fecha (con eager loading de usuario)
     registros_estado = RegistroEstadoSolicitud.query.options(
         joinedload(RegistroEstadoSolicitud.usuario)
@@ -434,7 +475,7 @@ def ver_solicitud(solicitud_id):
     ).order_by(RegistroEstadoSolicitud.fecha_cambio.asc()).all()
     
     # Obtener usuarios activos para asignar mockup
-    usuarios = Usuario.query.filter_by(activo=True).order_by(Usuario.usuario).all()
+    usuarios = obtener_usuarios_activos()
     
     hoy = datetime.now().date()
     
@@ -549,6 +590,8 @@ def cambiar_estado_solicitud(solicitud_id):
             )
             db.session.add(registro)
         
+        # Invalidar la caché del panel de control en todos los workers
+        incrementar_version(VERSION_PANEL_SOLICITUDES)
         db.session.commit()
         
         # Enviar email si cambió el estado o el subestado
@@ -786,6 +829,8 @@ def editar_solicitud(solicitud_id):
                     )
                     db.session.add(linea)
             
+            # Invalidar la caché del panel de control en todos los workers
+            incrementar_version(VERSION_PANEL_SOLICITUDES)
             db.session.commit()
             flash('Solicitud actualizada correctamente', 'success')
             return redirect(url_for('solicitudes.ver_solicitud', solicitud_id=solicitud_id))
@@ -794,16 +839,12 @@ def editar_solicitud(solicitud_id):
             db.session.rollback()
             flash(f'Error al actualizar la solicitud: {str(e)}', 'error')
     
-    # GET: mostrar formulario
-    clientes = Cliente.query.order_by(Cliente.nombre).all()
-    comerciales = Comercial.query.join(Usuario).order_by(Usuario.usuario).all()
-    prendas = Prenda.query.order_by(Prenda.nombre).all()
+    # GET: mostrar formulario (clientes y prendas se buscan por autocompletado)
+    comerciales = obtener_comerciales()
     
     return render_template('solicitudes/editar.html',
                          solicitud=solicitud,
-                         clientes=clientes,
-                         comerciales=comerciales,
-                         prendas=prendas)
+                         comerciales=comerciales)
 
 
 @solicitudes_bp.route('/solicitudes/crear-cliente-ajax', methods=['POST'])
@@ -1049,6 +1090,7 @@ def descargar_albaran_solicitud(solicitud_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -1123,6 +1165,7 @@ def descargar_pdf_solicitud(solicitud_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -1202,6 +1245,7 @@ def hoja_trabajo_solicitud(solicitud_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
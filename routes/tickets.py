@@ -1,7 +1,7 @@
 """Rutas para gestión de tickets de tienda (Facturas simplificadas)"""
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, send_file
 from flask_login import login_required
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 import os
 import requests
@@ -12,9 +12,15 @@ from io import BytesIO
 from extensions import db
 from models import Ticket, LineaTicket, ClienteTienda
 from flask import jsonify
+from sqlalchemy import func
+from sqlalchemy.orm import raiseload
 from utils.numeracion import obtener_siguiente_numero_ticket
 from playwright.sync_api import sync_playwright
 from utils.auth import not_usuario_required
+from utils.paginacion import paginar_desde_request
+from utils.fechas import MESES
+from utils.metricas import registrar_pdf_generado
+from utils.exportacion import respuesta_exportacion, filas_consulta
 
 tickets_bp = Blueprint('tickets', __name__)
 
@@ -26,24 +32,21 @@ def listado_clientes_tienda():
     clientes = ClienteTienda.query.order_by(ClienteTienda.nombre).all()
     return render_template('listado_clientes_tienda.html', clientes=clientes)
 
-@tickets_bp.route('/tickets')
-@login_required
-@not_usuario_required
-def listado_tickets():
-    """Listado de tickets con opciones de ver y eliminar"""
-    query = Ticket.query
+def filtros_listado_tickets():
+    """Condiciones de los filtros GET del listado de tickets (las usa también la exportación)"""
+    filtros = []
     
     # Filtro por estado
     estado_filtro = request.args.get('estado', '')
     if estado_filtro:
-        query = query.filter(Ticket.estado == estado_filtro)
+        filtros.append(Ticket.estado == estado_filtro)
     
     # Filtro por fecha desde
     fecha_desde = request.args.get('fecha_desde', '')
     if fecha_desde:
         try:
             fecha_desde_obj = datetime.strptime(fecha_desde, '%Y-%m-%d').date()
-            query = query.filter(Ticket.fecha_expedicion >= fecha_desde_obj)
+            filtros.append(Ticket.fecha_expedicion >= fecha_desde_obj)
         except ValueError:
             pass
     
@@ -52,11 +55,25 @@ def listado_tickets():
     if fecha_hasta:
         try:
             fecha_hasta_obj = datetime.strptime(fecha_hasta, '%Y-%m-%d').date()
-            query = query.filter(Ticket.fecha_expedicion <= fecha_hasta_obj)
+            filtros.append(Ticket.fecha_expedicion <= fecha_hasta_obj)
         except ValueError:
             pass
     
-    tickets = query.order_by(Ticket.id.desc()).all()
+    return filtros
+
+@tickets_bp.route('/tickets')
+@login_required
+@not_usuario_required
+def listado_tickets():
+    """Listado de tickets con opciones de ver y eliminar"""
+    query = Ticket.query.options(raiseload('*')).filter(*filtros_listado_tickets())
+    
+    estado_filtro = request.args.get('estado', '')
+    fecha_desde = request.args.get('fecha_desde', '')
+    fecha_hasta = request.args.get('fecha_hasta', '')
+    
+    pagina = paginar_desde_request(query, [(Ticket.id, True)])
+    tickets = pagina.items
     
     # Obtener estados únicos para el filtro
     estados = db.session.query(Ticket.estado).distinct().all()
@@ -64,11 +81,32 @@ def listado_tickets():
     
     return render_template('listado_tickets.html', 
                          tickets=tickets,
+                         pagina=pagina,
                          estados=estados_list,
                          estado_filtro=estado_filtro,
                          fecha_desde=fecha_desde,
                          fecha_hasta=fecha_hasta)
 
+@tickets_bp.route('/tickets/exportar')
+@login_required
+@not_usuario_required
+def exportar_tickets():
+    """Exportar a CSV o Excel los tickets del listado con los filtros aplicados"""
+    consulta = db.session.query(
+        Ticket.serie, Ticket.numero, Ticket.fecha_expedicion, Ticket.nombre, Ticket.nif,
+        Ticket.categoria, Ticket.forma_pago, Ticket.importe_total, Ticket.estado
+    ).filter(*filtros_listado_tickets()).order_by(Ticket.id.desc())
+    
+    def convertir(fila):
+        serie, numero, *resto = fila
+        return (f'{serie}-{numero}', *resto)
+    
+    return respuesta_exportacion(
+        'tickets',
+        ['Serie-Nº', 'Fecha', 'Cliente', 'NIF', 'Categoría', 'Forma de Pago', 'Importe', 'Estado'],
+        filas_consulta(consulta, convertir)
+    )
+
 @tickets_bp.route('/tickets/nuevo', methods=['GET', 'POST'])
 @login_required
 @not_usuario_required
@@ -174,11 +212,8 @@ def nuevo_ticket():
             ticket.importe_total = importe_total
             
             # Verificar si el envío a Verifactu está activado
-            from models import Configuracion
-            config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-            verifactu_enviar_activo = True  # Por defecto activado
-            if config:
-                verifactu_enviar_activo = config.valor.lower() == 'true'
+            from utils.datos_referencia import configuracion_activa
+            verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
             
             # Enviar a Verifactu solo si está activado y hay token
             verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
@@ -384,6 +419,7 @@ def descargar_pdf_ticket(ticket_id):
                 )
                 
                 browser.close()
+                registrar_pdf_generado()
             
             # Escribir el PDF al buffer
             pdf_buffer.write(pdf_bytes)
@@ -432,76 +468,130 @@ def eliminar_ticket(ticket_id):
     
     return redirect(url_for('tickets.listado_tickets'))
 
+# Formas de pago conocidas del cuadre de caja, en el orden en que se muestran:
+# etiqueta y colores de su tarjeta. Las demás se muestran con su nombre y en gris.
+FORMAS_PAGO_CUADRE = {
+    'efectivo': ('💵 Efectivo', '#28a745', '#20c997'),
+    'tarjeta': ('💳 Tarjeta', '#007bff', '#0056b3'),
+    'bizum': ('📱 Bizum', '#6f42c1', '#5a32a3'),
+    'transferencia': ('🏦 Transferencia', '#17a2b8', '#138496'),
+}
+COLORES_OTRA_FORMA_PAGO = ('#6c757d', '#495057')
+ETIQUETA_SIN_FORMA_PAGO = 'Sin forma de pago'
+
+
+def _grupo_caja(**datos):
+    """Acumulador de tickets e importes de un día, semana, mes o periodo, por forma de pago"""
+    return dict(datos, cantidad=0, total=Decimal('0.00'), por_forma={})
+
+
+def _acumular_caja(grupo, forma, cantidad, total):
+    grupo['cantidad'] += cantidad
+    grupo['total'] += total
+    celda = grupo['por_forma'].setdefault(forma, {'cantidad': 0, 'total': Decimal('0.00')})
+    celda['cantidad'] += cantidad
+    celda['total'] += total
+
+
+def calcular_cuadre_caja(desde, hasta):
+    """
+    Cuadre de caja entre dos fechas (incluidas), por día y forma de pago
+
+    Se calcula con una sola consulta agrupada por fecha de expedición y forma de pago
+    en minúsculas (usa el índice de fecha_expedicion). Devuelve un diccionario con:
+    - formas: formas de pago presentes (primero las conocidas) con etiqueta y colores
+    - dias, semanas, meses: acumuladores por periodo con cantidad, total y por_forma
+    - periodo: acumulador del periodo completo
+    """
+    forma_pago = func.lower(func.trim(func.coalesce(Ticket.forma_pago, '')))
+    filas = db.session.query(
+        Ticket.fecha_expedicion, forma_pago, func.count(Ticket.id), func.sum(func.round(Ticket.importe_total, 2))
+    ).filter(
+        Ticket.fecha_expedicion >= desde, Ticket.fecha_expedicion <= hasta
+    ).group_by(Ticket.fecha_expedicion, forma_pago).order_by(Ticket.fecha_expedicion).all()
+    
+    dias, semanas, meses = {}, {}, {}
+    periodo = _grupo_caja()
+    for fecha, forma, cantidad, total in filas:
+        total = Decimal(str(total or 0)).quantize(Decimal('0.01'))
+        año_iso, semana_iso, _ = fecha.isocalendar()
+        lunes = fecha - timedelta(days=fecha.weekday())
+        grupos = (
+            dias.setdefault(fecha, _grupo_caja(fecha=fecha)),
+            semanas.setdefault((año_iso, semana_iso), _grupo_caja(
+                etiqueta=f"Semana {semana_iso} ({lunes.strftime('%d/%m')} - {(lunes + timedelta(days=6)).strftime('%d/%m/%Y')})"
+            )),
+            meses.setdefault((fecha.year, fecha.month), _grupo_caja(etiqueta=f"{MESES[fecha.month]} {fecha.year}")),
+            periodo,
+        )
+        for grupo in grupos:
+            _acumular_caja(grupo, forma, cantidad, total)
+    
+    # Las formas conocidas siempre aparecen (aunque sea a cero); las demás, si tienen tickets
+    otras = sorted(f for f in periodo['por_forma'] if f not in FORMAS_PAGO_CUADRE)
+    formas = [
+        {'clave': clave, 'etiqueta': etiqueta, 'colores': (color_1, color_2)}
+        for clave, (etiqueta, color_1, color_2) in FORMAS_PAGO_CUADRE.items()
+    ] + [
+        {'clave': clave, 'etiqueta': clave.capitalize() or ETIQUETA_SIN_FORMA_PAGO, 'colores': COLORES_OTRA_FORMA_PAGO}
+        for clave in otras
+    ]
+    
+    return {
+        'formas': formas,
+        'dias': list(dias.values()),
+        'semanas': list(semanas.values()),
+        'meses': list(meses.values()),
+        'periodo': periodo,
+    }
+
 @tickets_bp.route('/tickets/cuadre-caja')
 @login_required
 @not_usuario_required
 def cuadre_caja():
-    """Cuadre de caja diario - mostrar totales por forma de pago"""
-    # Obtener fecha del filtro o usar hoy por defecto
-    fecha_cuadre = request.args.get('fecha', '')
+    """Cuadre de caja de un día o de un rango de fechas - totales por día y forma de pago"""
+    hoy = datetime.now().date()
     
-    if fecha_cuadre:
+    def leer_fecha(nombre, defecto):
         try:
-            fecha_cuadre_obj = datetime.strptime(fecha_cuadre, '%Y-%m-%d').date()
+            return datetime.strptime(request.args.get(nombre, ''), '%Y-%m-%d').date()
         except ValueError:
-            fecha_cuadre_obj = datetime.now().date()
-    else:
-        fecha_cuadre_obj = datetime.now().date()
+            return defecto
     
-    # Obtener todos los tickets del día seleccionado
-    tickets_dia = Ticket.query.filter(
-        Ticket.fecha_expedicion == fecha_cuadre_obj
-    ).all()
+    # ?fecha= (un solo día) se mantiene por compatibilidad con los enlaces existentes
+    fecha = leer_fecha('fecha', hoy)
+    fecha_desde = leer_fecha('fecha_desde', fecha)
+    fecha_hasta = leer_fecha('fecha_hasta', fecha_desde)
+    if fecha_hasta < fecha_desde:
+        fecha_desde, fecha_hasta = fecha_hasta, fecha_desde
     
-    # Calcular totales por forma de pago
-    total_efectivo = Decimal('0.00')
-    total_tarjeta = Decimal('0.00')
-    total_bizum = Decimal('0.00')
-    total_transferencia = Decimal('0.00')
-    total_general = Decimal('0.00')
+    cuadre = calcular_cuadre_caja(fecha_desde, fecha_hasta)
     
-    # Contadores por forma de pago
-    cantidad_efectivo = 0
-    cantidad_tarjeta = 0
-    cantidad_bizum = 0
-    cantidad_transferencia = 0
+    # Accesos rápidos: semana, mes y año en curso hasta hoy
+    accesos_rapidos = [
+        ('Semana', hoy - timedelta(days=hoy.weekday()), hoy),
+        ('Mes', hoy.replace(day=1), hoy),
+        ('Año', hoy.replace(month=1, day=1), hoy),
+    ]
     
-    for ticket in tickets_dia:
-        importe = Decimal(str(ticket.importe_total))
-        forma_pago = ticket.forma_pago.lower() if ticket.forma_pago else ''
-        
-        total_general += importe
-        
-        if forma_pago == 'efectivo':
-            total_efectivo += importe
-            cantidad_efectivo += 1
-        elif forma_pago == 'tarjeta':
-            total_tarjeta += importe
-            cantidad_tarjeta += 1
-        elif forma_pago == 'bizum':
-            total_bizum += importe
-            cantidad_bizum += 1
-        elif forma_pago == 'transferencia':
-            total_transferencia += importe
-            cantidad_transferencia += 1
+    # El desglose de tickets solo se muestra en el cuadre de un día
+    tickets_dia = []
+    if fecha_desde == fecha_hasta:
+        tickets_dia = Ticket.query.options(raiseload('*')).filter(
+            Ticket.fecha_expedicion == fecha_desde
+        ).order_by(Ticket.id).all()
     
-    # Preparar datos para el template
-    resumen = {
-        'fecha': fecha_cuadre_obj,
-        'total_efectivo': float(total_efectivo),
-        'total_tarjeta': float(total_tarjeta),
-        'total_bizum': float(total_bizum),
-        'total_transferencia': float(total_transferencia),
-        'total_general': float(total_general),
-        'cantidad_efectivo': cantidad_efectivo,
-        'cantidad_tarjeta': cantidad_tarjeta,
-        'cantidad_bizum': cantidad_bizum,
-        'cantidad_transferencia': cantidad_transferencia,
-        'tickets_dia': tickets_dia,
-        'total_tickets': len(tickets_dia)
-    }
-    
-    return render_template('tickets/cuadre_caja.html', **resumen)
+    return render_template('tickets/cuadre_caja.html',
+                         fecha_desde=fecha_desde,
+                         fecha_hasta=fecha_hasta,
+                         un_dia=fecha_desde == fecha_hasta,
+                         formas_pago=cuadre['formas'],
+                         dias=cuadre['dias'],
+                         semanas=cuadre['semanas'],
+                         meses=cuadre['meses'],
+                         periodo=cuadre['periodo'],
+                         tickets_dia=tickets_dia,
+                         accesos_rapidos=accesos_rapidos)
 
 @tickets_bp.route('/tickets/<int:ticket_id>/reenviar', methods=['POST'])
 @login_required
@@ -512,11 +602,8 @@ def reenviar_ticket(ticket_id):
         ticket = Ticket.query.get_or_404(ticket_id)
         
         # Verificar si el envío a Verifactu está activado
-        from models import Configuracion
-        config = Configuracion.query.filter_by(clave='verifactu_enviar_activo').first()
-        verifactu_enviar_activo = True  # Por defecto activado
-        if config:
-            verifactu_enviar_activo = config.valor.lower() == 'true'
+        from utils.datos_referencia import configuracion_activa
+        verifactu_enviar_activo = configuracion_activa('verifactu_enviar_activo', defecto=True)
         
         verifactu_url = os.environ.get('VERIFACTU_URL', 'https://api.verifacti.com/verifactu/create')
         verifactu_token = os.environ.get('VERIFACTU_TOKEN', '')
@@ -0,0 +1,187 @@
+/*
+ * Autocompletado contra los endpoints de búsqueda (/api/clientes/buscar, /api/prendas/buscar)
+ *
+ * Las peticiones se retrasan mientras el usuario escribe (debounce) y se cancela la
+ * anterior si todavía no ha respondido, así que solo se pide al servidor la lista
+ * de coincidencias y nunca el catálogo completo.
+ */
+(function () {
+    const ESPERA_MS = 250;
+
+    function escaparHtml(texto) {
+        return String(texto == null ? '' : texto)
+            .replace(/&/g, '&amp;')
+            .replace(/</g, '&lt;')
+            .replace(/>/g, '&gt;')
+            .replace(/"/g, '&quot;')
+            .replace(/'/g, '&#39;');
+    }
+
+    /*
+     * Buscador con retardo: devuelve una función buscar(termino, callback) que solo
+     * ejecuta la última petición y descarta las respuestas obsoletas.
+     */
+    function crearBuscador(url, clave, limite) {
+        let temporizador = null;
+        let controlador = null;
+
+        return function (termino, callback) {
+            clearTimeout(temporizador);
+            temporizador = setTimeout(function () {
+                if (controlador) {
+                    controlador.abort();
+                }
+                controlador = new AbortController();
+                const parametros = new URLSearchParams({ q: termino, limite: limite || 15 });
+                fetch(url + '?' + parametros.toString(), { signal: controlador.signal, credentials: 'same-origin' })
+                    .then(function (r) { return r.json(); })
+                    .then(function (datos) { callback(datos[clave] || []); })
+                    .catch(function (e) {
+                        if (e.name !== 'AbortError') {
+                            console.error('Error en autocompletado:', e);
+                            callback([]);
+                        }
+                    });
+            }, ESPERA_MS);
+        };
+    }
+
+    /*
+     * Lista desplegable de resultados bajo un campo de texto
+     *
+     * opciones:
+     *   input        campo de texto donde escribe el usuario
+     *   resultados   contenedor (div) donde se muestran las coincidencias
+     *   url, clave   endpoint y clave de la lista en la respuesta JSON
+     *   texto(item)  texto a mostrar para cada resultado (por defecto item.nombre)
+     *   alSeleccionar(item)  se llama al elegir un resultado
+     *   alLimpiar()  se llama cuando el campo se queda vacío
+     *   minimo       caracteres mínimos para buscar (por defecto 1)
+     */
+    function autocompletar(opciones) {
+        const input = opciones.input;
+        const resultados = opciones.resultados;
+        const texto = opciones.texto || function (item) { return item.nombre; };
+        const minimo = opciones.minimo || 1;
+        const buscar = crearBuscador(opciones.url, opciones.clave, opciones.limite);
+        let items = [];
+        let activo = -1;
+
+        function ocultar() {
+            resultados.style.display = 'none';
+            activo = -1;
+        }
+
+        function marcarActivo() {
+            Array.from(resultados.children).forEach(function (el, i) {
+                el.style.background = i === activo ? '#f0f0f0' : 'white';
+            });
+        }
+
+        function seleccionar(i) {
+            const item = items[i];
+            if (!item) return;
+            input.value = texto(item);
+            ocultar();
+            opciones.alSeleccionar(item);
+        }
+
+        function pintar(lista) {
+            items = lista;
+            activo = -1;
+            if (!lista.length) {
+                resultados.innerHTML = '<div style="padding: 10px; color: #999; text-align: center;">Sin resultados</div>';
+            } else {
+                resultados.innerHTML = lista.map(function (item, i) {
+                    return '<div class="autocompletar-opcion" data-indice="' + i + '" ' +
+                        'style="padding: 10px; cursor: pointer; border-bottom: 1px solid #eee;">' +
+                        escaparHtml(texto(item)) + '</div>';
+                }).join('');
+            }
+            resultados.style.display = 'block';
+        }
+
+        input.addEventListener('input', function () {
+            const termino = input.value.trim();
+            if (termino.length < minimo) {
+                ocultar();
+                if (termino === '' && opciones.alLimpiar) opciones.alLimpiar();
+                return;
+            }
+            buscar(termino, function (lista) {
+                // Ignorar respuestas que llegan después de que el usuario haya vaciado el campo
+                if (input.value.trim().length >= minimo) pintar(lista);
+            });
+        });
+
+        input.addEventListener('keydown', function (e) {
+            if (resultados.style.display !== 'block' || !items.length) return;
+            if (e.key === 'ArrowDown') {
+                activo = Math.min(activo + 1, items.length - 1);
+                marcarActivo();
+                e.preventDefault();
+            } else if (e.key === 'ArrowUp') {
+                activo = Math.max(activo - 1, 0);
+                marcarActivo();
+                e.preventDefault();
+            } else if (e.key === 'Enter' && activo >= 0) {
+                seleccionar(activo);
+                e.preventDefault();
+            } else if (e.key === 'Escape') {
+                ocultar();
+            }
+        });
+
+        resultados.addEventListener('mousedown', function (e) {
+            const opcion = e.target.closest('.autocompletar-opcion');
+            if (opcion) {
+                e.preventDefault();
+                seleccionar(parseInt(opcion.getAttribute('data-indice'), 10));
+            }
+        });
+
+        resultados.addEventListener('mouseover', function (e) {
+            const opcion = e.target.closest('.autocompletar-opcion');
+            if (opcion) {
+                activo = parseInt(opcion.getAttribute('data-indice'), 10);
+                marcarActivo();
+            }
+        });
+
+        input.addEventListener('blur', function () {
+            setTimeout(ocultar, 150);
+        });
+    }
+
+    /*
+     * Rellenar un <datalist> con las coincidencias del servidor mientras se escribe
+     * en cualquier campo que lo use (delegado en document, sirve para filas añadidas
+     * dinámicamente). Cada <option> lleva data-id y data-precio-venta.
+     */
+    function autocompletarDatalist(selector, datalist, url, clave) {
+        const buscar = crearBuscador(url, clave, 20);
+        document.addEventListener('input', function (e) {
+            if (!e.target.matches || !e.target.matches(selector)) return;
+            const termino = e.target.value.trim();
+            if (!termino) return;
+            // Si el texto ya coincide con una opción no hace falta volver a buscar
+            const existente = Array.from(datalist.options).some(function (o) { return o.value === termino; });
+            if (existente) return;
+            const campo = e.target;
+            buscar(termino, function (lista) {
+                datalist.innerHTML = lista.map(function (item) {
+                    return '<option value="' + escaparHtml(item.nombre) + '" data-id="' + item.id + '"' +
+                        (item.precio_venta !== undefined ? ' data-precio-venta="' + item.precio_venta + '"' : '') +
+                        '>' + escaparHtml(item.nombre) + '</option>';
+                }).join('');
+                // Si el usuario ya ha escrito el nombre exacto, avisar para que se sincronice el id
+                if (lista.some(function (item) { return item.nombre === campo.value.trim(); })) {
+                    campo.dispatchEvent(new Event('change', { bubbles: true }));
+                }
+            });
+        });
+    }
+
+    window.autocompletar = autocompletar;
+    window.autocompletarDatalist = autocompletarDatalist;
+})();
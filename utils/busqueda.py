@@ -0,0 +1,202 @@
+"""Búsqueda de texto completo de clientes con SQLite FTS5
+
+La tabla virtual clientes_fts indexa los campos de búsqueda de clientes (contenido
+externo: no duplica los datos, solo el índice). Se mantiene sincronizada con
+triggers en la propia BD, de modo que también recoge los cambios hechos con SQL
+directo (importaciones, migraciones).
+
+El tokenizador unicode61 con remove_diacritics 2 hace que "garcia" encuentre
+"García"; cada palabra buscada se trata como prefijo ("ayunt" encuentra
+"Ayuntamiento") y los resultados se ordenan por relevancia (bm25).
+
+El índice no encuentra texto en mitad de una palabra ("yuntam" no encuentra
+"Ayuntamiento"). Para el NIF eso no basta: un CIF se suele escribir sin su letra
+("10000003" por "B10000003"), así que si el texto lleva dígitos se busca además
+con LIKE en el NIF.
+"""
+import re
+from sqlalchemy import text
+from extensions import db
+
+TABLA_FTS_CLIENTES = 'clientes_fts'
+
+# Columnas indexadas (en el mismo orden que en la tabla virtual)
+COLUMNAS_FTS_CLIENTES = [
+    'nombre', 'alias', 'nif', 'poblacion', 'provincia',
+    'email', 'email_general', 'email_comunicaciones'
+]
+
+# Peso de cada columna en el ranking bm25 (el nombre y el alias pesan más)
+PESOS_FTS_CLIENTES = [10.0, 8.0, 5.0, 2.0, 1.0, 1.0, 1.0, 1.0]
+
+# None = todavía no comprobado en este proceso
+_fts_disponible = None
+
+
+def _sql_triggers():
+    columnas = ', '.join(COLUMNAS_FTS_CLIENTES)
+    nuevas = ', '.join(f'new.{c}' for c in COLUMNAS_FTS_CLIENTES)
+    antiguas = ', '.join(f'old.{c}' for c in COLUMNAS_FTS_CLIENTES)
+    return {
+        'clientes_fts_ai': f'''
+            CREATE TRIGGER IF NOT EXISTS clientes_fts_ai AFTER INSERT ON clientes BEGIN
+                INSERT INTO {TABLA_FTS_CLIENTES}(rowid, {columnas}) VALUES (new.id, {nuevas});
+            END''',
+        'clientes_fts_ad': f'''
+            CREATE TRIGGER IF NOT EXISTS clientes_fts_ad AFTER DELETE ON clientes BEGIN
+                INSERT INTO {TABLA_FTS_CLIENTES}({TABLA_FTS_CLIENTES}, rowid, {columnas}) VALUES ('delete', old.id, {antiguas});
+            END''',
+        'clientes_fts_au': f'''
+            CREATE TRIGGER IF NOT EXISTS clientes_fts_au AFTER UPDATE ON clientes BEGIN
+                INSERT INTO {TABLA_FTS_CLIENTES}({TABLA_FTS_CLIENTES}, rowid, {columnas}) VALUES ('delete', old.id, {antiguas});
+                INSERT INTO {TABLA_FTS_CLIENTES}(rowid, {columnas}) VALUES (new.id, {nuevas});
+            END''',
+    }
+
+
+def asegurar_indice_clientes(conn):
+    """
+    Crear la tabla FTS de clientes y sus triggers si faltan (idempotente)
+
+    Si la tabla se acaba de crear, o faltaba algún trigger (por ejemplo porque una
+    migración ha recreado la tabla clientes), se reconstruye el índice completo.
+    Devuelve True si se ha reconstruido.
+    """
+    existentes = {
+        fila[0] for fila in conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE 'clientes_fts%'"
+        ))
+    }
+    reconstruir = False
+
+    if TABLA_FTS_CLIENTES not in existentes:
+        conn.execute(text(f'''
+            CREATE VIRTUAL TABLE {TABLA_FTS_CLIENTES} USING fts5(
+                {', '.join(COLUMNAS_FTS_CLIENTES)},
+                content='clientes',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        '''))
+        reconstruir = True
+
+    for nombre, sql in _sql_triggers().items():
+        if nombre not in existentes:
+            conn.execute(text(sql))
+            reconstruir = True
+
+    if reconstruir:
+        conn.execute(text(f"INSERT INTO {TABLA_FTS_CLIENTES}({TABLA_FTS_CLIENTES}) VALUES ('rebuild')"))
+    return reconstruir
+
+
+def fts_disponible():
+    """Comprobar (una vez por proceso) si existe el índice FTS de clientes"""
+    global _fts_disponible
+    if _fts_disponible is None:
+        try:
+            resultado = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :nombre"
+            ), {'nombre': TABLA_FTS_CLIENTES}).fetchone()
+            _fts_disponible = resultado is not None
+        except Exception as e:
+            print(f"Error al comprobar índice FTS de clientes: {e}")
+            _fts_disponible = False
+    return _fts_disponible
+
+
+def reiniciar_estado_fts():
+    """Olvidar la comprobación de disponibilidad (tras sustituir la BD)"""
+    global _fts_disponible
+    _fts_disponible = None
+
+
+def construir_consulta_fts(termino):
+    """
+    Convertir el texto escrito por el usuario en una consulta FTS5 segura
+
+    Cada palabra se entrecomilla (para que caracteres como - o : no se interpreten
+    como operadores) y se marca como prefijo. Todas las palabras deben aparecer.
+    Devuelve None si el texto no contiene ninguna palabra.
+    """
+    palabras = re.findall(r'\w+', termino or '', flags=re.UNICODE)
+    if not palabras:
+        return None
+    return ' '.join(f'"{palabra}"*' for palabra in palabras)
+
+
+def _subconsulta_fts(consulta):
+    pesos = ', '.join(str(p) for p in PESOS_FTS_CLIENTES)
+    return text(
+        f'SELECT rowid AS id, bm25({TABLA_FTS_CLIENTES}, {pesos}) AS rango '
+        f'FROM {TABLA_FTS_CLIENTES} WHERE {TABLA_FTS_CLIENTES} MATCH :consulta'
+    ).bindparams(consulta=consulta).columns(id=db.Integer, rango=db.Float).subquery('clientes_fts_resultado')
+
+
+def _condicion_nif(termino):
+    """LIKE en el NIF si el texto lleva dígitos (None si no): parte de un NIF no es un prefijo"""
+    from models import Cliente
+
+    termino = (termino or '').strip()
+    if not any(caracter.isdigit() for caracter in termino):
+        return None
+    return Cliente.nif.ilike(f'%{termino}%')
+
+
+def filtrar_clientes(query, termino):
+    """
+    Filtrar una consulta de Cliente por el texto de búsqueda
+
+    Usa el índice FTS si está disponible; si no, recurre a las comparaciones LIKE
+    sobre los mismos campos.
+    """
+    from models import Cliente
+
+    consulta = construir_consulta_fts(termino)
+    if consulta and fts_disponible():
+        resultado = _subconsulta_fts(consulta)
+        condicion = Cliente.id.in_(db.select(resultado.c.id))
+        condicion_nif = _condicion_nif(termino)
+        if condicion_nif is not None:
+            condicion = db.or_(condicion, condicion_nif)
+        return query.filter(condicion)
+
+    patron = f'%{termino}%'
+    return query.filter(db.or_(*[
+        getattr(Cliente, columna).ilike(patron) for columna in COLUMNAS_FTS_CLIENTES
+    ]))
+
+
+def buscar_clientes(termino, limite=20, query=None):
+    """
+    Buscar clientes ordenados por relevancia
+
+    Devuelve una lista de objetos Cliente (como máximo limite). query permite
+    partir de una consulta ya filtrada u optimizada con options().
+    """
+    from models import Cliente
+
+    if query is None:
+        query = Cliente.query
+
+    consulta = construir_consulta_fts(termino)
+    if not consulta:
+        return []
+
+    if fts_disponible():
+        resultado = _subconsulta_fts(consulta)
+        condicion_nif = _condicion_nif(termino)
+        if condicion_nif is None:
+            return (query.join(resultado, resultado.c.id == Cliente.id)
+                    .order_by(resultado.c.rango, Cliente.nombre)
+                    .limit(limite)
+                    .all())
+        # Los que contienen el NIF buscado primero; después el resto por relevancia
+        return (query.outerjoin(resultado, resultado.c.id == Cliente.id)
+                .filter(db.or_(resultado.c.id.isnot(None), condicion_nif))
+                .order_by(db.case((condicion_nif, 0), else_=1), resultado.c.rango, Cliente.nombre)
+                .limit(limite)
+                .all())
+
+    return filtrar_clientes(query, termino).order_by(Cliente.nombre).limit(limite).all()
@@ -0,0 +1,134 @@
+"""Cachés en memoria del proceso invalidadas por contadores de versión guardados en la BD
+
+Cada worker de gunicorn mantiene su propia copia de los datos cacheados, pero todos
+comparten la tabla versiones_cache de SQLite. Cuando una escritura incrementa la
+versión de una clave, el resto de workers detectan el cambio en su siguiente lectura
+(una consulta por clave única) y reconstruyen la entrada.
+"""
+import os
+import threading
+from datetime import datetime
+from sqlalchemy import text
+from extensions import db
+
+# Claves de versión usadas en la aplicación
+VERSION_PANEL_SOLICITUDES = 'panel_solicitudes'
+VERSION_COMERCIALES = 'ref_comerciales'
+VERSION_USUARIOS = 'ref_usuarios'
+VERSION_PRENDAS = 'ref_prendas'
+VERSION_CATEGORIAS_CLIENTE = 'ref_categorias_cliente'
+VERSION_PLANTILLAS_EMAIL = 'ref_plantillas_email'
+VERSION_CONFIGURACION = 'ref_configuracion'
+VERSION_DIAS_FESTIVOS = 'ref_dias_festivos'
+VERSION_CLIENTES = 'clientes'
+
+# Registro de todas las cachés creadas (para mostrar estadísticas)
+_caches_registradas = []
+
+
+def obtener_version(clave):
+    """Obtener la versión actual de una clave (0 si todavía no se ha incrementado nunca)"""
+    resultado = db.session.execute(
+        text('SELECT version FROM versiones_cache WHERE clave = :clave'),
+        {'clave': clave}
+    ).fetchone()
+    return resultado[0] if resultado else 0
+
+
+def incrementar_version(clave, conexion=None):
+    """
+    Incrementar la versión de una clave dentro de la transacción actual.
+
+    No hace commit: el incremento se confirma junto con la escritura que lo provoca,
+    de modo que nunca se invalida una caché por un cambio que acaba en rollback.
+    conexion permite hacerlo desde un evento de la sesión (session.connection()).
+    """
+    ejecutor = conexion if conexion is not None else db.session
+    ahora = datetime.utcnow()
+    ejecutor.execute(
+        text('INSERT OR IGNORE INTO versiones_cache (clave, version, fecha_actualizacion) VALUES (:clave, 0, :ahora)'),
+        {'clave': clave, 'ahora': ahora}
+    )
+    ejecutor.execute(
+        text('UPDATE versiones_cache SET version = version + 1, fecha_actualizacion = :ahora WHERE clave = :clave'),
+        {'clave': clave, 'ahora': ahora}
+    )
+
+
+class CacheVersionada:
+    """Caché en memoria cuyas entradas se descartan cuando cambia la versión de su clave en BD"""
+
+    def __init__(self, nombre, clave_version, max_entradas=64):
+        self.nombre = nombre
+        self.clave_version = clave_version
+        self.max_entradas = max_entradas
+        self._entradas = {}
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+        _caches_registradas.append(self)
+
+    def obtener(self, subclave, construir):
+        """
+        Devolver el valor cacheado para subclave o construirlo con construir()
+
+        La versión se lee antes de construir el valor: si otra petición escribe mientras
+        tanto, la entrada queda guardada con la versión antigua y se reconstruye en la
+        siguiente lectura.
+        """
+        try:
+            version = obtener_version(self.clave_version)
+        except Exception as e:
+            # Si la tabla de versiones no está disponible, no cachear
+            print(f"Error al leer versión de caché '{self.clave_version}': {e}")
+            return construir()
+
+        with self._lock:
+            entrada = self._entradas.get(subclave)
+            if entrada is not None and entrada[0] == version:
+                self.aciertos += 1
+                return entrada[1]
+
+        valor = construir()
+
+        with self._lock:
+            self.fallos += 1
+            if entrada is not None:
+                self.invalidaciones += 1
+            if subclave not in self._entradas and len(self._entradas) >= self.max_entradas:
+                # Descartar la entrada más antigua
+                self._entradas.pop(next(iter(self._entradas)))
+            self._entradas[subclave] = (version, valor)
+        return valor
+
+    def limpiar(self):
+        """Vaciar la caché de este proceso"""
+        with self._lock:
+            self._entradas.clear()
+
+    def estadisticas(self):
+        """Estadísticas de aciertos/fallos de este proceso"""
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                'nombre': self.nombre,
+                'clave_version': self.clave_version,
+                'pid': os.getpid(),
+                'entradas': len(self._entradas),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'invalidaciones': self.invalidaciones,
+                'ratio_aciertos': round(self.aciertos / total, 4) if total else 0.0
+            }
+
+
+def limpiar_caches():
+    """Vaciar todas las cachés de este proceso (por ejemplo tras sustituir la BD)"""
+    for cache in _caches_registradas:
+        cache.limpiar()
+
+
+def obtener_estadisticas():
+    """Estadísticas de todas las cachés registradas en este proceso"""
+    return [cache.estadisticas() for cache in _caches_registradas]
@@ -0,0 +1,211 @@
+"""Copias de seguridad automáticas de la base de datos con rotación
+
+Un hilo de cada worker comprueba cada minuto si toca hacer copia, pero solo actúa el
+que tiene el bloqueo del archivo .programador.lock del directorio de copias (líder):
+el bloqueo lo libera el sistema si el proceso muere y otro worker lo toma en su
+siguiente comprobación.
+
+Cada COPIAS_INTERVALO_MINUTOS se copia la BD con la API de backup de SQLite (por pasos, sin
+bloquear a los escritores; ver utils.copias_seguridad), se verifica la copia con
+PRAGMA integrity_check y solo entonces se le da su nombre definitivo. Si la BD no ha
+cambiado desde la última copia no se hace otra.
+
+Se conservan la copia más reciente de cada una de las últimas 24 horas, 7 días y 4
+semanas (RETENCION); el resto se borran. Las copias se listan en /configuracion y se
+restauran con importar_bd_sqlite.
+
+Variables de entorno:
+- COPIAS_AUTOMATICAS: 'true' para activar el programador (por defecto solo en Render).
+- COPIAS_DIR: directorio de las copias (por defecto 'copias' junto a la BD, que en
+  producción está en el disco persistente /data).
+- COPIAS_INTERVALO_MINUTOS: minutos entre copias (60 por defecto).
+"""
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from utils.copias_seguridad import copiar_base_datos, ruta_base_datos
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin gunicorn solo hay un proceso
+    fcntl = None
+
+PREFIJO_COPIA = 'pedidos_'
+FORMATO_FECHA_COPIA = '%Y%m%d_%H%M%S'
+EXTENSION_COPIA = '.db'
+
+# Cada cuánto (segundos) comprueba el hilo si toca hacer copia
+INTERVALO_COMPROBACION = 60
+
+# (nombre, copias que se conservan, formato de fecha que define el periodo)
+RETENCION = (
+    ('hora', 24, '%Y%m%d%H'),
+    ('dia', 7, '%Y%m%d'),
+    ('semana', 4, '%G%V'),
+)
+
+FICHERO_BLOQUEO = '.programador.lock'
+
+_archivo_bloqueo = None
+_hilo = None
+
+
+def intervalo_copias():
+    """Segundos entre copias automáticas"""
+    return int(os.environ.get('COPIAS_INTERVALO_MINUTOS', 60)) * 60
+
+
+def directorio_copias(ruta_bd):
+    """Directorio donde se guardan las copias de la BD indicada"""
+    return os.environ.get('COPIAS_DIR') or os.path.join(os.path.dirname(ruta_bd), 'copias')
+
+
+def listar_copias(directorio):
+    """Copias del directorio, de la más reciente a la más antigua"""
+    if not directorio or not os.path.isdir(directorio):
+        return []
+    copias = []
+    for nombre in os.listdir(directorio):
+        if not (nombre.startswith(PREFIJO_COPIA) and nombre.endswith(EXTENSION_COPIA)):
+            continue
+        try:
+            fecha = datetime.strptime(nombre[len(PREFIJO_COPIA):-len(EXTENSION_COPIA)], FORMATO_FECHA_COPIA)
+        except ValueError:
+            continue
+        ruta = os.path.join(directorio, nombre)
+        copias.append({'nombre': nombre, 'ruta': ruta, 'fecha': fecha, 'tamano': os.path.getsize(ruta)})
+    copias.sort(key=lambda c: c['fecha'], reverse=True)
+    return copias
+
+
+def buscar_copia(directorio, nombre):
+    """Copia con ese nombre (solo las del listado: el nombre viene del formulario) o None"""
+    return next((c for c in listar_copias(directorio) if c['nombre'] == nombre), None)
+
+
+def verificar_copia(ruta):
+    """True si PRAGMA integrity_check no encuentra errores en la BD"""
+    conexion = sqlite3.connect(ruta)
+    try:
+        return [fila[0] for fila in conexion.execute('PRAGMA integrity_check')] == ['ok']
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conexion.close()
+
+
+def crear_copia(origen, directorio):
+    """
+    Copiar la BD en el directorio de copias y verificarla
+
+    Devuelve el nombre de la copia. Si la verificación falla se borra y se lanza ValueError.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    nombre = f'{PREFIJO_COPIA}{datetime.now().strftime(FORMATO_FECHA_COPIA)}{EXTENSION_COPIA}'
+    ruta = os.path.join(directorio, nombre)
+    # Mientras se copia y verifica no tiene la extensión .db: no aparece en el listado
+    ruta_temporal = ruta + '.tmp'
+    try:
+        copiar_base_datos(origen, ruta_temporal)
+        if not verificar_copia(ruta_temporal):
+            raise ValueError(f'La copia {nombre} no ha superado PRAGMA integrity_check')
+        os.replace(ruta_temporal, ruta)
+    finally:
+        if os.path.exists(ruta_temporal):
+            os.remove(ruta_temporal)
+    return nombre
+
+
+def copias_a_conservar(copias):
+    """Nombres de las copias que mantiene la política de RETENCION"""
+    conservar = set()
+    for _, cantidad, formato_periodo in RETENCION:
+        periodos = set()
+        # Las copias vienen de la más reciente a la más antigua: se queda la última de cada periodo
+        for copia in copias:
+            periodo = copia['fecha'].strftime(formato_periodo)
+            if periodo in periodos:
+                continue
+            if len(periodos) == cantidad:
+                break
+            periodos.add(periodo)
+            conservar.add(copia['nombre'])
+    return conservar
+
+
+def rotar_copias(directorio):
+    """Borrar las copias que no conserva la política de retención. Devuelve cuántas se borran"""
+    copias = listar_copias(directorio)
+    conservar = copias_a_conservar(copias)
+    borradas = 0
+    for copia in copias:
+        if copia['nombre'] not in conservar:
+            os.remove(copia['ruta'])
+            borradas += 1
+    return borradas
+
+
+def _ultima_modificacion(ruta_bd):
+    """Última modificación de la BD, contando el WAL si lo hay"""
+    return max(os.path.getmtime(ruta) for ruta in (ruta_bd, ruta_bd + '-wal') if os.path.exists(ruta))
+
+
+def ejecutar_copia_programada(origen, directorio):
+    """Hacer copia si ha pasado el intervalo y la BD ha cambiado desde la última; después rotar"""
+    copias = listar_copias(directorio)
+    if copias:
+        ultima = copias[0]
+        if (datetime.now() - ultima['fecha']).total_seconds() < intervalo_copias():
+            return None
+        if _ultima_modificacion(origen) <= os.path.getmtime(ultima['ruta']):
+            return None
+    nombre = crear_copia(origen, directorio)
+    borradas = rotar_copias(directorio)
+    print(f"[Copias] Copia {nombre} creada y verificada ({borradas} copias antiguas borradas)")
+    return nombre
+
+
+def _es_lider(directorio):
+    """Tomar (o conservar) el bloqueo de líder del programador"""
+    global _archivo_bloqueo
+    if fcntl is None or _archivo_bloqueo is not None:
+        return True
+    os.makedirs(directorio, exist_ok=True)
+    archivo = open(os.path.join(directorio, FICHERO_BLOQUEO), 'a')
+    try:
+        fcntl.flock(archivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        archivo.close()
+        return False
+    _archivo_bloqueo = archivo
+    return True
+
+
+def _bucle_copias(origen, directorio):
+    while True:
+        try:
+            if _es_lider(directorio):
+                ejecutar_copia_programada(origen, directorio)
+        except Exception as e:
+            print(f"[Copias] Error en la copia automática: {e}")
+        time.sleep(INTERVALO_COMPROBACION)
+
+
+def init_copias_programadas(app):
+    """Guardar el directorio de copias en la configuración y arrancar el programador si está activo"""
+    global _hilo
+    with app.app_context():
+        origen = ruta_base_datos()
+    if origen is None:
+        return
+    directorio = directorio_copias(origen)
+    app.config['COPIAS_DIR'] = directorio
+
+    activas = os.environ.get('COPIAS_AUTOMATICAS', os.environ.get('RENDER', 'false')).lower() == 'true'
+    if activas and _hilo is None:
+        _hilo = threading.Thread(target=_bucle_copias, args=(origen, directorio),
+                                 name='copias-programadas', daemon=True)
+        _hilo.start()
+        print(f"[Copias] Copias automáticas cada {intervalo_copias() // 60} min en: {directorio}")
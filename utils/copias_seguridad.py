@@ -0,0 +1,82 @@
+"""Copias consistentes de la base de datos SQLite con la API de backup de sqlite3
+
+Copiar el fichero .db con open().read() mientras otro worker escribe puede dar una
+copia a medias. La API de backup copia las páginas de la BD dentro de una lectura
+consistente: si alguien escribe durante la copia, SQLite la reinicia, así que el
+resultado siempre es una BD válida.
+
+La copia se hace por pasos de PAGINAS_POR_PASO páginas con una pausa entre pasos,
+en la que se libera el bloqueo de lectura: los escritores no esperan más que lo que
+tarda un paso.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+from flask import current_app
+from utils.exportacion import fichero_temporal
+
+# Páginas copiadas en cada paso (con páginas de 4 KB, 1 MB por paso)
+PAGINAS_POR_PASO = 256
+# Pausa entre pasos (segundos) para dejar escribir al resto de conexiones
+PAUSA_ENTRE_PASOS = 0.005
+
+
+def ruta_base_datos():
+    """Ruta del fichero SQLite de la aplicación (None si la BD no es SQLite)"""
+    database_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+    if not database_uri.startswith('sqlite:///'):
+        return None
+    return os.path.normpath(database_uri.replace('sqlite:///', ''))
+
+
+def copiar_base_datos(origen, destino):
+    """Copiar la BD de origen en destino (se sobrescribe) sin bloquear a los escritores"""
+    conexion_origen = sqlite3.connect(origen)
+    try:
+        conexion_destino = sqlite3.connect(destino)
+        try:
+            conexion_origen.backup(conexion_destino, pages=PAGINAS_POR_PASO, sleep=PAUSA_ENTRE_PASOS)
+            # La copia hereda el modo WAL de la BD: se deja en un único archivo para
+            # descargarla, guardarla o restaurarla sin -wal/-shm al lado
+            conexion_destino.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            conexion_destino.close()
+    finally:
+        conexion_origen.close()
+
+
+def comprimir_fichero(origen, destino):
+    """Comprimir un fichero en gzip leyendo por bloques"""
+    with open(origen, 'rb') as entrada, gzip.open(destino, 'wb') as salida:
+        shutil.copyfileobj(entrada, salida)
+
+
+def crear_copia_temporal(comprimir=False):
+    """
+    Copia de la BD de la aplicación en un fichero temporal
+
+    Devuelve la ruta del fichero (.db o .db.gz); quien llama debe borrarlo.
+    """
+    origen = ruta_base_datos()
+    if origen is None or not os.path.exists(origen):
+        raise FileNotFoundError('El archivo de base de datos no existe')
+
+    ruta_copia = fichero_temporal('.db')
+    try:
+        copiar_base_datos(origen, ruta_copia)
+    except Exception:
+        os.remove(ruta_copia)
+        raise
+    if not comprimir:
+        return ruta_copia
+
+    ruta_comprimida = fichero_temporal('.db.gz')
+    try:
+        comprimir_fichero(ruta_copia, ruta_comprimida)
+    except Exception:
+        os.remove(ruta_comprimida)
+        raise
+    finally:
+        os.remove(ruta_copia)
+    return ruta_comprimida
@@ -0,0 +1,198 @@
+"""Datos de referencia cacheados: comerciales, usuarios, prendas, categorías, plantillas, configuración y festivos
+
+Son tablas pequeñas que se consultan en casi todos los formularios pero cambian muy
+de vez en cuando. Cada conjunto se guarda en memoria del proceso y se invalida con
+su contador de versión en la tabla versiones_cache (ver utils/cache.py), de modo que
+todos los workers detectan los cambios.
+
+Las lecturas devuelven instantáneas inmutables (tuplas de namedtuples y
+MappingProxyType), nunca objetos del ORM: se pueden compartir entre peticiones y
+hilos sin riesgo de que una petición modifique lo que ve otra. Las rutas que
+modifican estos datos deben llamar a la función invalidar_* correspondiente antes
+del commit.
+"""
+from collections import namedtuple
+from types import MappingProxyType
+from extensions import db
+from utils.cache import (
+    CacheVersionada, incrementar_version, limpiar_caches,
+    VERSION_COMERCIALES, VERSION_USUARIOS, VERSION_PRENDAS,
+    VERSION_CATEGORIAS_CLIENTE, VERSION_PLANTILLAS_EMAIL, VERSION_CONFIGURACION,
+    VERSION_DIAS_FESTIVOS
+)
+
+ComercialRef = namedtuple('ComercialRef', ['id', 'nombre', 'usuario_id', 'rol', 'activo'])
+UsuarioRef = namedtuple('UsuarioRef', ['id', 'usuario', 'rol', 'correo', 'activo'])
+PrendaRef = namedtuple('PrendaRef', ['id', 'nombre', 'tipo', 'precio_coste', 'precio_venta'])
+CategoriaRef = namedtuple('CategoriaRef', ['id', 'nombre', 'activo'])
+PlantillaRef = namedtuple('PlantillaRef', ['id', 'tipo', 'asunto', 'cuerpo', 'enviar_activo'])
+
+# Roles de usuario que pueden asignarse como comercial de un cliente
+ROLES_COMERCIAL = ('comercial', 'administracion')
+
+_cache_comerciales = CacheVersionada('comerciales', VERSION_COMERCIALES, max_entradas=1)
+_cache_usuarios = CacheVersionada('usuarios', VERSION_USUARIOS, max_entradas=1)
+_cache_prendas = CacheVersionada('prendas', VERSION_PRENDAS, max_entradas=1)
+_cache_categorias = CacheVersionada('categorias_cliente', VERSION_CATEGORIAS_CLIENTE, max_entradas=1)
+_cache_plantillas = CacheVersionada('plantillas_email', VERSION_PLANTILLAS_EMAIL, max_entradas=1)
+_cache_configuracion = CacheVersionada('configuracion', VERSION_CONFIGURACION, max_entradas=1)
+_cache_festivos = CacheVersionada('dias_festivos', VERSION_DIAS_FESTIVOS, max_entradas=1)
+
+
+# ========== LECTURA ==========
+
+def _cargar_comerciales():
+    from models import Comercial, Usuario
+    # Se seleccionan columnas y no objetos: los Comercial que ya estén en la sesión
+    # pueden venir de una consulta con raiseload y no tener cargada la relación usuario
+    filas = db.session.query(
+        Comercial.id, Usuario.usuario, Comercial._nombre, Comercial.usuario_id, Usuario.rol, Usuario.activo
+    ).join(Usuario, Comercial.usuario_id == Usuario.id).order_by(Usuario.usuario).all()
+    return tuple(
+        ComercialRef(id, usuario or nombre or '', usuario_id, rol, bool(activo))
+        for id, usuario, nombre, usuario_id, rol, activo in filas
+    )
+
+
+def obtener_comerciales(solo_asignables=False):
+    """
+    Comerciales con usuario, ordenados por nombre de usuario
+
+    solo_asignables: solo los de usuarios activos con rol comercial o administracion
+    (los que se ofrecen al asignar comercial a un cliente).
+    """
+    comerciales = _cache_comerciales.obtener('todos', _cargar_comerciales)
+    if solo_asignables:
+        return tuple(c for c in comerciales if c.activo and c.rol in ROLES_COMERCIAL)
+    return comerciales
+
+
+def _cargar_usuarios():
+    from models import Usuario
+    return tuple(
+        UsuarioRef(u.id, u.usuario, u.rol, u.correo, bool(u.activo))
+        for u in Usuario.query.order_by(Usuario.usuario).all()
+    )
+
+
+def obtener_usuarios_activos():
+    """Usuarios activos ordenados por nombre de usuario"""
+    return tuple(u for u in _cache_usuarios.obtener('todos', _cargar_usuarios) if u.activo)
+
+
+def _cargar_prendas():
+    from models import Prenda
+    return tuple(
+        PrendaRef(p.id, p.nombre, p.tipo, p.precio_coste, p.precio_venta)
+        for p in Prenda.query.order_by(Prenda.nombre).all()
+    )
+
+
+def obtener_prendas():
+    """Todas las prendas ordenadas por nombre"""
+    return _cache_prendas.obtener('todas', _cargar_prendas)
+
+
+def _cargar_categorias():
+    from models import CategoriaCliente
+    return tuple(
+        CategoriaRef(c.id, c.nombre, bool(c.activo))
+        for c in CategoriaCliente.query.order_by(CategoriaCliente.nombre).all()
+    )
+
+
+def obtener_categorias(solo_activas=True):
+    """Categorías de cliente ordenadas por nombre"""
+    categorias = _cache_categorias.obtener('todas', _cargar_categorias)
+    if solo_activas:
+        return tuple(c for c in categorias if c.activo)
+    return categorias
+
+
+def _cargar_plantillas():
+    from models import PlantillaEmail
+    return MappingProxyType({
+        p.tipo: PlantillaRef(p.id, p.tipo, p.asunto, p.cuerpo, bool(p.enviar_activo))
+        for p in PlantillaEmail.query.all()
+    })
+
+
+def obtener_plantilla_email(tipo):
+    """Plantilla de email guardada en BD para un tipo (None si no existe)"""
+    return _cache_plantillas.obtener('todas', _cargar_plantillas).get(tipo)
+
+
+def _cargar_configuracion():
+    from models import Configuracion
+    return MappingProxyType({c.clave: c.valor for c in Configuracion.query.all()})
+
+
+def obtener_configuracion(clave, defecto=None):
+    """Valor de una clave de configuración (defecto si no existe)"""
+    valor = _cache_configuracion.obtener('todas', _cargar_configuracion).get(clave)
+    return defecto if valor is None else valor
+
+
+def configuracion_activa(clave, defecto=True):
+    """Valor booleano de una clave de configuración guardada como 'true'/'false'"""
+    valor = obtener_configuracion(clave)
+    if valor is None:
+        return defecto
+    return valor.lower() == 'true'
+
+
+def _cargar_festivos():
+    from models import DiaFestivo
+    return frozenset(f for (f,) in db.session.query(DiaFestivo.fecha).filter(DiaFestivo.activo == True))
+
+
+def obtener_fechas_festivas():
+    """Fechas (date) de los días festivos activos"""
+    return _cache_festivos.obtener('activos', _cargar_festivos)
+
+
+# ========== INVALIDACIÓN ==========
+# Se llaman dentro de la transacción de la escritura, antes del commit
+
+def invalidar_comerciales():
+    incrementar_version(VERSION_COMERCIALES)
+
+
+def invalidar_usuarios():
+    """Los comerciales muestran datos del usuario, así que también se invalidan"""
+    incrementar_version(VERSION_USUARIOS)
+    incrementar_version(VERSION_COMERCIALES)
+
+
+def invalidar_prendas():
+    incrementar_version(VERSION_PRENDAS)
+
+
+def invalidar_categorias():
+    incrementar_version(VERSION_CATEGORIAS_CLIENTE)
+
+
+def invalidar_plantillas_email():
+    incrementar_version(VERSION_PLANTILLAS_EMAIL)
+
+
+def invalidar_configuracion():
+    incrementar_version(VERSION_CONFIGURACION)
+
+
+def invalidar_dias_festivos():
+    incrementar_version(VERSION_DIAS_FESTIVOS)
+
+
+def invalidar_todos():
+    """
+    Invalidar todos los datos de referencia (tras importar o sustituir datos en bloque)
+
+    Hace commit: se usa después de operaciones que ya han confirmado sus cambios.
+    """
+    limpiar_caches()
+    for clave in (VERSION_COMERCIALES, VERSION_USUARIOS, VERSION_PRENDAS,
+                  VERSION_CATEGORIAS_CLIENTE, VERSION_PLANTILLAS_EMAIL, VERSION_CONFIGURACION,
+                  VERSION_DIAS_FESTIVOS):
+        incrementar_version(clave)
+    db.session.commit()
@@ -0,0 +1,392 @@
+"""Detección de clientes (y proveedores) duplicados con nombres escritos de otra forma
+
+Comparar solo el NIF exacto y el nombre exacto en mayúsculas deja pasar "BAR PEPE S.L."
+y "BAR PEPE SL" como dos clientes distintos. Aquí se comparan:
+
+1. El NIF/CIF normalizado (sin guiones, espacios, prefijo ES ni ceros iniciales).
+2. La clave del nombre: sin acentos, signos ni espacios y sin la forma jurídica final
+   (SL, SA, S.L.U., SOCIEDAD LIMITADA...). Misma clave = mismo nombre, salvo que los
+   dos tengan NIF y sean distintos ("X SA" y "X SL" pueden ser dos sociedades): eso
+   es solo un posible duplicado.
+3. La similitud de los n-gramas (trigramas) de las palabras del nombre en singular
+   ("CLINICAS DENTALES" = "CLINICA DENTAL"), con el coeficiente de Dice: a partir de
+   UMBRAL_SIMILITUD se considera un posible duplicado, salvo que los nombres lleven
+   números distintos ("TIENDA 1" y "TIENDA 2" son dos tiendas).
+
+Comparar cada nombre con todos los demás sería O(n²). Para llegar al umbral dos nombres
+tienen que compartir un mínimo de trigramas; con los trigramas de cada nombre
+ordenados de más raro a más frecuente (el mismo orden para todos), los dos primeros
+que comparten están entre los primeros de cada uno (filtro de prefijo). El índice
+guarda cada par de esos primeros trigramas (firmas) con los nombres que lo tienen
+(bloques) y la búsqueda solo recorre los bloques de las firmas del nombre buscado.
+Un par de trigramas es mucho más selectivo que un trigrama suelto, pero con nombres
+muy repetidos ("BAR ...") algunos bloques seguirían creciendo: cada bloque guarda
+como máximo MAX_BLOQUE nombres, así que cada búsqueda recorre un número acotado de
+candidatos aunque crezca la lista. Un nombre que solo se parezca a otro por firmas
+de bloques llenos no se encuentra; con nombres parecidos casi siempre hay alguna
+firma rara en común. Solo con los candidatos se calcula la similitud.
+
+El informe de clientes duplicados (/clientes/duplicados) agrupa los clientes que
+parecen el mismo y sugiere cuál conservar: el que tiene más solicitudes y pedidos y,
+a igualdad, el más antiguo. Los grupos se cachean con la versión VERSION_CLIENTES,
+que se incrementa al guardar un cliente nuevo, borrado o con otro nombre o NIF (y en
+las importaciones, que insertan sin pasar por la sesión).
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict, namedtuple
+from functools import lru_cache
+from itertools import combinations
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from extensions import db
+from models import Cliente, Pedido, Presupuesto
+from utils.cache import CacheVersionada, VERSION_CLIENTES, incrementar_version
+
+TAMANO_NGRAMA = 3
+
+# Similitud (coeficiente de Dice de los trigramas) a partir de la que se avisa
+UMBRAL_SIMILITUD = 0.8
+
+# Nombres que se guardan como máximo en el bloque de una firma (par de trigramas)
+MAX_BLOQUE = 60
+
+# Formas jurídicas que se quitan del final del nombre (ya sin puntos ni espacios)
+FORMAS_JURIDICAS = {
+    'SL', 'SA', 'SLU', 'SAU', 'SLL', 'SLP', 'SLNE', 'SC', 'SCP', 'CB', 'SCOOP', 'COOP', 'SCCL', 'SCL',
+}
+FORMAS_JURIDICAS_PALABRAS = (
+    ('SOCIEDAD', 'LIMITADA'),
+    ('SOCIEDAD', 'ANONIMA'),
+    ('SOCIEDAD', 'COOPERATIVA'),
+    ('COMUNIDAD', 'DE', 'BIENES'),
+    ('SOCIEDAD', 'CIVIL'),
+)
+
+# Atributos de Cliente que cambian el informe de duplicados
+ATRIBUTOS_DUPLICADOS = ('nombre', 'nif')
+
+# Grupos de agrupar_duplicados() de los clientes, por umbral
+_cache_grupos = CacheVersionada('clientes_duplicados', VERSION_CLIENTES, max_entradas=4)
+
+# referencia: id del registro en la BD (None para filas de un archivo que se importa)
+Registro = namedtuple('Registro', ['referencia', 'nombre', 'nif'])
+# tipo: 'nif', 'nombre' (nombre equivalente) o 'similar'
+Coincidencia = namedtuple('Coincidencia', ['tipo', 'registro', 'similitud'])
+
+
+def normalizar_nif(nif):
+    """NIF/CIF sin signos ni espacios, en mayúsculas, sin el prefijo de IVA ES ni ceros a la izquierda"""
+    if not nif:
+        return None
+    nif = re.sub(r'[^A-Z0-9]', '', str(nif).upper())
+    if len(nif) == 11 and nif.startswith('ES'):
+        nif = nif[2:]
+    # Un DNI se escribe a veces sin su cero inicial ("9190016S" = "09190016S")
+    return nif.lstrip('0') or None
+
+
+def _quitar_forma_juridica(palabras):
+    # Letras sueltas al final ("S L" de "S. L.") forman una sigla
+    inicio = len(palabras)
+    while inicio > 0 and len(palabras[inicio - 1]) == 1:
+        inicio -= 1
+    if len(palabras) - inicio > 1:
+        palabras = palabras[:inicio] + [''.join(palabras[inicio:])]
+
+    cambiado = True
+    while cambiado and len(palabras) > 1:
+        cambiado = False
+        if palabras[-1] in FORMAS_JURIDICAS:
+            palabras = palabras[:-1]
+            cambiado = True
+            continue
+        for forma in FORMAS_JURIDICAS_PALABRAS:
+            if len(palabras) > len(forma) and tuple(palabras[-len(forma):]) == forma:
+                palabras = palabras[:-len(forma)]
+                cambiado = True
+                break
+    return palabras
+
+
+def palabras_nombre(nombre):
+    """Palabras del nombre en mayúsculas, sin acentos, signos ni forma jurídica final"""
+    if not nombre:
+        return []
+    texto = unicodedata.normalize('NFKD', str(nombre).upper())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    # "S.L." -> "SL"; "&" cuenta como "Y"
+    texto = texto.replace('.', '').replace('&', ' Y ')
+    return _quitar_forma_juridica(re.findall(r'[A-Z0-9]+', texto))
+
+
+def _singular(palabra):
+    # Plurales regulares: DENTALES -> DENTAL, TALLERES -> TALLER, CLINICAS -> CLINICA
+    if len(palabra) > 4 and palabra.endswith('ES') and palabra[-3] in 'LRNDZ':
+        return palabra[:-2]
+    if len(palabra) > 3 and palabra.endswith('S'):
+        return palabra[:-1]
+    return palabra
+
+
+def ngramas(palabras):
+    """Trigramas de las palabras en singular, con marcas de inicio y fin de palabra"""
+    texto = '#' + '#'.join(_singular(palabra) for palabra in palabras) + '#'
+    if len(texto) <= TAMANO_NGRAMA:
+        return {texto}
+    return {texto[i:i + TAMANO_NGRAMA] for i in range(len(texto) - TAMANO_NGRAMA + 1)}
+
+
+def _numeros(nombre):
+    """Números que aparecen en el nombre (sin ceros a la izquierda)"""
+    return tuple(sorted(numero.lstrip('0') or '0' for numero in re.findall(r'[0-9]+', str(nombre or ''))))
+
+
+@lru_cache(maxsize=65536)
+def analizar_nombre(nombre):
+    """(clave, trigramas, números) del nombre; la clave es '' si no tiene letras ni números"""
+    palabras = palabras_nombre(nombre)
+    return ''.join(palabras), frozenset(ngramas(palabras)), _numeros(nombre)
+
+
+def frecuencias_ngramas(nombres):
+    """En cuántos nombres aparece cada trigrama (define qué trigramas son raros)"""
+    frecuencias = Counter()
+    for nombre in nombres:
+        frecuencias.update(analizar_nombre(nombre)[1])
+    return frecuencias
+
+
+def similitud(ngramas_a, ngramas_b):
+    """Coeficiente de Dice entre dos conjuntos de n-gramas (0 a 1)"""
+    if not ngramas_a or not ngramas_b:
+        return 0.0
+    return 2 * len(ngramas_a & ngramas_b) / (len(ngramas_a) + len(ngramas_b))
+
+
+class IndiceDuplicados:
+    """
+    Índice de NIF, claves de nombre y trigramas para buscar duplicados sin comparar todos con todos
+
+    frecuencias (frecuencias_ngramas de los nombres que se van a indexar) solo afecta a
+    la velocidad: sin ellas se usa el orden alfabético y los bloques son más grandes.
+    """
+
+    def __init__(self, umbral=UMBRAL_SIMILITUD, frecuencias=None):
+        self.umbral = umbral
+        self._frecuencias = frecuencias if frecuencias is not None else Counter()
+        self._por_nif = {}
+        self._por_clave = {}
+        self._bloques = defaultdict(list)  # par de trigramas -> posiciones en _registros
+        self._registros = []
+        self._ngramas = []
+        self._numeros = []
+
+    def __len__(self):
+        return len(self._registros)
+
+    def agregar(self, referencia, nombre, nif=None):
+        """Añadir un registro al índice"""
+        registro = Registro(referencia, nombre, nif)
+        nif = normalizar_nif(nif)
+        if nif:
+            self._por_nif.setdefault(nif, registro)
+        clave, conjunto, numeros = analizar_nombre(nombre)
+        if not clave:
+            return
+        if clave in self._por_clave:
+            # Un nombre equivalente ya está indexado: basta con encontrar el primero
+            return
+        self._por_clave[clave] = registro
+        posicion = len(self._registros)
+        self._registros.append(registro)
+        self._ngramas.append(conjunto)
+        self._numeros.append(numeros)
+        for firma in self._firmas(conjunto):
+            bloque = self._bloques[firma]
+            if len(bloque) < MAX_BLOQUE:
+                bloque.append(posicion)
+
+    def buscar(self, nombre, nif=None):
+        """
+        Registro del índice que parece el mismo: devuelve una Coincidencia o None
+
+        Por orden: mismo NIF/CIF, mismo nombre normalizado o nombre parecido (el de
+        mayor similitud a partir del umbral). El mismo nombre con otro NIF es solo
+        parecido ('similar').
+        """
+        nif = normalizar_nif(nif)
+        if nif and nif in self._por_nif:
+            return Coincidencia('nif', self._por_nif[nif], 1.0)
+        clave, conjunto, numeros = analizar_nombre(nombre)
+        if not clave:
+            return None
+        if clave in self._por_clave:
+            registro = self._por_clave[clave]
+            nif_registro = normalizar_nif(registro.nif)
+            if nif and nif_registro and nif != nif_registro:
+                return Coincidencia('similar', registro, similitud(conjunto, analizar_nombre(registro.nombre)[1]))
+            return Coincidencia('nombre', registro, 1.0)
+        return self._mas_parecido(conjunto, numeros)
+
+    def _firmas(self, conjunto):
+        """
+        Pares de trigramas del prefijo del conjunto en el orden global (de más raro a más frecuente)
+
+        Con similitud >= umbral dos conjuntos comparten al menos c = umbral / (2 - umbral)
+        de los trigramas del menor. Sus dos primeros trigramas comunes están entre los
+        len - c + 2 primeros de cada uno, así que ambos tienen ese par entre sus firmas.
+        Un par es mucho más selectivo que un trigrama suelto: los trigramas son pocos
+        miles y sus bloques crecerían con el número de nombres.
+        """
+        # Orden alfabético y después por frecuencia (sorted es estable): orden total fijo
+        ordenados = sorted(sorted(conjunto), key=self._frecuencias.__getitem__)
+        if len(ordenados) < 2:
+            # Un solo trigrama: solo puede parecerse a otro nombre con ese mismo trigrama
+            return ordenados
+        # El margen evita que el redondeo de la división deje el mínimo una unidad por encima
+        comunes_minimos = math.ceil(self.umbral * len(conjunto) / (2 - self.umbral) - 1e-9)
+        # Cada par como una sola cadena de 6 letras: ocupa menos que una tupla y el recolector
+        # de basura no la recorre (el índice llega a millones de firmas)
+        return [a + b for a, b in combinations(ordenados[:len(conjunto) - comunes_minimos + 2], 2)]
+
+    def _mas_parecido(self, buscados, numeros):
+        # Longitudes compatibles con el umbral (Dice no puede llegar con tamaños muy
+        # distintos), con el mismo margen de redondeo que en _firmas
+        tamano = len(buscados)
+        minimo = tamano * self.umbral / (2 - self.umbral) - 1e-9
+        maximo = tamano * (2 - self.umbral) / self.umbral + 1e-9
+
+        vistos = set()
+        mejor = None
+        mejor_valor = self.umbral
+        for firma in self._firmas(buscados):
+            for posicion in self._bloques.get(firma, ()):
+                if posicion in vistos:
+                    continue
+                vistos.add(posicion)
+                otros = self._ngramas[posicion]
+                if not minimo <= len(otros) <= maximo or self._numeros[posicion] != numeros:
+                    continue
+                # Coeficiente de Dice (similitud()) sin la llamada, que aquí se repite mucho
+                valor = 2 * len(buscados & otros) / (tamano + len(otros))
+                if valor >= mejor_valor and (mejor is None or valor > mejor_valor):
+                    mejor = Coincidencia('similar', self._registros[posicion], valor)
+                    mejor_valor = valor
+        return mejor
+
+
+# ========== INFORME DE DUPLICADOS ==========
+
+def agrupar_duplicados(registros, umbral=UMBRAL_SIMILITUD):
+    """
+    Agrupar los registros (referencia, nombre, nif) que parecen el mismo
+
+    Cada registro se busca en el índice de los anteriores y después se añade, así que
+    cada pareja se encuentra una sola vez. Las parejas se unen en grupos (si A se parece
+    a B y B a C, los tres van juntos). Devuelve una lista de grupos; cada grupo es un
+    diccionario referencia -> Coincidencia (None para el primero del grupo).
+    """
+    registros = list(registros)
+    indice = IndiceDuplicados(umbral, frecuencias_ngramas(nombre for _, nombre, _ in registros))
+    padres = {}
+    coincidencias = {}
+
+    def raiz(referencia):
+        while padres[referencia] != referencia:
+            padres[referencia] = padres[padres[referencia]]
+            referencia = padres[referencia]
+        return referencia
+
+    for referencia, nombre, nif in registros:
+        padres[referencia] = referencia
+        coincidencia = indice.buscar(nombre, nif)
+        if coincidencia:
+            coincidencias[referencia] = coincidencia
+            padres[raiz(referencia)] = raiz(coincidencia.registro.referencia)
+        indice.agregar(referencia, nombre, nif)
+
+    grupos = defaultdict(dict)
+    for referencia in coincidencias:
+        grupo = grupos[raiz(referencia)]
+        grupo[referencia] = coincidencias[referencia]
+        otra = coincidencias[referencia].registro.referencia
+        grupo.setdefault(otra, coincidencias.get(otra))
+    return list(grupos.values())
+
+
+def _documentos_por_cliente(ids):
+    """Solicitudes (presupuestos) y pedidos de cada cliente: {id: cantidad}"""
+    documentos = Counter()
+    for modelo in (Presupuesto, Pedido):
+        consulta = (select(modelo.cliente_id, func.count(modelo.id))
+                    .where(modelo.cliente_id.in_(ids))
+                    .group_by(modelo.cliente_id))
+        for cliente_id, cantidad in db.session.execute(consulta):
+            documentos[cliente_id] += cantidad
+    return documentos
+
+
+def _agrupar_clientes(umbral):
+    registros = db.session.execute(select(Cliente.id, Cliente.nombre, Cliente.nif).order_by(Cliente.id))
+    return agrupar_duplicados(registros, umbral)
+
+
+def informe_clientes_duplicados(umbral=UMBRAL_SIMILITUD):
+    """
+    Grupos de clientes que parecen el mismo, con la sugerencia de cuál conservar
+
+    Cada grupo es un diccionario con 'clientes' (lista de diccionarios cliente,
+    coincidencia y documentos, el sugerido primero), 'conservar' (el cliente
+    sugerido) y 'tipo' (la coincidencia más fuerte del grupo).
+    """
+    grupos = _cache_grupos.obtener(umbral, lambda: _agrupar_clientes(umbral))
+    if not grupos:
+        return []
+
+    ids = [cliente_id for grupo in grupos for cliente_id in grupo]
+    clientes = {cliente.id: cliente for cliente in Cliente.query.filter(Cliente.id.in_(ids)).all()}
+    documentos = _documentos_por_cliente(ids)
+
+    informe = []
+    for grupo in grupos:
+        # Un cliente borrado justo después de leer la caché ya no está en clientes
+        filas = [
+            {'cliente': clientes[cliente_id], 'coincidencia': coincidencia, 'documentos': documentos[cliente_id]}
+            for cliente_id, coincidencia in grupo.items() if cliente_id in clientes
+        ]
+        if len(filas) < 2:
+            continue
+        filas.sort(key=lambda fila: (-fila['documentos'], fila['cliente'].id))
+        tipos = {fila['coincidencia'].tipo for fila in filas if fila['coincidencia']}
+        informe.append({
+            'clientes': filas,
+            'conservar': filas[0]['cliente'],
+            'tipo': next(tipo for tipo in ('nif', 'nombre', 'similar') if tipo in tipos),
+        })
+    # Primero las coincidencias seguras (NIF, nombre equivalente) y los grupos grandes
+    orden_tipo = {'nif': 0, 'nombre': 1, 'similar': 2}
+    informe.sort(key=lambda grupo: (orden_tipo[grupo['tipo']], -len(grupo['clientes']), grupo['conservar'].nombre or ''))
+    return informe
+
+
+# ========== INVALIDACIÓN DE LA CACHÉ ==========
+
+def _cambia_duplicados(obj):
+    estado = inspect(obj)
+    return any(estado.attrs[atributo].history.has_changes() for atributo in ATRIBUTOS_DUPLICADOS)
+
+
+def _antes_de_flush(session, contexto, instancias):
+    # Aquí todavía se ve qué atributos cambian; el incremento se confirma con el flush
+    if (any(isinstance(obj, Cliente) for obj in session.new)
+            or any(isinstance(obj, Cliente) for obj in session.deleted)
+            or any(isinstance(obj, Cliente) and _cambia_duplicados(obj) for obj in session.dirty)):
+        incrementar_version(VERSION_CLIENTES, session.connection())
+
+
+def init_duplicados():
+    """Registrar el evento que invalida el informe de duplicados al guardar clientes"""
+    if not event.contains(Session, 'before_flush', _antes_de_flush):
+        event.listen(Session, 'before_flush', _antes_de_flush)
@@ -2,7 +2,8 @@
 from flask import current_app, render_template
 from flask_mail import Message
 from extensions import mail
-from models import PlantillaEmail, Cliente
+from models import Cliente
+from utils.datos_referencia import obtener_plantilla_email
 from datetime import datetime
 from decimal import Decimal
 import os
@@ -10,7 +11,7 @@ from io import BytesIO
 
 def obtener_plantilla(tipo):
     """Obtener plantilla de email por tipo"""
-    plantilla = PlantillaEmail.query.filter_by(tipo=tipo).first()
+    plantilla = obtener_plantilla_email(tipo)
     if not plantilla:
         # Plantillas por defecto si no existen en BD
         plantillas_defecto = {
@@ -182,7 +183,7 @@ def enviar_email_cambio_estado_solicitud(solicitud, nuevo_estado, subestado=None
             plantilla = obtener_plantilla(tipo_plantilla)
             # Si existe plantilla específica del subestado, usarla
             if plantilla and plantilla.get('asunto'):
-                plantilla_db = PlantillaEmail.query.filter_by(tipo=tipo_plantilla).first()
+                plantilla_db = obtener_plantilla_email(tipo_plantilla)
                 if plantilla_db and not plantilla_db.enviar_activo:
                     print(f"DEBUG: Plantilla {tipo_plantilla} está desactivada")
                     return False, f'La plantilla para el subestado {subestado} está desactivada'
@@ -202,7 +203,7 @@ def enviar_email_cambio_estado_solicitud(solicitud, nuevo_estado, subestado=None
             return False, f'No hay plantilla configurada para el estado {nuevo_estado}'
         
         # Verificar si la plantilla está activa
-        plantilla_db = PlantillaEmail.query.filter_by(tipo=tipo_plantilla).first()
+        plantilla_db = obtener_plantilla_email(tipo_plantilla)
         if plantilla_db and not plantilla_db.enviar_activo:
             print(f"DEBUG: Plantilla {tipo_plantilla} está desactivada")
             return False, f'La plantilla para {nuevo_estado} está desactivada'
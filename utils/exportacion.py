@@ -0,0 +1,199 @@
+"""Exportación de listados e informes a CSV y Excel sin cargar el resultado en memoria
+
+Las filas se leen de la BD por lotes (yield_per) y se escriben según llegan:
+- CSV: la respuesta es un generador, cada fila se envía al cliente al escribirse.
+- XLSX: openpyxl en modo write_only escribe las filas en disco a medida que se
+  añaden; el fichero temporal se envía por bloques y se borra al cerrar la respuesta.
+
+Así el consumo de memoria no depende del número de filas exportadas. Las rutas de
+exportación reutilizan los filtros del listado o informe (los mismos parámetros
+GET) y pasan a respuesta_exportacion() una consulta de columnas, no de objetos.
+"""
+import csv
+import io
+import os
+import tempfile
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from flask import Response, request, stream_with_context, url_for
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+FORMATO_CSV = 'csv'
+FORMATO_XLSX = 'xlsx'
+FORMATOS_EXPORTACION = (FORMATO_CSV, FORMATO_XLSX)
+
+# Filas leídas de la BD en cada lote
+TAMANO_LOTE = 500
+
+# Parámetros de la paginación que no se pasan a la exportación (se exporta todo)
+PARAMETROS_PAGINACION = ('cursor', 'dir', 'por_pagina', 'total')
+
+TIPOS_MIME = {
+    FORMATO_CSV: 'text/csv; charset=utf-8',
+    FORMATO_XLSX: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+TAMANO_BLOQUE_ENVIO = 64 * 1024
+
+# wbits de zlib para escribir cabecera y cola gzip (16 + tamaño de ventana)
+WBITS_GZIP = 16 + zlib.MAX_WBITS
+
+
+def formato_desde_request():
+    """Formato pedido en ?formato= (CSV por defecto)"""
+    formato = request.args.get('formato', FORMATO_CSV).lower()
+    return formato if formato in FORMATOS_EXPORTACION else FORMATO_CSV
+
+
+def url_exportacion(endpoint, formato):
+    """URL de exportación con los filtros de la petición actual (sin los de paginación)"""
+    argumentos = {
+        clave: valor for clave, valor in request.args.items()
+        if clave not in PARAMETROS_PAGINACION and clave != 'formato'
+    }
+    return url_for(endpoint, formato=formato, **argumentos)
+
+
+def filas_consulta(consulta, convertir=None):
+    """
+    Recorrer una consulta por lotes de TAMANO_LOTE filas
+
+    convertir: función opcional que transforma cada fila en la tupla a exportar.
+    """
+    for fila in consulta.yield_per(TAMANO_LOTE):
+        yield convertir(fila) if convertir else tuple(fila)
+
+
+def _valor_csv(valor):
+    """Texto de una celda CSV: fechas dd/mm/aaaa y decimales con coma (Excel en español)"""
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.strftime('%d/%m/%Y %H:%M')
+    if isinstance(valor, date):
+        return valor.strftime('%d/%m/%Y')
+    if isinstance(valor, (Decimal, float)):
+        return f'{valor:.2f}'.replace('.', ',')
+    return str(valor)
+
+
+def _generar_csv(columnas, filas):
+    """Generador del CSV: cabecera y filas separadas por ';' (con BOM para que Excel lea UTF-8)"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=';')
+
+    def volcar():
+        texto = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return texto
+
+    escritor.writerow(columnas)
+    yield '\ufeff' + volcar()
+    for fila in filas:
+        escritor.writerow([_valor_csv(v) for v in fila])
+        yield volcar()
+
+
+def _valor_xlsx(valor):
+    """Las fechas y números se guardan con su tipo; los Decimal como float"""
+    if isinstance(valor, Decimal):
+        return float(valor)
+    return valor
+
+
+def _escribir_xlsx(ruta, titulo, columnas, filas):
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet(title=titulo[:31])
+    cabecera = []
+    for nombre in columnas:
+        celda = WriteOnlyCell(hoja, value=nombre)
+        celda.font = Font(bold=True)
+        cabecera.append(celda)
+    hoja.append(cabecera)
+    for fila in filas:
+        hoja.append([_valor_xlsx(v) for v in fila])
+    libro.save(ruta)
+
+
+def comprimir_gzip(bloques, nivel=6):
+    """
+    Comprimir en gzip un generador de bloques de bytes según se van produciendo
+
+    Devuelve los bloques comprimidos (agrupados hasta TAMANO_BLOQUE_ENVIO) sin tener
+    nunca el contenido completo en memoria.
+    """
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, WBITS_GZIP)
+    pendiente = bytearray()
+    for bloque in bloques:
+        pendiente += compresor.compress(bloque)
+        if len(pendiente) >= TAMANO_BLOQUE_ENVIO:
+            yield bytes(pendiente)
+            pendiente.clear()
+    pendiente += compresor.flush()
+    if pendiente:
+        yield bytes(pendiente)
+
+
+def _leer_por_bloques(ruta):
+    with open(ruta, 'rb') as archivo:
+        while True:
+            bloque = archivo.read(TAMANO_BLOQUE_ENVIO)
+            if not bloque:
+                break
+            yield bloque
+
+
+def _borrar_si_existe(ruta):
+    if os.path.exists(ruta):
+        os.remove(ruta)
+
+
+def respuesta_fichero_temporal(ruta, nombre_fichero, mimetype):
+    """
+    Enviar un fichero temporal por bloques y borrarlo al cerrar la respuesta
+
+    Se borra también si el cliente corta la descarga.
+    """
+    respuesta = Response(_leer_por_bloques(ruta), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{nombre_fichero}"',
+        'Content-Length': str(os.path.getsize(ruta)),
+    })
+    respuesta.call_on_close(lambda: _borrar_si_existe(ruta))
+    return respuesta
+
+
+def fichero_temporal(sufijo):
+    """Ruta de un fichero temporal vacío (quien lo crea debe borrarlo o enviarlo)"""
+    descriptor, ruta = tempfile.mkstemp(suffix=sufijo)
+    os.close(descriptor)
+    return ruta
+
+
+def respuesta_exportacion(nombre, columnas, filas, formato=None):
+    """
+    Respuesta de descarga con las filas en CSV o XLSX
+
+    nombre: base del nombre del fichero (se añaden la fecha y la extensión).
+    columnas: títulos de las columnas.
+    filas: iterable de tuplas, normalmente filas_consulta(...), que se consume al
+    escribir el fichero (nunca se guarda entero en una lista).
+    """
+    formato = formato or formato_desde_request()
+    nombre_fichero = f"{nombre}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}"
+
+    if formato == FORMATO_XLSX:
+        ruta = fichero_temporal('.xlsx')
+        try:
+            _escribir_xlsx(ruta, nombre, columnas, filas)
+        except Exception:
+            os.remove(ruta)
+            raise
+        return respuesta_fichero_temporal(ruta, nombre_fichero, TIPOS_MIME[FORMATO_XLSX])
+
+    # El generador lee de la BD mientras se envía: necesita el contexto de la petición
+    return Response(stream_with_context(_generar_csv(columnas, filas)), mimetype=TIPOS_MIME[FORMATO_CSV],
+                    headers={'Content-Disposition': f'attachment; filename="{nombre_fichero}"'})
@@ -2,9 +2,13 @@
 from datetime import date, timedelta
 from flask import current_app
 from extensions import db
-from models import DiaFestivo, Configuracion
+from models import Configuracion
+from utils.datos_referencia import obtener_fechas_festivas
 
-def es_dia_festivo(fecha, excluir_sabados=None, excluir_domingos=None):
+# Nombres de los meses (índice 1-12)
+MESES = ['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
+
+def es_dia_festivo(fecha, excluir_sabados=None, excluir_domingos=None, festivos=None):
     """
     Verificar si una fecha es día festivo o no laborable
     
@@ -12,6 +16,7 @@ def es_dia_festivo(fecha, excluir_sabados=None, excluir_domingos=None):
         fecha: objeto date a verificar
         excluir_sabados: si se deben excluir sábados (None para obtener de BD, True por defecto)
         excluir_domingos: si se deben excluir domingos (None para obtener de BD, True por defecto)
+        festivos: conjunto de fechas festivas ya obtenido (None para leerlo de la caché)
     
     Returns:
         True si es día festivo/no laborable, False en caso contrario
@@ -35,8 +40,9 @@ def es_dia_festivo(fecha, excluir_sabados=None, excluir_domingos=None):
     
     # Verificar si está en la lista de días festivos activos
     try:
-        dia_festivo = DiaFestivo.query.filter_by(fecha=fecha, activo=True).first()
-        if dia_festivo:
+        if festivos is None:
+            festivos = obtener_fechas_festivas()
+        if fecha in festivos:
             return True
     except Exception as e:
         print(f"Error al verificar día festivo {fecha}: {e}")
@@ -59,12 +65,18 @@ def calcular_fecha_saltando_festivos(fecha_inicio, dias_habiles):
     dias_sumados = 0
     max_iteraciones = dias_habiles * 3  # Límite de seguridad (máximo 3 veces los días hábiles)
     iteraciones = 0
+    # Los festivos se leen una vez para todo el cálculo y no una consulta por día
+    try:
+        festivos = obtener_fechas_festivas()
+    except Exception as e:
+        print(f"Error al obtener días festivos: {e}")
+        festivos = frozenset()
     
     while dias_sumados < dias_habiles and iteraciones < max_iteraciones:
         fecha_actual += timedelta(days=1)
         iteraciones += 1
         # Si no es día festivo, contar como día hábil
-        if not es_dia_festivo(fecha_actual):
+        if not es_dia_festivo(fecha_actual, festivos=festivos):
             dias_sumados += 1
     
     if iteraciones >= max_iteraciones:
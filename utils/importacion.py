@@ -0,0 +1,329 @@
+"""Motor de importación masiva de clientes y proveedores desde Excel
+
+El libro se abre en modo read_only y las filas se leen como tuplas de valores
+(values_only), sin crear objetos Cell ni cargar la hoja entera.
+
+Los NIF/CIF y nombres que ya existen en la BD se cargan una vez en un índice de
+duplicados (utils.duplicados), así que comprobar si una fila está duplicada no hace
+ninguna consulta. Se omiten las filas con el mismo NIF/CIF o el mismo nombre
+normalizado ("BAR PEPE S.L." = "BAR PEPE SL"); las de nombre parecido se importan y
+se avisan en el informe como posibles duplicados. Las filas aceptadas se añaden al
+índice para detectar también los duplicados dentro del propio archivo.
+
+Las filas se procesan en lotes de TAMANO_LOTE_IMPORTACION filas del Excel: las válidas
+se insertan con bulk_insert_mappings y cada lote se confirma por separado. Si un lote
+falla, sus filas se insertan una a una para localizar las que dan error.
+
+Cada lote queda identificado por su última fila. procesar_excel() puede empezar después
+de una fila dada y llamar a al_confirmar(ultima_fila) dentro de la transacción del
+lote, antes del commit: así quien guarda el progreso (utils.trabajos_importacion) lo
+confirma junto con las filas insertadas y una importación interrumpida se reanuda
+justo después del último lote confirmado, sin repetir ni perder filas.
+
+El resultado incluye un informe por fila (número de fila del Excel) de los duplicados
+omitidos y de las filas con error.
+"""
+from collections import namedtuple
+from datetime import datetime
+from openpyxl import load_workbook
+from sqlalchemy import select
+from extensions import db
+from models import Cliente, Proveedor
+from utils.cache import VERSION_CLIENTES, incrementar_version
+from utils.duplicados import IndiceDuplicados, frecuencias_ngramas
+
+# Filas insertadas (y confirmadas) en cada lote
+TAMANO_LOTE_IMPORTACION = 1000
+
+# Incidencias que se guardan para el informe (los contadores incluyen todas)
+MAX_INCIDENCIAS = 500
+
+CAMPOS_EMAIL = ('email', 'correo')
+
+# nombre: para los mensajes; campo_fiscal: NIF/CIF con el que se detectan duplicados;
+# columna_obligatoria: título que se muestra si falta la columna del nombre;
+# mapear_columnas: cabecera -> {campo: índice}; preparar: valores -> fila a insertar
+TipoImportacion = namedtuple('TipoImportacion', [
+    'nombre', 'modelo', 'campo_fiscal', 'columna_obligatoria', 'mapear_columnas', 'preparar'
+])
+
+
+# ========== COLUMNAS ==========
+
+def _columnas_clientes(cabecera):
+    """Mapeo de columnas del Excel de clientes a campos de la base de datos"""
+    column_map = {}
+    for idx, header in enumerate(cabecera):
+        if header and header.strip():
+            header_upper = header.upper()
+            if 'NOMBRE FISCAL' in header_upper or ('NOMBRE' in header_upper and 'FISCAL' in header_upper):
+                column_map['nombre'] = idx
+            elif 'ALIAS' in header_upper:
+                column_map['alias'] = idx
+            elif ('TEL' in header_upper or 'TELEFONO' in header_upper) and 'MOVIL' not in header_upper:
+                column_map['telefono'] = idx
+            elif 'MOVIL' in header_upper or ('M' in header_upper and 'VIL' in header_upper):
+                column_map['movil'] = idx
+            elif 'E-MAIL' in header_upper or 'EMAIL' in header_upper:
+                column_map['email'] = idx
+            elif 'PERSONA' in header_upper and 'CONTACTO' in header_upper:
+                column_map['personas_contacto'] = idx
+            elif 'N.I.F' in header_upper or ('NIF' in header_upper and '.' in header):
+                column_map['nif'] = idx
+            elif 'DOMICILIO' in header_upper or 'DIRECCION' in header_upper:
+                column_map['direccion'] = idx
+            elif 'POBLACI' in header_upper:
+                column_map['poblacion'] = idx
+            elif ('C' in header_upper or 'COD' in header_upper) and 'POSTAL' in header_upper:
+                column_map['codigo_postal'] = idx
+            elif 'PROVINCIA' in header_upper:
+                column_map['provincia'] = idx
+            elif 'ANOTACIONES' in header_upper:
+                column_map['anotaciones'] = idx
+    return column_map
+
+
+def _columnas_proveedores(cabecera):
+    """Mapeo de columnas del Excel de proveedores a campos de la base de datos"""
+    column_map = {}
+    for idx, header in enumerate(cabecera):
+        if header and header.strip():
+            header_upper = header.upper()
+            if 'NOMBRE' in header_upper and 'FISCAL' not in header_upper:
+                column_map['nombre'] = idx
+            elif 'CIF' in header_upper or 'NIF' in header_upper:
+                column_map['cif'] = idx
+            elif ('TEL' in header_upper or 'TELEFONO' in header_upper) and 'MOVIL' not in header_upper:
+                column_map['telefono'] = idx
+            elif 'MOVIL' in header_upper or ('M' in header_upper and 'VIL' in header_upper):
+                column_map['movil'] = idx
+            elif 'E-MAIL' in header_upper or 'EMAIL' in header_upper or 'CORREO' in header_upper:
+                column_map['correo'] = idx
+            elif 'PERSONA' in header_upper and 'CONTACTO' in header_upper:
+                column_map['persona_contacto'] = idx
+    return column_map
+
+
+def _preparar_cliente(valores):
+    fila = dict(valores)
+    if fila.get('email'):
+        fila['email'] = fila['email'].lower()
+    fila['pais'] = 'España'
+    fila['fecha_alta'] = datetime.now().date()
+    return fila
+
+
+def _preparar_proveedor(valores):
+    fila = dict(valores)
+    if fila.get('correo'):
+        fila['correo'] = fila['correo'].lower()
+    fila['activo'] = True
+    return fila
+
+
+IMPORTACION_CLIENTES = TipoImportacion(
+    'clientes', Cliente, 'nif', 'NOMBRE FISCAL', _columnas_clientes, _preparar_cliente
+)
+IMPORTACION_PROVEEDORES = TipoImportacion(
+    'proveedores', Proveedor, 'cif', 'NOMBRE', _columnas_proveedores, _preparar_proveedor
+)
+
+
+# ========== VALORES ==========
+
+def _normalizar_valor(campo, valor):
+    """Texto de una celda: números sin decimales, mayúsculas (salvo emails) y CP a 5 cifras"""
+    if valor is None or str(valor).strip() == '':
+        return None
+    if isinstance(valor, (int, float)):
+        valor = str(int(valor))
+    else:
+        valor = str(valor).strip()
+
+    if campo not in CAMPOS_EMAIL:
+        valor = valor.upper()
+
+    if campo == 'codigo_postal':
+        digitos = ''.join(filter(str.isdigit, valor))
+        if len(digitos) == 4:
+            valor = '0' + digitos
+    return valor or None
+
+
+def valores_fila(columnas, fila):
+    """Valores normalizados de una fila del Excel según el mapeo de columnas"""
+    return {
+        campo: _normalizar_valor(campo, fila[indice] if indice < len(fila) else None)
+        for campo, indice in columnas.items()
+    }
+
+
+def _fila_vacia(fila):
+    return all(valor is None or str(valor).strip() == '' for valor in fila)
+
+
+def cargar_claves_existentes(tipo):
+    """Índice de duplicados con los NIF/CIF y nombres ya registrados (una sola consulta)"""
+    columna_fiscal = getattr(tipo.modelo, tipo.campo_fiscal)
+    registros = db.session.execute(
+        select(tipo.modelo.id, columna_fiscal, tipo.modelo.nombre).order_by(tipo.modelo.id)
+    ).all()
+    indice = IndiceDuplicados(frecuencias=frecuencias_ngramas(nombre for _, _, nombre in registros))
+    for id_registro, fiscal, nombre in registros:
+        indice.agregar(id_registro, nombre, fiscal)
+    return indice
+
+
+# ========== IMPORTACIÓN ==========
+
+# Contador del resultado de cada tipo de incidencia
+CONTADORES_INCIDENCIA = {'duplicado': 'duplicados', 'similar': 'similares', 'error': 'errores'}
+
+
+def nuevo_resultado():
+    return {'importados': 0, 'duplicados': 0, 'similares': 0, 'errores': 0, 'incidencias': []}
+
+
+def anotar_incidencia(resultado, numero_fila, tipo_incidencia, nombre, motivo):
+    """Contar un duplicado, posible duplicado o error y guardarlo en el informe (hasta MAX_INCIDENCIAS)"""
+    resultado[CONTADORES_INCIDENCIA[tipo_incidencia]] += 1
+    if len(resultado['incidencias']) < MAX_INCIDENCIAS:
+        resultado['incidencias'].append({
+            'fila': numero_fila, 'tipo': tipo_incidencia, 'nombre': nombre, 'motivo': motivo
+        })
+
+
+def _anotar_insercion(tipo):
+    # bulk_insert_mappings no pasa por los eventos de la sesión que invalidan el informe de duplicados
+    if tipo.modelo is Cliente:
+        incrementar_version(VERSION_CLIENTES)
+
+
+def confirmar_lote(tipo, lote, resultado, ultima_fila, al_confirmar=None):
+    """
+    Insertar y confirmar un lote de (número de fila, valores) que acaba en ultima_fila
+
+    al_confirmar(ultima_fila) se ejecuta en la misma transacción que las inserciones.
+    Si el lote falla se reintenta fila a fila para informar solo de las que fallan;
+    en ese caso el progreso se confirma al final, con las filas ya insertadas (una
+    reanudación las vería como duplicados, nunca las insertaría dos veces).
+    """
+    importados = resultado['importados']
+    try:
+        if lote:
+            db.session.bulk_insert_mappings(tipo.modelo, [valores for _, valores in lote])
+            _anotar_insercion(tipo)
+        resultado['importados'] += len(lote)
+        if al_confirmar:
+            al_confirmar(ultima_fila)
+        db.session.commit()
+        return
+    except Exception:
+        db.session.rollback()
+        resultado['importados'] = importados
+
+    for numero_fila, valores in lote:
+        try:
+            db.session.bulk_insert_mappings(tipo.modelo, [valores])
+            _anotar_insercion(tipo)
+            db.session.commit()
+            resultado['importados'] += 1
+        except Exception as e:
+            db.session.rollback()
+            anotar_incidencia(resultado, numero_fila, 'error', valores.get('nombre'), str(e.__cause__ or e))
+    if al_confirmar:
+        al_confirmar(ultima_fila)
+    db.session.commit()
+
+
+def clasificar_fila(tipo, columnas, fila, claves):
+    """
+    Decidir qué hacer con una fila: devuelve (acción, valores, motivo)
+
+    acción es 'vacia', 'error', 'duplicado' o 'nueva'. Una fila nueva con motivo se
+    parece a un registro existente (posible duplicado). Las filas nuevas se añaden al
+    índice claves para detectar duplicados posteriores del mismo archivo.
+    """
+    if _fila_vacia(fila):
+        return 'vacia', None, None
+    try:
+        valores = valores_fila(columnas, fila)
+    except (TypeError, ValueError, OverflowError) as e:
+        return 'error', None, f'Valor no válido: {e}'
+
+    nombre = valores.get('nombre')
+    if not nombre:
+        return 'error', valores, 'Falta el nombre'
+
+    fiscal = valores.get(tipo.campo_fiscal)
+    coincidencia = claves.buscar(nombre, fiscal)
+    motivo = None
+    if coincidencia:
+        existente = coincidencia.registro.nombre
+        if coincidencia.tipo == 'nif':
+            return 'duplicado', valores, f'{tipo.campo_fiscal.upper()} {fiscal} ya registrado'
+        if coincidencia.tipo == 'nombre':
+            if existente == nombre:
+                return 'duplicado', valores, 'Nombre ya registrado'
+            return 'duplicado', valores, f'Nombre equivalente a "{existente}"'
+        motivo = f'Posible duplicado de "{existente}" ({coincidencia.similitud:.0%})'
+        if coincidencia.registro.nif:
+            motivo += f', con {tipo.campo_fiscal.upper()} {coincidencia.registro.nif}'
+
+    claves.agregar(None, nombre, fiscal)
+    return 'nueva', valores, motivo
+
+
+def leer_cabecera(hoja):
+    """Títulos de las columnas (primera fila del Excel)"""
+    filas = hoja.iter_rows(max_row=1, values_only=True)
+    return [str(valor) if valor else '' for valor in next(filas, ())]
+
+
+def abrir_excel(tipo, ruta):
+    """
+    Abrir el libro (read_only) y mapear sus columnas: devuelve (libro, hoja, columnas)
+
+    Lanza ValueError si el archivo no tiene la columna del nombre. Quien llama debe
+    cerrar el libro.
+    """
+    libro = load_workbook(ruta, read_only=True, data_only=True)
+    hoja = libro.active
+    columnas = tipo.mapear_columnas(leer_cabecera(hoja))
+    if 'nombre' not in columnas:
+        libro.close()
+        raise ValueError(f'No se encontró la columna "{tipo.columna_obligatoria}" en el archivo')
+    return libro, hoja, columnas
+
+
+def procesar_excel(tipo, ruta, resultado, desde_fila=1, al_confirmar=None):
+    """
+    Importar las filas del Excel posteriores a desde_fila (1 = solo la cabecera)
+
+    Acumula en resultado los importados, duplicados, posibles duplicados, errores e
+    incidencias por fila. Cada TAMANO_LOTE_IMPORTACION filas se confirma un lote (ver confirmar_lote).
+    Lanza ValueError si el archivo no tiene la columna del nombre.
+    """
+    libro, hoja, columnas = abrir_excel(tipo, ruta)
+    try:
+        claves = cargar_claves_existentes(tipo)
+        lote = []
+        ultima_fila = desde_fila
+        for numero_fila, fila in enumerate(hoja.iter_rows(min_row=desde_fila + 1, values_only=True),
+                                           start=desde_fila + 1):
+            accion, valores, motivo = clasificar_fila(tipo, columnas, fila, claves)
+            if accion == 'nueva':
+                lote.append((numero_fila, tipo.preparar(valores)))
+                if motivo:
+                    anotar_incidencia(resultado, numero_fila, 'similar', valores['nombre'], motivo)
+            elif accion in ('error', 'duplicado'):
+                anotar_incidencia(resultado, numero_fila, accion, (valores or {}).get('nombre'), motivo)
+            ultima_fila = numero_fila
+            if numero_fila - desde_fila >= TAMANO_LOTE_IMPORTACION:
+                confirmar_lote(tipo, lote, resultado, ultima_fila, al_confirmar)
+                lote = []
+                desde_fila = ultima_fila
+        confirmar_lote(tipo, lote, resultado, ultima_fila, al_confirmar)
+    finally:
+        libro.close()
+    return resultado
@@ -0,0 +1,289 @@
+"""Instrumentación de consultas SQL por petición y registro de consultas lentas
+
+Los eventos before/after_cursor_execute de SQLAlchemy miden cada sentencia. Por
+petición se acumulan el número de consultas y el tiempo total en BD, que se
+devuelven en las cabeceras X-DB-Queries y X-DB-Time (milisegundos).
+
+Las sentencias que superan el umbral SLOW_QUERY_MS se escriben en el log con sus
+parámetros y el endpoint, y se agregan en memoria por SQL normalizado (literales
+y listas IN sustituidos por ?) para la página de consultas lentas.
+
+Como las métricas de /metrics, cada worker vuelca sus consultas lentas a un archivo
+JSON propio en el directorio compartido (METRICS_DIR) y la página suma los de todos
+los procesos, también los de workers ya terminados. Reiniciar las estadísticas
+escribe una marca de reinicio en ese directorio: cada worker vacía las suyas al
+verla y los archivos anteriores a la marca dejan de sumarse.
+"""
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.metricas import directorio_metricas
+
+UMBRAL_LENTO_MS_DEFECTO = 200
+
+# Número máximo de sentencias distintas que se guardan (se descartan las de menor tiempo total)
+MAX_SENTENCIAS = 200
+
+PREFIJO_ARCHIVO = 'lentas_'
+ARCHIVO_REINICIO = 'lentas_reinicio.txt'
+
+_umbral_lento_ms = UMBRAL_LENTO_MS_DEFECTO
+_lentas = {}
+_lock = threading.Lock()
+_reinicio = 0.0          # marca del último reinicio aplicado en este proceso
+_pendiente = False       # hay consultas lentas sin volcar
+_inicio_proceso = int(time.time())
+
+_RE_CADENA = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMERO = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_LISTA_IN = re.compile(r'\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)', re.IGNORECASE)
+_RE_ESPACIOS = re.compile(r'\s+')
+
+
+def normalizar_sql(sql):
+    """Quitar literales y espacios de una sentencia para agrupar las equivalentes"""
+    sql = _RE_CADENA.sub('?', sql)
+    sql = _RE_NUMERO.sub('?', sql)
+    sql = _RE_ESPACIOS.sub(' ', sql).strip()
+    return _RE_LISTA_IN.sub('IN (?)', sql)
+
+
+def _endpoint_actual():
+    if has_request_context():
+        return request.endpoint or request.path
+    return None
+
+
+def _resumir_parametros(parametros, max_longitud=500):
+    texto = repr(parametros)
+    if len(texto) > max_longitud:
+        texto = texto[:max_longitud] + '...'
+    return texto
+
+
+def _antes_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_consultas', []).append(time.perf_counter())
+
+
+def _despues_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get('inicio_consultas')
+    if not inicios:
+        return
+    duracion_ms = (time.perf_counter() - inicios.pop()) * 1000
+
+    if has_request_context():
+        g.sql_consultas = g.get('sql_consultas', 0) + 1
+        g.sql_tiempo_ms = g.get('sql_tiempo_ms', 0.0) + duracion_ms
+
+    if duracion_ms >= _umbral_lento_ms:
+        _registrar_lenta(statement, parameters, duracion_ms)
+
+
+def _error_al_ejecutar(contexto):
+    # Si la sentencia falla no se llama a after_cursor_execute: descartar su inicio
+    conn = contexto.connection
+    if conn is not None and conn.info.get('inicio_consultas'):
+        conn.info['inicio_consultas'].pop()
+
+
+def _registrar_lenta(statement, parameters, duracion_ms):
+    endpoint = _endpoint_actual()
+    parametros = _resumir_parametros(parameters)
+    print(f"[SQL lenta] {duracion_ms:.1f} ms endpoint={endpoint} sql={_RE_ESPACIOS.sub(' ', statement).strip()} params={parametros}")
+
+    global _pendiente
+    clave = normalizar_sql(statement)
+    _aplicar_reinicio()
+    with _lock:
+        _pendiente = True
+        entrada = _lentas.get(clave)
+        if entrada is None:
+            if len(_lentas) >= MAX_SENTENCIAS:
+                menor = min(_lentas, key=lambda k: _lentas[k]['tiempo_total_ms'])
+                _lentas.pop(menor)
+            entrada = _lentas[clave] = {
+                'sql': clave,
+                'veces': 0,
+                'tiempo_total_ms': 0.0,
+                'tiempo_max_ms': 0.0,
+                'endpoints': set(),
+            }
+        entrada['veces'] += 1
+        entrada['tiempo_total_ms'] += duracion_ms
+        if duracion_ms >= entrada['tiempo_max_ms']:
+            entrada['tiempo_max_ms'] = duracion_ms
+            entrada['parametros_max'] = parametros
+        entrada['ultimo_endpoint'] = endpoint
+        if endpoint and len(entrada['endpoints']) < 20:
+            entrada['endpoints'].add(endpoint)
+    # En una petición se vuelca al terminarla (una vez aunque haya varias lentas)
+    if not has_request_context():
+        volcar_consultas_lentas()
+
+
+# ========== VOLCADO Y AGREGACIÓN ENTRE WORKERS ==========
+
+def _leer_reinicio():
+    """Marca (time.time()) del último reinicio de las estadísticas, 0 si no hay"""
+    try:
+        with open(os.path.join(directorio_metricas(), ARCHIVO_REINICIO)) as f:
+            return float(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _aplicar_reinicio():
+    """Vaciar las estadísticas de este proceso si otro worker las ha reiniciado; devuelve la marca"""
+    global _reinicio
+    marca = _leer_reinicio()
+    with _lock:
+        if marca > _reinicio:
+            _lentas.clear()
+            _reinicio = marca
+    return marca
+
+
+def _estado_proceso():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'reinicio': _reinicio,
+            'lentas': [dict(e, endpoints=sorted(e['endpoints'])) for e in _lentas.values()],
+        }
+
+
+def _ruta_archivo_proceso():
+    return os.path.join(directorio_metricas(), f'{PREFIJO_ARCHIVO}{os.getpid()}_{_inicio_proceso}.json')
+
+
+def volcar_consultas_lentas():
+    """Escribir las consultas lentas de este proceso en su archivo si han cambiado"""
+    global _pendiente
+    if not _pendiente:
+        return
+    _aplicar_reinicio()
+    try:
+        directorio = directorio_metricas()
+        os.makedirs(directorio, exist_ok=True)
+        ruta = _ruta_archivo_proceso()
+        # Un temporal por thread: dos peticiones del mismo worker pueden volcar a la vez
+        temporal = f'{ruta}.{threading.get_ident()}.tmp'
+        with _lock:
+            _pendiente = False
+        with open(temporal, 'w') as f:
+            json.dump(_estado_proceso(), f)
+        os.replace(temporal, ruta)
+    except OSError as e:
+        print(f"Error al volcar consultas lentas: {e}")
+
+
+def _leer_archivos(excluir=None):
+    """(ruta, estado) de los archivos de consultas lentas del directorio compartido"""
+    directorio = directorio_metricas()
+    try:
+        nombres = os.listdir(directorio)
+    except OSError:
+        return
+    for nombre in nombres:
+        if not nombre.startswith(PREFIJO_ARCHIVO) or not nombre.endswith('.json') or nombre == excluir:
+            continue
+        ruta = os.path.join(directorio, nombre)
+        try:
+            with open(ruta) as f:
+                yield ruta, json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def _leer_estados():
+    """Estados de todos los procesos posteriores al último reinicio: el propio desde memoria"""
+    marca = _aplicar_reinicio()
+    estados = [_estado_proceso()]
+    for _, estado in _leer_archivos(excluir=os.path.basename(_ruta_archivo_proceso())):
+        # Un worker que todavía no ha visto el reinicio conserva las estadísticas anteriores
+        if estado.get('reinicio', 0) >= marca:
+            estados.append(estado)
+    return estados
+
+
+def obtener_consultas_lentas(limite=50):
+    """Sentencias lentas agregadas de todos los workers, ordenadas por tiempo total"""
+    agregadas = {}
+    for estado in _leer_estados():
+        for lenta in estado.get('lentas', []):
+            entrada = agregadas.get(lenta['sql'])
+            if entrada is None:
+                entrada = agregadas[lenta['sql']] = dict(lenta, endpoints=set(lenta['endpoints']))
+                continue
+            entrada['veces'] += lenta['veces']
+            entrada['tiempo_total_ms'] += lenta['tiempo_total_ms']
+            if lenta['tiempo_max_ms'] > entrada['tiempo_max_ms']:
+                entrada['tiempo_max_ms'] = lenta['tiempo_max_ms']
+                entrada['parametros_max'] = lenta.get('parametros_max')
+            entrada['endpoints'].update(lenta['endpoints'])
+
+    entradas = list(agregadas.values())
+    for entrada in entradas:
+        entrada['endpoints'] = sorted(entrada['endpoints'])
+        entrada['tiempo_medio_ms'] = entrada['tiempo_total_ms'] / entrada['veces']
+    entradas.sort(key=lambda e: e['tiempo_total_ms'], reverse=True)
+    return entradas[:limite]
+
+
+def limpiar_consultas_lentas():
+    """Vaciar las estadísticas de consultas lentas de todos los workers"""
+    global _reinicio
+    marca = time.time()
+    directorio = directorio_metricas()
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        temporal = os.path.join(directorio, f'{ARCHIVO_REINICIO}.{os.getpid()}.tmp')
+        with open(temporal, 'w') as f:
+            f.write(repr(marca))
+        os.replace(temporal, os.path.join(directorio, ARCHIVO_REINICIO))
+        # Los archivos anteriores a la marca sobran: un worker vivo vacía sus estadísticas
+        # al ver la marca y escribe uno nuevo con su siguiente consulta lenta
+        for ruta, estado in _leer_archivos():
+            if estado.get('reinicio', 0) < marca:
+                os.remove(ruta)
+    except OSError as e:
+        print(f"Error al reiniciar las consultas lentas: {e}")
+    with _lock:
+        _lentas.clear()
+        _reinicio = marca
+
+
+def obtener_umbral_lento_ms():
+    return _umbral_lento_ms
+
+
+def init_instrumentacion_sql(app):
+    """Registrar los eventos de SQLAlchemy y las cabeceras de respuesta"""
+    global _umbral_lento_ms
+    _umbral_lento_ms = float(app.config.get('SLOW_QUERY_MS', UMBRAL_LENTO_MS_DEFECTO))
+
+    # Se escucha en la clase Engine para cubrir también los engines recreados
+    if not event.contains(Engine, 'before_cursor_execute', _antes_de_ejecutar):
+        event.listen(Engine, 'before_cursor_execute', _antes_de_ejecutar)
+        event.listen(Engine, 'after_cursor_execute', _despues_de_ejecutar)
+        event.listen(Engine, 'handle_error', _error_al_ejecutar)
+
+    @app.after_request
+    def cabeceras_consultas_sql(response):
+        response.headers['X-DB-Queries'] = str(g.get('sql_consultas', 0))
+        response.headers['X-DB-Time'] = f"{g.get('sql_tiempo_ms', 0.0):.2f}"
+        return response
+
+    @app.teardown_request
+    def volcar_lentas_pendientes(error=None):
+        volcar_consultas_lentas()
+
+    atexit.register(volcar_consultas_lentas)
+
+    print(f"[SQL] Instrumentación activa (consultas lentas >= {_umbral_lento_ms:g} ms)")
@@ -0,0 +1,312 @@
+"""Métricas de la aplicación en formato de texto de Prometheus (/metrics)
+
+Cada petición registra su latencia en un histograma y su código de estado en un
+contador, por endpoint y método; mientras se atiende cuenta como petición en
+curso. Además hay contadores de PDFs generados, transferencias SFTP y emails
+enviados, y la memoria residente (RSS) de cada proceso.
+
+Cada worker de gunicorn guarda sus métricas en memoria y las vuelca cada pocos
+segundos a un archivo JSON propio en un directorio compartido (METRICS_DIR). El
+worker que atiende /metrics suma los archivos de todos los procesos, de modo que
+el resultado no depende de qué worker responda. Los contadores de procesos ya
+terminados se conservan (no deben disminuir); sus gauges se descartan.
+
+Este módulo no importa la aplicación: gunicorn_config.py lo usa para vaciar el
+directorio al arrancar el proceso principal.
+"""
+import atexit
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import g, request, Response, abort
+from flask_login import current_user
+
+# Límites superiores (segundos) de los buckets de latencia; los PDFs con Chromium
+# pueden tardar decenas de segundos
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Cada cuánto (segundos) vuelca un worker sus métricas al directorio compartido
+INTERVALO_VOLCADO = 5
+
+PREFIJO_ARCHIVO = 'metricas_'
+
+DESCRIPCIONES = {
+    'http_request_duration_seconds': ('histogram', 'Latencia de las peticiones HTTP'),
+    'http_requests_total': ('counter', 'Peticiones HTTP atendidas por código de estado'),
+    'http_requests_in_flight': ('gauge', 'Peticiones HTTP en curso'),
+    'process_resident_memory_bytes': ('gauge', 'Memoria residente (RSS) de cada proceso'),
+    'pdfs_generados_total': ('counter', 'PDFs generados'),
+    'sftp_transferencias_total': ('counter', 'Operaciones SFTP por tipo y resultado'),
+    'emails_enviados_total': ('counter', 'Emails enviados'),
+}
+
+_lock = threading.Lock()
+_contadores = {}   # (nombre, etiquetas) -> valor
+_histogramas = {}  # (nombre, etiquetas) -> [cuentas por bucket..., +Inf, suma]
+_en_curso = {}     # etiquetas -> peticiones en curso
+_ultimo_volcado = 0.0
+_inicio_proceso = int(time.time())
+
+
+def directorio_metricas():
+    """Directorio compartido entre workers donde se vuelcan las métricas"""
+    return os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'metricas_app')
+
+
+def _etiquetas(**etiquetas):
+    return tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+
+# ========== REGISTRO ==========
+
+def incrementar_contador(nombre, valor=1, **etiquetas):
+    clave = (nombre, _etiquetas(**etiquetas))
+    with _lock:
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+
+
+def observar_latencia(segundos, **etiquetas):
+    clave = ('http_request_duration_seconds', _etiquetas(**etiquetas))
+    with _lock:
+        cuentas = _histogramas.get(clave)
+        if cuentas is None:
+            cuentas = _histogramas[clave] = [0] * (len(BUCKETS_LATENCIA) + 1) + [0.0]
+        for i, limite in enumerate(BUCKETS_LATENCIA):
+            if segundos <= limite:
+                cuentas[i] += 1
+                break
+        else:
+            cuentas[len(BUCKETS_LATENCIA)] += 1
+        cuentas[-1] += segundos
+
+
+def _endpoint_actual():
+    try:
+        return request.endpoint or 'sin_endpoint'
+    except RuntimeError:
+        return 'sin_peticion'
+
+
+def registrar_pdf_generado():
+    """Contar un PDF generado (etiquetado con el endpoint que lo genera)"""
+    incrementar_contador('pdfs_generados_total', endpoint=_endpoint_actual())
+
+
+def registrar_transferencia_sftp(operacion, correcta):
+    incrementar_contador('sftp_transferencias_total', operacion=operacion,
+                         resultado='ok' if correcta else 'error')
+
+
+def _memoria_residente():
+    """RSS del proceso en bytes (pico de RSS si no hay /proc)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except Exception:
+            return 0
+
+
+# ========== VOLCADO Y AGREGACIÓN ENTRE WORKERS ==========
+
+def _estado_proceso():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'contadores': [[n, dict(e), v] for (n, e), v in _contadores.items()],
+            'histogramas': [[n, dict(e), list(c)] for (n, e), c in _histogramas.items()],
+            'gauges': [['http_requests_in_flight', dict(e), v] for e, v in _en_curso.items()] + [
+                ['process_resident_memory_bytes', {'pid': str(os.getpid())}, _memoria_residente()]
+            ],
+        }
+
+
+def _ruta_archivo_proceso():
+    return os.path.join(directorio_metricas(), f'{PREFIJO_ARCHIVO}{os.getpid()}_{_inicio_proceso}.json')
+
+
+def volcar_metricas(forzar=False):
+    """Escribir las métricas de este proceso en su archivo (como mucho cada INTERVALO_VOLCADO)"""
+    global _ultimo_volcado
+    ahora = time.monotonic()
+    with _lock:
+        if not forzar and ahora - _ultimo_volcado < INTERVALO_VOLCADO:
+            return
+        _ultimo_volcado = ahora
+    try:
+        directorio = directorio_metricas()
+        os.makedirs(directorio, exist_ok=True)
+        ruta = _ruta_archivo_proceso()
+        # Un temporal por thread: /metrics fuerza el volcado mientras otra petición vuelca al terminar
+        temporal = f'{ruta}.{threading.get_ident()}.tmp'
+        with open(temporal, 'w') as f:
+            json.dump(_estado_proceso(), f)
+        os.replace(temporal, ruta)
+    except OSError as e:
+        print(f"Error al volcar métricas: {e}")
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _leer_estados():
+    """Estados de todos los procesos: el propio desde memoria, el resto desde disco"""
+    estados = [_estado_proceso()]
+    propio = os.path.basename(_ruta_archivo_proceso())
+    try:
+        nombres = os.listdir(directorio_metricas())
+    except OSError:
+        return estados
+    for nombre in nombres:
+        if not nombre.startswith(PREFIJO_ARCHIVO) or not nombre.endswith('.json') or nombre == propio:
+            continue
+        try:
+            with open(os.path.join(directorio_metricas(), nombre)) as f:
+                estado = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _proceso_vivo(estado.get('pid', 0)):
+            estado['gauges'] = []
+        estados.append(estado)
+    return estados
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{' + ','.join(f'{k}="{_escapar(v)}"' for k, v in sorted(etiquetas.items())) + '}'
+
+
+def _formatear_numero(valor):
+    if isinstance(valor, float) and not valor.is_integer():
+        return repr(valor)
+    return str(int(valor))
+
+
+def generar_texto_metricas():
+    """Métricas de todos los workers en formato de texto de Prometheus"""
+    series = {}       # (nombre, etiquetas) -> valor
+    histogramas = {}  # (nombre, etiquetas) -> cuentas
+    for estado in _leer_estados():
+        for nombre, etiquetas, valor in estado.get('contadores', []) + estado.get('gauges', []):
+            clave = (nombre, _etiquetas(**etiquetas))
+            series[clave] = series.get(clave, 0) + valor
+        for nombre, etiquetas, cuentas in estado.get('histogramas', []):
+            clave = (nombre, _etiquetas(**etiquetas))
+            acumuladas = histogramas.setdefault(clave, [0] * len(cuentas))
+            for i, cuenta in enumerate(cuentas):
+                acumuladas[i] += cuenta
+
+    lineas = []
+    for nombre, (tipo, descripcion) in DESCRIPCIONES.items():
+        lineas.append(f'# HELP {nombre} {descripcion}')
+        lineas.append(f'# TYPE {nombre} {tipo}')
+        if tipo == 'histogram':
+            for (n, etiquetas), cuentas in sorted(histogramas.items()):
+                if n != nombre:
+                    continue
+                etiquetas = dict(etiquetas)
+                acumulado = 0
+                for limite, cuenta in zip(list(BUCKETS_LATENCIA) + ['+Inf'], cuentas[:-1]):
+                    acumulado += cuenta
+                    lineas.append(f'{nombre}_bucket{_formatear_etiquetas(dict(etiquetas, le=limite))} {acumulado}')
+                lineas.append(f'{nombre}_sum{_formatear_etiquetas(etiquetas)} {_formatear_numero(cuentas[-1])}')
+                lineas.append(f'{nombre}_count{_formatear_etiquetas(etiquetas)} {acumulado}')
+        else:
+            for (n, etiquetas), valor in sorted(series.items()):
+                if n == nombre:
+                    lineas.append(f'{nombre}{_formatear_etiquetas(dict(etiquetas))} {_formatear_numero(valor)}')
+    return '\n'.join(lineas) + '\n'
+
+
+def limpiar_directorio(prefijo=PREFIJO_ARCHIVO):
+    """Borrar los archivos de métricas (al arrancar el proceso principal de gunicorn)"""
+    directorio = directorio_metricas()
+    try:
+        for nombre in os.listdir(directorio):
+            if nombre.startswith(prefijo):
+                os.remove(os.path.join(directorio, nombre))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error al limpiar el directorio de métricas {directorio}: {e}")
+
+
+# ========== INTEGRACIÓN CON FLASK ==========
+
+def _autorizado():
+    """Con METRICS_TOKEN se exige el token (Bearer o ?token=); sin él, un supervisor con sesión"""
+    token = os.environ.get('METRICS_TOKEN', '')
+    if token:
+        recibido = request.args.get('token', '')
+        cabecera = request.headers.get('Authorization', '')
+        if cabecera.startswith('Bearer '):
+            recibido = cabecera[len('Bearer '):]
+        return hmac.compare_digest(recibido, token)
+    return current_user.is_authenticated and getattr(current_user, 'rol', None) == 'supervisor'
+
+
+def init_metricas(app):
+    """Registrar el middleware de métricas y el endpoint /metrics"""
+
+    @app.before_request
+    def iniciar_metricas_peticion():
+        g.metricas_inicio = time.perf_counter()
+        g.metricas_etiquetas = _etiquetas(endpoint=_endpoint_actual())
+        with _lock:
+            _en_curso[g.metricas_etiquetas] = _en_curso.get(g.metricas_etiquetas, 0) + 1
+
+    @app.after_request
+    def guardar_estado_respuesta(response):
+        g.metricas_estado = response.status_code
+        return response
+
+    @app.teardown_request
+    def finalizar_metricas_peticion(error=None):
+        inicio = g.pop('metricas_inicio', None)
+        if inicio is None:
+            return
+        etiquetas = g.pop('metricas_etiquetas')
+        with _lock:
+            _en_curso[etiquetas] -= 1
+        endpoint = dict(etiquetas)['endpoint']
+        estado = 500 if error is not None else g.pop('metricas_estado', 500)
+        observar_latencia(time.perf_counter() - inicio, endpoint=endpoint, method=request.method)
+        incrementar_contador('http_requests_total', endpoint=endpoint, method=request.method, status=estado)
+        volcar_metricas()
+
+    @app.route('/metrics')
+    def metrics():
+        if not _autorizado():
+            abort(403)
+        volcar_metricas(forzar=True)
+        return Response(generar_texto_metricas(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    # Contar los emails enviados con Flask-Mail
+    try:
+        from flask_mail import email_dispatched
+
+        def contar_email(message, app):
+            incrementar_contador('emails_enviados_total')
+        email_dispatched.connect(contar_email, weak=False)
+    except ImportError:
+        pass
+
+    atexit.register(volcar_metricas, True)
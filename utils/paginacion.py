@@ -0,0 +1,223 @@
+"""Paginación por cursor (keyset) para los listados
+
+En lugar de OFFSET, cada página se pide a partir de los valores de ordenación de la
+última fila mostrada (WHERE (col1, col2, id) < (:v1, :v2, :id)). El coste de pedir
+una página no depende de lo lejos que esté del principio y las filas insertadas
+mientras se navega no desplazan el resto de páginas.
+
+El cursor viaja en la URL como JSON en base64 y se conservan el resto de parámetros
+de la petición (filtros), de modo que los enlaces siguiente/anterior mantienen los
+filtros aplicados.
+"""
+import base64
+import json
+from datetime import date, datetime
+from flask import request, url_for
+from sqlalchemy import and_, or_, func
+
+POR_PAGINA_DEFECTO = 50
+POR_PAGINA_MAXIMO = 200
+
+DIRECCION_SIGUIENTE = 'siguiente'
+DIRECCION_ANTERIOR = 'anterior'
+
+
+class Pagina:
+    """Resultado de una página: filas, cursores y total opcional"""
+
+    def __init__(self, items, por_pagina, cursor_siguiente=None, cursor_anterior=None, total=None):
+        self.items = items
+        self.por_pagina = por_pagina
+        self.cursor_siguiente = cursor_siguiente
+        self.cursor_anterior = cursor_anterior
+        self.total = total
+        self.url_siguiente = None
+        self.url_anterior = None
+        self.url_total = None
+
+    @property
+    def hay_siguiente(self):
+        return self.cursor_siguiente is not None
+
+    @property
+    def hay_anterior(self):
+        return self.cursor_anterior is not None
+
+
+def _valor_minimo(columna):
+    """Valor que sustituye a NULL al ordenar (se ordena antes que cualquier valor real)"""
+    tipo = _tipo_python(columna)
+    if tipo is datetime:
+        return datetime(1, 1, 1)
+    if tipo is date:
+        return date(1, 1, 1)
+    if tipo is int:
+        return -2 ** 62
+    return ''
+
+
+def _tipo_python(columna):
+    try:
+        return columna.type.python_type
+    except (AttributeError, NotImplementedError):
+        return str
+
+
+def _expresion(columna):
+    """Expresión de ordenación: las columnas que admiten NULL se comparan con COALESCE"""
+    columna_tabla = getattr(columna, 'expression', columna)
+    if getattr(columna_tabla, 'nullable', True) is False or getattr(columna_tabla, 'primary_key', False):
+        return columna
+    return func.coalesce(columna, _valor_minimo(columna))
+
+
+def _serializar(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return valor
+
+
+def _deserializar(valor, columna):
+    tipo = _tipo_python(columna)
+    if valor is None:
+        return None
+    if tipo is datetime:
+        return datetime.fromisoformat(valor)
+    if tipo is date:
+        return date.fromisoformat(valor)
+    if tipo is int:
+        return int(valor)
+    return str(valor)
+
+
+def codificar_cursor(valores):
+    """Codificar una lista de valores de ordenación como cursor para la URL"""
+    datos = json.dumps([_serializar(v) for v in valores], separators=(',', ':'))
+    return base64.urlsafe_b64encode(datos.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor, columnas):
+    """Decodificar un cursor; devuelve None si no es válido para estas columnas"""
+    if not cursor:
+        return None
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + relleno).decode('utf-8'))
+        if not isinstance(valores, list) or len(valores) != len(columnas):
+            return None
+        return [_deserializar(v, col) for v, (col, _) in zip(valores, columnas)]
+    except (ValueError, TypeError):
+        return None
+
+
+def _valores_fila(fila, columnas):
+    """Valores de ordenación de una fila (NULL sustituido por el mismo valor que en SQL)"""
+    valores = []
+    for columna, _ in columnas:
+        valor = getattr(fila, columna.key)
+        if valor is None and _expresion(columna) is not columna:
+            valor = _valor_minimo(columna)
+        valores.append(valor)
+    return valores
+
+
+def _predicado_posterior(columnas, valores):
+    """
+    Condición "la fila va después del cursor" para un orden con direcciones mixtas
+
+    (a, b, c) después de (x, y, z) equivale a:
+    a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+    cambiando > por < en las columnas descendentes.
+    """
+    condiciones = []
+    for i, (columna, descendente) in enumerate(columnas):
+        expr = _expresion(columna)
+        iguales = [_expresion(c) == v for (c, _), v in zip(columnas[:i], valores[:i])]
+        paso = expr < valores[i] if descendente else expr > valores[i]
+        condiciones.append(and_(*iguales, paso) if iguales else paso)
+    return or_(*condiciones)
+
+
+def paginar_keyset(query, columnas, por_pagina=POR_PAGINA_DEFECTO, cursor=None,
+                   direccion=DIRECCION_SIGUIENTE, contar=False):
+    """
+    Paginar una consulta por cursor
+
+    columnas: lista de (columna, descendente) con el orden del listado. La última
+    columna debe ser única (normalmente el id) para que el orden sea total.
+    cursor: cursor de la fila frontera (la última de la página anterior al avanzar,
+    la primera de la página actual al retroceder).
+    contar: si es True se calcula además el total de filas con una consulta COUNT
+    aparte (sin ORDER BY); solo cuando se pide, porque es la parte cara.
+    """
+    por_pagina = max(1, min(int(por_pagina or POR_PAGINA_DEFECTO), POR_PAGINA_MAXIMO))
+    valores = decodificar_cursor(cursor, columnas)
+    retroceder = direccion == DIRECCION_ANTERIOR and valores is not None
+
+    total = query.order_by(None).count() if contar else None
+
+    # Al retroceder se recorre el orden invertido y luego se da la vuelta a las filas
+    orden = [(col, desc != retroceder) for col, desc in columnas]
+    consulta = query
+    if valores is not None:
+        consulta = consulta.filter(_predicado_posterior(orden, valores))
+    consulta = consulta.order_by(*[
+        _expresion(col).desc() if desc else _expresion(col).asc() for col, desc in orden
+    ])
+    filas = consulta.limit(por_pagina + 1).all()
+
+    hay_mas = len(filas) > por_pagina
+    filas = filas[:por_pagina]
+    if retroceder:
+        filas.reverse()
+
+    cursor_siguiente = cursor_anterior = None
+    if filas:
+        primera = codificar_cursor(_valores_fila(filas[0], columnas))
+        ultima = codificar_cursor(_valores_fila(filas[-1], columnas))
+        if retroceder:
+            cursor_anterior = primera if hay_mas else None
+            cursor_siguiente = ultima
+        else:
+            cursor_siguiente = ultima if hay_mas else None
+            cursor_anterior = primera if valores is not None else None
+
+    return Pagina(filas, por_pagina, cursor_siguiente, cursor_anterior, total)
+
+
+def paginar_desde_request(query, columnas):
+    """
+    Paginar usando los parámetros de la petición actual (cursor, dir, por_pagina, total)
+    y preparar los enlaces siguiente/anterior conservando el resto de parámetros
+    """
+    try:
+        por_pagina = int(request.args.get('por_pagina', POR_PAGINA_DEFECTO))
+    except ValueError:
+        por_pagina = POR_PAGINA_DEFECTO
+    contar = request.args.get('total') == '1'
+
+    pagina = paginar_keyset(
+        query, columnas,
+        por_pagina=por_pagina,
+        cursor=request.args.get('cursor'),
+        direccion=request.args.get('dir', DIRECCION_SIGUIENTE),
+        contar=contar
+    )
+
+    parametros = dict(request.view_args or {})
+    parametros.update(request.args.to_dict())
+    parametros.pop('cursor', None)
+    parametros.pop('dir', None)
+    if pagina.hay_siguiente:
+        pagina.url_siguiente = url_for(request.endpoint, **dict(
+            parametros, cursor=pagina.cursor_siguiente, dir=DIRECCION_SIGUIENTE))
+    if pagina.hay_anterior:
+        pagina.url_anterior = url_for(request.endpoint, **dict(
+            parametros, cursor=pagina.cursor_anterior, dir=DIRECCION_ANTERIOR))
+    if not contar:
+        # Enlace para pedir el total manteniendo la página actual
+        actuales = dict(request.view_args or {})
+        actuales.update(request.args.to_dict())
+        actuales['total'] = '1'
+        pagina.url_total = url_for(request.endpoint, **actuales)
+    return pagina
@@ -0,0 +1,110 @@
+"""Perfil de conexión de SQLite: pragmas aplicados a cada conexión nueva del pool
+
+Los pragmas de SQLite (salvo journal_mode) son de cada conexión, así que se aplican
+en el evento connect del pool: todas las conexiones de todos los workers y threads
+quedan iguales, también las que se abren tras descartar el pool (sustitución de la
+BD en caliente).
+
+Perfil por defecto (PERFIL_SQLITE):
+- journal_mode=WAL: los lectores no bloquean al escritor ni el escritor a los
+  lectores. Es persistente (queda en la cabecera de la BD); la BD pasa a tener los
+  archivos -wal y -shm a su lado mientras haya conexiones abiertas.
+- synchronous=NORMAL: con WAL, un commit no espera a fsync; lo hace el checkpoint.
+  Un corte de luz puede perder las últimas transacciones, pero no corrompe la BD.
+- busy_timeout: milisegundos que una conexión espera un bloqueo antes de fallar con
+  "database is locked".
+- cache_size (negativo = KiB por conexión), mmap_size (bytes leídos por mmap) y
+  temp_store=MEMORY (tablas temporales de ORDER BY/GROUP BY en memoria).
+- foreign_keys=ON: SQLite no comprueba las claves foráneas si no se activa en
+  cada conexión.
+
+SQLITE_PRAGMAS (variable de entorno o configuración) modifica el perfil con pares
+"pragma=valor" separados por comas; un valor vacío quita el pragma del perfil. Por
+ejemplo, SQLITE_PRAGMAS="journal_mode=DELETE,synchronous=FULL,mmap_size=" vuelve al
+modo de journal clásico. medir_perfil_sqlite.py compara perfiles con carga mixta.
+"""
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Orden de aplicación: busy_timeout primero para que el cambio de journal_mode
+# espere a otras conexiones en lugar de fallar
+PERFIL_SQLITE = {
+    'busy_timeout': 5000,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -20000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+# Pragmas que devuelven el valor aplicado: se comprueba para avisar si SQLite no lo acepta
+PRAGMAS_CON_RESULTADO = ('journal_mode',)
+
+_pragmas = dict(PERFIL_SQLITE)
+_avisos = set()
+
+
+def leer_pragmas(valor):
+    """Perfil resultante de aplicar al de por defecto los cambios de SQLITE_PRAGMAS"""
+    pragmas = dict(PERFIL_SQLITE)
+    if isinstance(valor, dict):
+        cambios = valor.items()
+    else:
+        cambios = (parte.split('=', 1) for parte in (valor or '').split(',') if '=' in parte)
+    for nombre, ajuste in cambios:
+        nombre = str(nombre).strip().lower()
+        ajuste = str(ajuste).strip() if ajuste is not None else ''
+        if not nombre.isidentifier():
+            raise ValueError(f'Pragma de SQLite no válido: {nombre!r}')
+        if not ajuste:
+            pragmas.pop(nombre, None)
+        elif not ajuste.lstrip('-').isalnum():
+            raise ValueError(f'Valor no válido para el pragma {nombre}: {ajuste!r}')
+        else:
+            pragmas[nombre] = ajuste
+    return pragmas
+
+
+def _avisar(mensaje):
+    # Una vez por proceso: el evento se repite con cada conexión del pool
+    if mensaje not in _avisos:
+        _avisos.add(mensaje)
+        print(f"[SQLite] {mensaje}")
+
+
+def aplicar_pragmas(dbapi_connection, pragmas):
+    """Aplicar los pragmas a una conexión sqlite3 recién abierta"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for nombre, valor in pragmas.items():
+            try:
+                cursor.execute(f'PRAGMA {nombre} = {valor}')
+                if nombre in PRAGMAS_CON_RESULTADO:
+                    fila = cursor.fetchone()
+                    if fila and str(fila[0]).lower() != str(valor).lower():
+                        _avisar(f"PRAGMA {nombre} = {valor} no aplicado (SQLite mantiene '{fila[0]}')")
+            except sqlite3.OperationalError as e:
+                # Por ejemplo, otro proceso con la BD bloqueada al cambiar journal_mode:
+                # la conexión sigue siendo válida con el valor anterior
+                _avisar(f"PRAGMA {nombre} = {valor} no aplicado: {e}")
+    finally:
+        cursor.close()
+
+
+def _al_conectar(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        aplicar_pragmas(dbapi_connection, _pragmas)
+
+
+def init_perfil_sqlite(app):
+    """Leer el perfil de la configuración y aplicarlo a las conexiones nuevas"""
+    global _pragmas
+    _pragmas = leer_pragmas(app.config.get('SQLITE_PRAGMAS'))
+
+    # Se escucha en la clase Engine (evento del pool) para cubrir también los engines recreados
+    if not event.contains(Engine, 'connect', _al_conectar):
+        event.listen(Engine, 'connect', _al_conectar)
+
+    print(f"[SQLite] Perfil de conexión: {', '.join(f'{n}={v}' for n, v in _pragmas.items())}")
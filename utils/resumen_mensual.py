@@ -0,0 +1,273 @@
+"""Resumen financiero mensual (tabla resumen_mensual) mantenido de forma incremental
+
+Los informes de IVA y de facturación emitida/soportada suman las filas de los meses
+del periodo en lugar de recorrer todas las facturas: un trimestre son 3 filas y un
+año 12.
+
+Cuando se guarda (flush) un cambio en Factura, LineaFactura, FacturaProveedor o
+Nomina que afecta a los importes o a las fechas, los meses afectados (el anterior y
+el nuevo si cambia la fecha) se recalculan a partir de sus datos con consultas
+agregadas. El recálculo se hace en la misma transacción que el cambio, así que se
+confirma o se deshace con él.
+
+Las operaciones masivas que no pasan por la sesión (query.delete(), SQL directo) no
+disparan los eventos. Si no van acompañadas de un cambio ORM del mismo mes hay que
+llamar a recalcular_mes() o reconstruir el resumen (reconstruir_resumen_mensual.py).
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import event, func, select, and_, inspect, tuple_
+from sqlalchemy.orm import Session
+from extensions import db
+from models import Factura, LineaFactura, FacturaProveedor, Nomina, ResumenMensual
+
+# IVA con el que se desglosan los importes de las líneas de factura (llevan el IVA incluido)
+TIPO_IVA = Decimal('21')
+CENTIMOS = Decimal('0.01')
+
+# Atributos que afectan al resumen: los cambios en otros atributos no recalculan nada
+ATRIBUTOS_RESUMEN = {
+    Factura: ('fecha_expedicion', 'importe_total'),
+    LineaFactura: ('factura_id', 'importe'),
+    FacturaProveedor: ('fecha_factura', 'total', 'base_imponible', 'importe_iva'),
+    Nomina: ('año', 'mes', 'total_devengado'),
+}
+
+# Atributos que deciden el mes: si están expirados (tras un commit) hay que leer el valor
+# anterior al asignarlos, o no se sabría qué mes deja de contener la fila
+ATRIBUTOS_MES = (
+    Factura.fecha_expedicion, LineaFactura.factura_id, FacturaProveedor.fecha_factura,
+    Nomina.año, Nomina.mes,
+)
+
+CLAVE_PENDIENTES = 'resumen_mensual_pendientes'
+
+
+def _centimos(columna):
+    """Importe redondeado a céntimos en SQL (SQLite guarda los Numeric como REAL)"""
+    return func.round(columna, 2)
+
+
+def _a_decimal(valor):
+    return Decimal(str(valor or 0)).quantize(CENTIMOS)
+
+
+def rango_mes(año, mes):
+    """Rango de fechas [desde, hasta) de un mes"""
+    desde = date(año, mes, 1)
+    hasta = date(año + 1, 1, 1) if mes == 12 else date(año, mes + 1, 1)
+    return desde, hasta
+
+
+def desglosar_iva_lineas(filas):
+    """
+    Base imponible e IVA de líneas con el IVA incluido, redondeando línea a línea
+
+    filas: pares (importe, número de líneas con ese importe). El redondeo de una línea
+    solo depende de su importe, así que cada importe distinto se calcula una vez.
+    """
+    divisor = Decimal('1') + TIPO_IVA / Decimal('100')
+    total_base = Decimal('0')
+    total_iva = Decimal('0')
+    for importe, num_lineas in filas:
+        base_imponible = (_a_decimal(importe) / divisor).quantize(CENTIMOS)
+        iva_linea = (base_imponible * TIPO_IVA / Decimal('100')).quantize(CENTIMOS)
+        total_base += base_imponible * num_lineas
+        total_iva += iva_linea * num_lineas
+    return total_base, total_iva
+
+
+# ========== CÁLCULO ==========
+
+def calcular_mes(conexion, año, mes):
+    """Totales de un mes calculados a partir de las facturas, facturas de proveedor y nóminas"""
+    desde, hasta = rango_mes(año, mes)
+    facturas = Factura.__table__.c
+    lineas = LineaFactura.__table__.c
+    proveedor = FacturaProveedor.__table__.c
+    nominas = Nomina.__table__.c
+
+    en_mes = and_(facturas.fecha_expedicion >= desde, facturas.fecha_expedicion < hasta)
+    num_emitidas, total_emitido = conexion.execute(
+        select(func.count(facturas.id), func.coalesce(func.sum(_centimos(facturas.importe_total)), 0))
+        .where(en_mes)
+    ).one()
+    filas_lineas = conexion.execute(
+        select(_centimos(lineas.importe), func.count(lineas.id))
+        .select_from(LineaFactura.__table__.join(Factura.__table__, lineas.factura_id == facturas.id))
+        .where(en_mes)
+        .group_by(_centimos(lineas.importe))
+    ).all()
+    base_repercutida, cuota_iva_repercutida = desglosar_iva_lineas(filas_lineas)
+    importe_lineas = sum((_a_decimal(importe) * n for importe, n in filas_lineas), Decimal('0'))
+
+    num_proveedor, total_soportado, base_soportada, cuota_soportada = conexion.execute(
+        select(
+            func.count(proveedor.id),
+            func.coalesce(func.sum(_centimos(proveedor.total)), 0),
+            func.coalesce(func.sum(_centimos(proveedor.base_imponible)), 0),
+            func.coalesce(func.sum(_centimos(proveedor.importe_iva)), 0)
+        ).where(proveedor.fecha_factura >= desde, proveedor.fecha_factura < hasta)
+    ).one()
+
+    num_nominas, total_nominas = conexion.execute(
+        select(func.count(nominas.id), func.coalesce(func.sum(_centimos(nominas.total_devengado)), 0))
+        .where(nominas['año'] == año, nominas.mes == mes)
+    ).one()
+
+    return {
+        'num_facturas_emitidas': num_emitidas,
+        'total_emitido': _a_decimal(total_emitido),
+        'importe_lineas_emitidas': importe_lineas,
+        'base_repercutida': base_repercutida,
+        'cuota_iva_repercutida': cuota_iva_repercutida,
+        'num_facturas_proveedor': num_proveedor,
+        'total_soportado': _a_decimal(total_soportado),
+        'base_soportada': _a_decimal(base_soportada),
+        'cuota_iva_soportada': _a_decimal(cuota_soportada),
+        'num_nominas': num_nominas,
+        'total_nominas': _a_decimal(total_nominas),
+    }
+
+
+def recalcular_mes(año, mes, conexion=None):
+    """Recalcular la fila de un mes dentro de la transacción actual (se borra si el mes no tiene datos)"""
+    conexion = conexion if conexion is not None else db.session.connection()
+    valores = calcular_mes(conexion, año, mes)
+    tabla = ResumenMensual.__table__
+    conexion.execute(tabla.delete().where(tabla.c['año'] == año, tabla.c.mes == mes))
+    if valores['num_facturas_emitidas'] or valores['num_facturas_proveedor'] or valores['num_nominas']:
+        conexion.execute(tabla.insert().values(
+            {'año': año, 'mes': mes, 'fecha_actualizacion': datetime.utcnow(), **valores}
+        ))
+
+
+def reconstruir_resumen():
+    """
+    Recalcular el resumen de todos los meses con datos (tras importar o restaurar una BD)
+
+    No hace commit. Devuelve el número de meses calculados.
+    """
+    conexion = db.session.connection()
+    meses = set()
+    for columna in (Factura.__table__.c.fecha_expedicion, FacturaProveedor.__table__.c.fecha_factura):
+        for (fecha,) in conexion.execute(select(columna).distinct()):
+            if fecha:
+                meses.add((fecha.year, fecha.month))
+    nominas = Nomina.__table__.c
+    meses.update(
+        (año, mes) for año, mes in conexion.execute(select(nominas['año'], nominas.mes).distinct())
+        if año and mes and 1 <= mes <= 12
+    )
+
+    conexion.execute(ResumenMensual.__table__.delete())
+    for año, mes in sorted(meses):
+        recalcular_mes(año, mes, conexion)
+    return len(meses)
+
+
+# ========== LECTURA ==========
+
+def obtener_resumen(desde, hasta):
+    """
+    Totales de los meses del rango [desde, hasta) (fechas de inicio de mes)
+
+    Devuelve un diccionario con las mismas claves que calcular_mes().
+    """
+    tabla = ResumenMensual.__table__
+    columnas = [c for c in tabla.c if c.name not in ('id', 'año', 'mes', 'fecha_actualizacion')]
+    mes = tuple_(tabla.c['año'], tabla.c.mes)
+    fila = db.session.execute(
+        select(*[func.coalesce(func.sum(c), 0) for c in columnas])
+        .where(mes >= tuple_(desde.year, desde.month), mes < tuple_(hasta.year, hasta.month))
+    ).one()
+    return {
+        c.name: int(valor) if c.name.startswith('num_') else _a_decimal(valor)
+        for c, valor in zip(columnas, fila)
+    }
+
+
+# ========== EVENTOS DE LA SESIÓN ==========
+
+def _anteriores(estado, atributo):
+    """Valores de un atributo antes de los cambios pendientes (sin cargar nada de la BD)"""
+    return [v for v in estado.attrs[atributo].history.deleted or () if v is not None]
+
+
+def _actual(estado, atributo):
+    # Los objetos borrados pueden tener atributos expirados: la fila aún existe y se cargan
+    return getattr(estado.obj(), atributo)
+
+
+def _meses_afectados(session):
+    """Meses y facturas (por id) afectados por los cambios pendientes de la sesión"""
+    meses = set()
+    ids_facturas = set()
+    cambios = [(obj, True) for obj in session.new] + [(obj, True) for obj in session.deleted]
+    cambios += [(obj, False) for obj in session.dirty]
+
+    for obj, siempre in cambios:
+        atributos = ATRIBUTOS_RESUMEN.get(type(obj))
+        if atributos is None:
+            continue
+        estado = inspect(obj)
+        if not siempre and not any(estado.attrs[a].history.has_changes() for a in atributos):
+            continue
+
+        if isinstance(obj, Factura):
+            for fecha in [_actual(estado, 'fecha_expedicion')] + _anteriores(estado, 'fecha_expedicion'):
+                if fecha:
+                    meses.add((fecha.year, fecha.month))
+        elif isinstance(obj, FacturaProveedor):
+            for fecha in [_actual(estado, 'fecha_factura')] + _anteriores(estado, 'fecha_factura'):
+                if fecha:
+                    meses.add((fecha.year, fecha.month))
+        elif isinstance(obj, LineaFactura):
+            factura = estado.dict.get('factura')
+            if factura is not None and factura.fecha_expedicion:
+                meses.add((factura.fecha_expedicion.year, factura.fecha_expedicion.month))
+            for factura_id in [_actual(estado, 'factura_id')] + _anteriores(estado, 'factura_id'):
+                if factura_id:
+                    ids_facturas.add(factura_id)
+        elif isinstance(obj, Nomina):
+            años = [_actual(estado, 'año')] + _anteriores(estado, 'año')
+            meses_nomina = [_actual(estado, 'mes')] + _anteriores(estado, 'mes')
+            meses.update((a, m) for a in años for m in meses_nomina if a and m and 1 <= m <= 12)
+    return meses, ids_facturas
+
+
+def _antes_de_flush(session, contexto, instancias):
+    # Aquí todavía se conocen los valores anteriores de los atributos modificados
+    session.info[CLAVE_PENDIENTES] = _meses_afectados(session)
+
+
+def _despues_de_flush(session, contexto):
+    meses, ids_facturas = session.info.pop(CLAVE_PENDIENTES, (set(), set()))
+    # Las líneas nuevas reciben su factura_id en el flush; se completan con el de después
+    for obj in session.new:
+        if isinstance(obj, LineaFactura) and obj.factura_id:
+            ids_facturas.add(obj.factura_id)
+    if not meses and not ids_facturas:
+        return
+
+    conexion = session.connection()
+    if ids_facturas:
+        facturas = Factura.__table__.c
+        for (fecha,) in conexion.execute(select(facturas.fecha_expedicion).where(facturas.id.in_(ids_facturas))):
+            if fecha:
+                meses.add((fecha.year, fecha.month))
+    for año, mes in sorted(meses):
+        recalcular_mes(año, mes, conexion)
+
+
+def _conservar_valor_anterior(objetivo, valor, anterior, iniciador):
+    """Sin efecto: registrarlo con active_history hace que el ORM cargue el valor anterior"""
+
+
+def init_resumen_mensual():
+    """Registrar los eventos que mantienen el resumen al guardar cambios"""
+    if not event.contains(Session, 'before_flush', _antes_de_flush):
+        for atributo in ATRIBUTOS_MES:
+            event.listen(atributo, 'set', _conservar_valor_anterior, active_history=True)
+        event.listen(Session, 'before_flush', _antes_de_flush)
+        event.listen(Session, 'after_flush', _despues_de_flush)
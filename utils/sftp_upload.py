@@ -3,6 +3,7 @@ import os
 import paramiko
 from io import BytesIO
 from flask import current_app
+from utils.metricas import registrar_transferencia_sftp
 
 
 def get_sftp_config():
@@ -72,6 +73,7 @@ def upload_file_to_sftp(file_content, remote_path):
             # Subir archivo
             file_obj = BytesIO(file_bytes)
             sftp.putfo(file_obj, remote_path)
+            registrar_transferencia_sftp('subida', True)
             
             # Retornar ruta relativa (sin el directorio base)
             return remote_path.lstrip('/')
@@ -81,6 +83,7 @@ def upload_file_to_sftp(file_content, remote_path):
             transport.close()
             
     except Exception as e:
+        registrar_transferencia_sftp('subida', False)
         print(f"Error al subir archivo a SFTP: {e}")
         import traceback
         traceback.print_exc()
@@ -114,6 +117,7 @@ def download_file_from_sftp(remote_path):
             file_obj = BytesIO()
             sftp.getfo(remote_path, file_obj)
             file_obj.seek(0)
+            registrar_transferencia_sftp('descarga', True)
             return file_obj.read()
             
         finally:
@@ -121,6 +125,7 @@ def download_file_from_sftp(remote_path):
             transport.close()
             
     except Exception as e:
+        registrar_transferencia_sftp('descarga', False)
         print(f"Error al descargar archivo desde SFTP: {e}")
         return None
 
@@ -0,0 +1,243 @@
+"""Sustitución en caliente de la base de datos SQLite (importar o restaurar una copia)
+
+La BD nueva se valida (cabecera SQLite, PRAGMA integrity_check y tablas básicas de la
+aplicación) antes de tocar nada. Después:
+
+1. Se hace una copia de la BD actual con la API de backup (pedidos_backup_<fecha>.db).
+2. Se coloca la nueva con os.replace(), que es atómico: ninguna conexión ve nunca un
+   archivo a medias ni un hueco sin BD. Por eso el archivo temporal debe estar en el
+   mismo directorio (mismo sistema de archivos) que la BD. En modo WAL (ver
+   utils.perfil_sqlite) antes se vuelca el WAL en la BD anterior y, después, se
+   retiran sus archivos -wal y -shm: SQLite los aplicaría a la BD nueva.
+3. Se incrementa el contador de generación (archivo <bd>.generacion).
+4. Se ejecutan las migraciones, se crea el índice FTS, se recalcula resumen_mensual y
+   se invalidan los datos de referencia. Si algo falla se vuelve a la copia del paso 1.
+
+Cada worker compara el contador con el suyo al empezar cada petición (leer un archivo
+de pocos bytes). Si ha cambiado, descarta su pool de conexiones, que siguen abiertas
+sobre el archivo anterior, y vacía sus cachés en memoria. Así todos los workers pasan
+a la BD nueva en su siguiente petición, sin reiniciar la aplicación.
+
+No hay número de versión del esquema: una BD de una versión anterior de la aplicación
+se actualiza con las migraciones, así que basta con exigir las tablas básicas.
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from extensions import db
+from utils.busqueda import asegurar_indice_clientes, reiniciar_estado_fts
+from utils.cache import limpiar_caches
+from utils.copias_seguridad import copiar_base_datos, ruta_base_datos
+from utils.datos_referencia import invalidar_todos
+from utils.resumen_mensual import reconstruir_resumen
+
+CABECERA_SQLITE = b'SQLite format 3\x00'
+
+# Tablas que debe tener una BD de la aplicación para poder importarla
+TABLAS_OBLIGATORIAS = ('usuarios', 'comerciales', 'clientes', 'prendas', 'presupuestos', 'facturas', 'tickets')
+
+SUFIJO_GENERACION = '.generacion'
+SUFIJO_WAL = '-wal'
+SUFIJO_SHM = '-shm'
+
+# Segundos que se espera a que terminen las escrituras en curso antes de sustituir la BD
+TIEMPO_ESPERA_BLOQUEO = 30
+
+# Generación de la BD con la que trabaja este proceso (None hasta la primera petición)
+_generacion_proceso = None
+# Función de migración de la aplicación (migrate_database de app.py)
+_migrar = None
+
+
+def ruta_temporal_importacion(ruta_bd):
+    """Archivo temporal en el directorio de la BD, para poder sustituirla con os.replace()"""
+    descriptor, ruta = tempfile.mkstemp(suffix='.db.tmp', dir=os.path.dirname(ruta_bd) or None)
+    os.close(descriptor)
+    return ruta
+
+
+def validar_bd(ruta):
+    """Mensaje de error si el archivo no es una BD válida de la aplicación, o None"""
+    with open(ruta, 'rb') as archivo:
+        if not archivo.read(16).startswith(CABECERA_SQLITE):
+            return 'El archivo no es un archivo SQLite válido'
+    conexion = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)
+    try:
+        if [fila[0] for fila in conexion.execute('PRAGMA integrity_check')] != ['ok']:
+            return 'El archivo SQLite está dañado (no supera PRAGMA integrity_check)'
+        tablas = {fila[0] for fila in conexion.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        return f'El archivo SQLite está dañado: {e}'
+    finally:
+        conexion.close()
+    faltan = [tabla for tabla in TABLAS_OBLIGATORIAS if tabla not in tablas]
+    if faltan:
+        return f"El archivo no es una base de datos de esta aplicación (faltan las tablas: {', '.join(faltan)})"
+    return None
+
+
+# ========== GENERACIÓN ==========
+
+def _ruta_generacion(ruta_bd):
+    return ruta_bd + SUFIJO_GENERACION
+
+
+def leer_generacion(ruta_bd):
+    """Generación actual de la BD (0 si nunca se ha sustituido)"""
+    try:
+        with open(_ruta_generacion(ruta_bd)) as archivo:
+            return int(archivo.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _incrementar_generacion(ruta_bd):
+    generacion = leer_generacion(ruta_bd) + 1
+    ruta = _ruta_generacion(ruta_bd)
+    with open(ruta + '.tmp', 'w') as archivo:
+        archivo.write(str(generacion))
+    os.replace(ruta + '.tmp', ruta)
+    return generacion
+
+
+def _reiniciar_conexiones():
+    """Cerrar las conexiones de este proceso y olvidar lo cacheado de la BD anterior"""
+    db.session.remove()
+    db.engine.dispose()
+    limpiar_caches()
+    reiniciar_estado_fts()
+
+
+def comprobar_generacion():
+    """Antes de cada petición: si otro proceso ha sustituido la BD, reconectar"""
+    global _generacion_proceso
+    ruta_bd = ruta_base_datos()
+    if ruta_bd is None:
+        return
+    generacion = leer_generacion(ruta_bd)
+    if _generacion_proceso is None:
+        _generacion_proceso = generacion
+    elif generacion != _generacion_proceso:
+        _reiniciar_conexiones()
+        _generacion_proceso = generacion
+        print(f"[BD] Base de datos sustituida (generación {generacion}): conexiones de este proceso renovadas")
+
+
+# ========== SUSTITUCIÓN ==========
+
+def _wal_vacio(ruta_bd):
+    ruta_wal = ruta_bd + SUFIJO_WAL
+    return not os.path.exists(ruta_wal) or os.path.getsize(ruta_wal) == 0
+
+
+def _retirar_wal(ruta_bd):
+    """Borrar los archivos -wal y -shm de la BD anterior
+
+    Las conexiones que aún siguen abiertas sobre la BD anterior (otros workers, hasta
+    su siguiente petición) conservan los suyos abiertos y no tocan los de la nueva.
+    """
+    for sufijo in (SUFIJO_WAL, SUFIJO_SHM):
+        if os.path.exists(ruta_bd + sufijo):
+            os.remove(ruta_bd + sufijo)
+
+
+def _bloquear_con_wal_vacio(conexion, ruta_bd):
+    """Tomar el bloqueo de escritura con todo el WAL ya volcado en la BD"""
+    limite = time.monotonic() + TIEMPO_ESPERA_BLOQUEO
+    while True:
+        # El checkpoint no puede hacerse con la transacción abierta: entre ambos puede
+        # colarse otra escritura, y entonces se repite
+        conexion.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conexion.execute('BEGIN IMMEDIATE')
+        if _wal_vacio(ruta_bd):
+            return
+        conexion.rollback()
+        if time.monotonic() > limite:
+            raise sqlite3.OperationalError('No se pudo volcar el WAL de la base de datos actual')
+        time.sleep(0.05)
+
+
+def _colocar(ruta_nueva, ruta_bd):
+    """Sustituir el archivo de la BD y avisar al resto de procesos"""
+    global _generacion_proceso
+    _reiniciar_conexiones()
+    if not os.path.exists(ruta_bd):
+        _retirar_wal(ruta_bd)
+        os.replace(ruta_nueva, ruta_bd)
+    else:
+        # Con el bloqueo de escritura de la BD anterior ninguna otra conexión está a mitad
+        # de una transacción: no queda un journal suyo que SQLite aplicase a la BD nueva,
+        # y en modo WAL tampoco quedan en el WAL páginas sin volcar
+        conexion = sqlite3.connect(ruta_bd, timeout=TIEMPO_ESPERA_BLOQUEO, isolation_level=None)
+        try:
+            _bloquear_con_wal_vacio(conexion, ruta_bd)
+            os.replace(ruta_nueva, ruta_bd)
+            _retirar_wal(ruta_bd)
+            conexion.execute('ROLLBACK')
+        finally:
+            conexion.close()
+    _generacion_proceso = _incrementar_generacion(ruta_bd)
+
+
+def _preparar_bd():
+    """Dejar la BD recién colocada lista para la versión actual de la aplicación"""
+    if _migrar is not None:
+        _migrar()
+    with db.engine.connect() as conn:
+        asegurar_indice_clientes(conn)
+        conn.commit()
+    reiniciar_estado_fts()
+    # Los datos de referencia cacheados corresponden a la BD anterior
+    invalidar_todos()
+    # El resumen mensual de la BD importada puede faltar o no cuadrar con sus datos
+    reconstruir_resumen()
+    db.session.commit()
+
+
+def sustituir_bd(ruta_nueva):
+    """
+    Sustituir la BD de la aplicación por el archivo ruta_nueva (que se consume)
+
+    ruta_nueva debe estar en el directorio de la BD (ruta_temporal_importacion()).
+    Devuelve la ruta de la copia de la BD anterior. Lanza ValueError si el archivo
+    no es válido; si falla la preparación de la BD nueva se restaura la anterior.
+    """
+    ruta_bd = ruta_base_datos()
+    if ruta_bd is None:
+        raise ValueError('No se pudo determinar la ruta de la base de datos')
+    try:
+        error = validar_bd(ruta_nueva)
+        if error:
+            raise ValueError(error)
+
+        ruta_backup = None
+        if os.path.exists(ruta_bd):
+            ruta_backup = ruta_bd.replace('.db', f"_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+            copiar_base_datos(ruta_bd, ruta_backup)
+        _colocar(ruta_nueva, ruta_bd)
+    finally:
+        # Con los -wal/-shm que deja validar_bd() si el archivo subido está en modo WAL
+        for ruta in (ruta_nueva, ruta_nueva + SUFIJO_WAL, ruta_nueva + SUFIJO_SHM):
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+    try:
+        _preparar_bd()
+    except Exception:
+        db.session.rollback()
+        if ruta_backup:
+            # Volver a la BD anterior (desde una copia: la del backup se conserva)
+            ruta_restauracion = ruta_temporal_importacion(ruta_bd)
+            copiar_base_datos(ruta_backup, ruta_restauracion)
+            _colocar(ruta_restauracion, ruta_bd)
+        raise
+    return ruta_backup
+
+
+def init_sustitucion_bd(app, migrar):
+    """Registrar la comprobación de generación por petición y la función de migración"""
+    global _migrar
+    _migrar = migrar
+    app.before_request(comprobar_generacion)
@@ -0,0 +1,217 @@
+"""Importaciones de clientes y proveedores en segundo plano, con progreso y reanudación
+
+Una importación grande dentro de la petición HTTP puede superar el timeout de gunicorn
+(120 s) y quedarse a medias. Al subir el Excel solo se guarda el archivo y se registra
+un trabajo (TrabajoImportacion); la importación la hace un hilo del worker y la página
+del trabajo consulta su progreso cada segundo.
+
+El trabajo avanza por lotes de utils.importacion: cada lote confirma en la misma
+transacción las filas insertadas y el progreso del trabajo (última fila del Excel,
+contadores e incidencias). Si el proceso muere a mitad, la BD queda en el último lote
+confirmado y al reanudar se sigue en la fila siguiente.
+
+Un trabajo en curso actualiza su latido con cada lote. Si no lo hace en
+SEGUNDOS_SIN_LATIDO se considera interrumpido (worker reiniciado o caído) y se puede
+reanudar. Para que dos procesos no lo ejecuten a la vez, el trabajo se reclama con un
+UPDATE condicional: solo uno lo consigue.
+
+Los archivos subidos se guardan en importaciones/ junto a la BD (en producción, el
+disco persistente) hasta que el trabajo termina bien.
+"""
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_, update
+from extensions import db
+from models import TrabajoImportacion
+from utils.copias_seguridad import ruta_base_datos
+from utils.importacion import IMPORTACION_CLIENTES, IMPORTACION_PROVEEDORES, abrir_excel, procesar_excel
+
+TIPOS_IMPORTACION = {tipo.nombre: tipo for tipo in (IMPORTACION_CLIENTES, IMPORTACION_PROVEEDORES)}
+
+# Sin latido durante este tiempo, un trabajo en curso se considera interrumpido
+SEGUNDOS_SIN_LATIDO = 120
+
+# Trabajos recientes que se listan en las páginas de importación
+TRABAJOS_RECIENTES = 10
+
+
+def directorio_importaciones():
+    """Directorio donde se guardan los Excel de los trabajos"""
+    ruta_bd = ruta_base_datos()
+    if ruta_bd is None:
+        return os.path.join(current_app.instance_path, 'importaciones')
+    return os.path.join(os.path.dirname(ruta_bd), 'importaciones')
+
+
+def trabajo_interrumpido(trabajo):
+    """True si el trabajo figura en curso pero ha dejado de dar señales"""
+    if trabajo.estado != 'en_curso':
+        return False
+    return trabajo.latido is None or trabajo.latido < datetime.utcnow() - timedelta(seconds=SEGUNDOS_SIN_LATIDO)
+
+
+def resultado_trabajo(trabajo):
+    """Progreso del trabajo con la forma del resultado de utils.importacion"""
+    return {
+        'importados': trabajo.importados,
+        'duplicados': trabajo.duplicados,
+        'similares': trabajo.similares,
+        'errores': trabajo.errores,
+        'incidencias': json.loads(trabajo.incidencias) if trabajo.incidencias else [],
+    }
+
+
+def estado_trabajo(trabajo):
+    """Datos del endpoint de progreso"""
+    filas_procesadas = trabajo.ultima_fila - 1
+    porcentaje = None
+    if trabajo.estado == 'completado':
+        porcentaje = 100
+    elif trabajo.total_filas:
+        porcentaje = min(99, filas_procesadas * 100 // trabajo.total_filas)
+    return {
+        'id': trabajo.id,
+        'tipo': trabajo.tipo,
+        'estado': 'interrumpido' if trabajo_interrumpido(trabajo) else trabajo.estado,
+        'filas_procesadas': filas_procesadas,
+        'total_filas': trabajo.total_filas,
+        'porcentaje': porcentaje,
+        'importados': trabajo.importados,
+        'duplicados': trabajo.duplicados,
+        'similares': trabajo.similares,
+        'errores': trabajo.errores,
+        'mensaje_error': trabajo.mensaje_error,
+    }
+
+
+def trabajos_recientes(tipo):
+    return (TrabajoImportacion.query
+            .filter_by(tipo=tipo.nombre)
+            .order_by(TrabajoImportacion.id.desc())
+            .limit(TRABAJOS_RECIENTES)
+            .all())
+
+
+def crear_trabajo(tipo, archivo, usuario_id=None):
+    """
+    Guardar el Excel subido y registrar su trabajo (pendiente)
+
+    Comprueba la cabecera antes de registrar nada: lanza ValueError si falta la
+    columna del nombre.
+    """
+    directorio = directorio_importaciones()
+    os.makedirs(directorio, exist_ok=True)
+    extension = os.path.splitext(archivo.filename)[1].lower()
+    ruta = os.path.join(directorio, f'{tipo.nombre}_{uuid.uuid4().hex}{extension}')
+    archivo.save(ruta)
+    try:
+        libro, hoja, _ = abrir_excel(tipo, ruta)
+        try:
+            # Dimensión declarada en la hoja: puede faltar o incluir filas vacías del final
+            total_filas = hoja.max_row - 1 if hoja.max_row else None
+        finally:
+            libro.close()
+    except Exception:
+        os.remove(ruta)
+        raise
+
+    trabajo = TrabajoImportacion(
+        tipo=tipo.nombre,
+        nombre_archivo=archivo.filename,
+        ruta_archivo=ruta,
+        estado='pendiente',
+        total_filas=total_filas,
+        usuario_id=usuario_id,
+    )
+    db.session.add(trabajo)
+    db.session.commit()
+    return trabajo
+
+
+def _reclamar(trabajo_id):
+    """Marcar el trabajo en curso si nadie lo está ejecutando. True si lo consigue este proceso"""
+    ahora = datetime.utcnow()
+    resultado = db.session.execute(
+        update(TrabajoImportacion)
+        .where(TrabajoImportacion.id == trabajo_id)
+        .where(or_(
+            TrabajoImportacion.estado.in_(('pendiente', 'error')),
+            (TrabajoImportacion.estado == 'en_curso')
+            & or_(TrabajoImportacion.latido.is_(None),
+                  TrabajoImportacion.latido < ahora - timedelta(seconds=SEGUNDOS_SIN_LATIDO)),
+        ))
+        .values(estado='en_curso', latido=ahora, mensaje_error=None)
+    )
+    db.session.commit()
+    return resultado.rowcount == 1
+
+
+def ejecutar_trabajo(trabajo_id):
+    """Importar el Excel del trabajo desde su última fila confirmada (ya reclamado)"""
+    trabajo = db.session.get(TrabajoImportacion, trabajo_id)
+    tipo = TIPOS_IMPORTACION[trabajo.tipo]
+    resultado = resultado_trabajo(trabajo)
+    desde_fila = trabajo.ultima_fila
+    ruta = trabajo.ruta_archivo
+    db.session.commit()
+
+    def guardar_progreso(ultima_fila):
+        # Dentro de la transacción del lote: se confirma con sus filas o no se confirma
+        db.session.execute(
+            update(TrabajoImportacion)
+            .where(TrabajoImportacion.id == trabajo_id)
+            .values(ultima_fila=ultima_fila,
+                    importados=resultado['importados'],
+                    duplicados=resultado['duplicados'],
+                    similares=resultado['similares'],
+                    errores=resultado['errores'],
+                    incidencias=json.dumps(resultado['incidencias'], ensure_ascii=False),
+                    latido=datetime.utcnow())
+        )
+
+    try:
+        if not os.path.exists(ruta):
+            raise ValueError('El archivo de la importación ya no existe; vuelve a subirlo')
+        procesar_excel(tipo, ruta, resultado, desde_fila=desde_fila, al_confirmar=guardar_progreso)
+    except Exception as e:
+        db.session.rollback()
+        db.session.execute(
+            update(TrabajoImportacion)
+            .where(TrabajoImportacion.id == trabajo_id)
+            .values(estado='error', mensaje_error=str(e), latido=datetime.utcnow())
+        )
+        db.session.commit()
+        print(f"[Importación] Error en el trabajo {trabajo_id}: {e}")
+        return
+
+    db.session.execute(
+        update(TrabajoImportacion)
+        .where(TrabajoImportacion.id == trabajo_id)
+        .values(estado='completado', fecha_fin=datetime.utcnow())
+    )
+    db.session.commit()
+    os.remove(ruta)
+    print(f"[Importación] Trabajo {trabajo_id} completado: {resultado['importados']} {tipo.nombre} importados, "
+          f"{resultado['duplicados']} duplicados, {resultado['similares']} posibles duplicados, {resultado['errores']} errores")
+
+
+def _hilo_trabajo(app, trabajo_id):
+    with app.app_context():
+        try:
+            ejecutar_trabajo(trabajo_id)
+        except Exception as e:
+            print(f"[Importación] Error inesperado en el trabajo {trabajo_id}: {e}")
+
+
+def lanzar_trabajo(trabajo_id):
+    """Reclamar el trabajo y ejecutarlo en un hilo. False si ya lo está ejecutando otro"""
+    if not _reclamar(trabajo_id):
+        return False
+    app = current_app._get_current_object()
+    threading.Thread(target=_hilo_trabajo, args=(app, trabajo_id),
+                     name=f'importacion-{trabajo_id}', daemon=True).start()
+    return True
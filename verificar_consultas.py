@@ -0,0 +1,339 @@
+"""Script para comprobar el número de consultas SQL de cada vista GET
+
+Crea una base de datos temporal con un conjunto de datos realista, visita todas
+las rutas GET registradas en la aplicación y cuenta las sentencias SQL que
+ejecuta cada una. El resultado se compara con el presupuesto guardado en
+presupuesto_consultas.json: si alguna vista supera su máximo, no tiene
+presupuesto o falla (error 5xx o excepción) se muestra un informe con las
+diferencias y el script termina con código 1. Las vistas que fallan no se
+guardan en el presupuesto.
+
+Las cachés de datos de referencia se vacían antes de cada petición, de modo que
+se mide el caso peor (caché fría) y el resultado no depende del orden.
+
+Uso:
+    python verificar_consultas.py              # comprobar contra el presupuesto
+    python verificar_consultas.py --actualizar # guardar los recuentos actuales como presupuesto
+    python verificar_consultas.py -v           # mostrar también las vistas sin cambios
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+ARCHIVO_PRESUPUESTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presupuesto_consultas.json')
+
+# La aplicación se importa después de apuntar DATABASE_PATH a una BD temporal
+_directorio_temporal = tempfile.mkdtemp(prefix='verificar_consultas_')
+os.environ['DATABASE_PATH'] = os.path.join(_directorio_temporal, 'pedidos.db')
+os.environ['METRICS_DIR'] = os.path.join(_directorio_temporal, 'metricas')
+os.environ.pop('METRICS_TOKEN', None)
+
+from sqlalchemy import event
+from app import app, db
+from models import (
+    Usuario, Comercial, CategoriaCliente, Cliente, DireccionEnvio, PersonaContacto, Prenda,
+    Presupuesto, LineaPresupuesto, RegistroEstadoSolicitud, Pedido, LineaPedido, Factura,
+    LineaFactura, Ticket, LineaTicket, ClienteTienda, Proveedor, FacturaProveedor, Empleado,
+    Nomina, DiaFestivo
+)
+from utils.cache import limpiar_caches
+
+# Rutas que no se pueden medir con una petición normal
+RUTAS_EXCLUIDAS = {
+    'static': 'archivos estáticos',
+    'index.stream_cambios_panel': 'stream SSE de larga duración',
+    'auth.logout': 'cierra la sesión',
+    'cliente_web.logout': 'cierra la sesión',
+}
+
+ESTADOS = ['presupuesto', 'rechazado', 'aceptado', 'mockup', 'en preparacion',
+           'revision y empaquetado', 'entregado al cliente']
+
+
+def sembrar_datos():
+    """Crear un conjunto de datos con volumen suficiente para detectar consultas N+1"""
+    azar = random.Random(0)
+    hoy = date.today()
+
+    supervisor = Usuario.query.filter_by(rol='supervisor').first()
+
+    comerciales = []
+    for i in range(5):
+        usuario = Usuario(usuario=f'comercial{i}', correo=f'comercial{i}@example.com',
+                          rol='comercial' if i < 4 else 'administracion', activo=True)
+        usuario.set_password('x')
+        db.session.add(usuario)
+        db.session.flush()
+        comercial = Comercial(usuario_id=usuario.id, _nombre=usuario.usuario)
+        db.session.add(comercial)
+        comerciales.append(comercial)
+    usuario_taller = Usuario(usuario='taller', correo='taller@example.com', rol='usuario', activo=True)
+    usuario_taller.set_password('x')
+    db.session.add(usuario_taller)
+
+    existentes = {c.nombre for c in CategoriaCliente.query.all()}
+    db.session.add_all(CategoriaCliente(nombre=n, activo=True)
+                       for n in ('Deporte', 'Hostelería', 'Colegio', 'Org. Público') if n not in existentes)
+    db.session.flush()
+    categorias = CategoriaCliente.query.order_by(CategoriaCliente.id).all()
+
+    clientes = []
+    for i in range(60):
+        cliente = Cliente(
+            nombre=f'Cliente {i} S.L.', alias=f'Alias {i}', nif=f'B{10000000 + i}',
+            direccion=f'Calle {i}', poblacion='Mérida', provincia='Badajoz', codigo_postal='06800',
+            telefono='924000000', email=f'cliente{i}@example.com',
+            categoria_id=categorias[i % len(categorias)].id,
+            comercial_id=comerciales[i % len(comerciales)].id if i % 3 else None
+        )
+        if i == 0:
+            cliente.usuario_web = 'cliente_web'
+            cliente.set_password('x')
+        db.session.add(cliente)
+        clientes.append(cliente)
+    db.session.flush()
+    for cliente in clientes[:20]:
+        db.session.add(DireccionEnvio(cliente_id=cliente.id, nombre='Almacén', direccion='Polígono 1'))
+        db.session.add(PersonaContacto(cliente_id=cliente.id, nombre='Contacto', email='contacto@example.com'))
+
+    prendas = Prenda.query.all()
+    for i in range(40):
+        prenda = Prenda(nombre=f'Prenda {i}', tipo='camiseta', precio_coste=Decimal('5.00'), precio_venta=Decimal('10.00'))
+        db.session.add(prenda)
+        prendas.append(prenda)
+    db.session.flush()
+
+    solicitudes = []
+    for i in range(80):
+        estado = ESTADOS[i % len(ESTADOS)]
+        solicitud = Presupuesto(
+            comercial_id=comerciales[i % len(comerciales)].id, cliente_id=clientes[i % len(clientes)].id,
+            tipo_pedido='confeccion', tipo_producto='', colores_principales='', colores_secundarios='',
+            ubicacion_logo='', referencias_web='', datos_adicionales='', estado=estado,
+            fecha_objetivo=hoy + timedelta(days=azar.randint(-10, 30)),
+            fecha_creacion=datetime.now() - timedelta(days=i, hours=azar.randint(0, 23))
+        )
+        if estado not in ('presupuesto', 'rechazado'):
+            # Como al aceptar el mockup: fecha de aceptación y fechas objetivo
+            solicitud.fecha_aceptado = hoy - timedelta(days=i)
+            solicitud.fecha_objetivo_25 = solicitud.fecha_aceptado + timedelta(days=35)
+            solicitud.fecha_objetivo_17 = solicitud.fecha_aceptado + timedelta(days=24)
+        db.session.add(solicitud)
+        solicitudes.append(solicitud)
+    db.session.flush()
+    for solicitud in solicitudes:
+        for j in range(azar.randint(1, 4)):
+            prenda = azar.choice(prendas)
+            db.session.add(LineaPresupuesto(presupuesto_id=solicitud.id, prenda_id=prenda.id, nombre=prenda.nombre,
+                                            cantidad=azar.randint(1, 50), precio_unitario=Decimal('10.00')))
+        for estado in ESTADOS[:ESTADOS.index(solicitud.estado) + 1]:
+            db.session.add(RegistroEstadoSolicitud(presupuesto_id=solicitud.id, estado=estado, usuario_id=supervisor.id))
+
+    pedidos = []
+    for i in range(10):
+        pedido = Pedido(comercial_id=comerciales[0].id, cliente_id=clientes[i].id, tipo_pedido='fabricacion')
+        db.session.add(pedido)
+        pedidos.append(pedido)
+    db.session.flush()
+    for pedido in pedidos:
+        db.session.add(LineaPedido(pedido_id=pedido.id, prenda_id=prendas[0].id, nombre=prendas[0].nombre, cantidad=5))
+
+    # Facturas de solicitudes aceptadas, facturas directas y albaranes
+    for i in range(30):
+        albaran = i >= 20
+        cliente = clientes[i]
+        fecha = hoy - timedelta(days=i * 5)
+        factura = Factura(
+            tipo_documento=Factura.TIPO_ALBARAN if albaran else Factura.TIPO_FACTURA,
+            presupuesto_id=solicitudes[i].id if not albaran and i % 2 else None,
+            numero=f'A{fecha:%y%m}_{i:03d}' if albaran else f'F{fecha:%y}{i + 1}',
+            fecha_expedicion=fecha, nif=cliente.nif, nombre=cliente.nombre,
+            importe_total=Decimal('121.00'), estado='pendiente' if albaran or i % 4 else 'confirmado'
+        )
+        db.session.add(factura)
+        db.session.flush()
+        for j in range(3):
+            db.session.add(LineaFactura(factura_id=factura.id, descripcion=f'Línea {j}', cantidad=1,
+                                        precio_unitario=Decimal('33.33'), importe=Decimal('33.33')))
+
+    for i in range(30):
+        ticket = Ticket(numero=f'T{i + 1}', fecha_expedicion=hoy - timedelta(days=i), nombre='Cliente tienda',
+                        importe_total=Decimal('20.00'), forma_pago='efectivo' if i % 2 else 'tarjeta')
+        db.session.add(ticket)
+        db.session.flush()
+        db.session.add(LineaTicket(ticket_id=ticket.id, descripcion='Camiseta', precio_unitario=Decimal('20.00'),
+                                   importe=Decimal('20.00')))
+    for i in range(10):
+        db.session.add(ClienteTienda(nombre=f'Cliente tienda {i}', categoria='varios'))
+
+    proveedores = [Proveedor(nombre=f'Proveedor {i}') for i in range(10)]
+    db.session.add_all(proveedores)
+    db.session.flush()
+    for i in range(30):
+        db.session.add(FacturaProveedor(
+            proveedor_id=proveedores[i % len(proveedores)].id, numero_factura=f'P-{i}',
+            fecha_factura=hoy - timedelta(days=i * 7), base_imponible=Decimal('100.00'),
+            importe_iva=Decimal('21.00'), total=Decimal('121.00')
+        ))
+
+    empleados = [Empleado(nombre=f'Empleado {i}') for i in range(5)]
+    db.session.add_all(empleados)
+    db.session.flush()
+    for empleado in empleados:
+        for mes in range(1, 7):
+            db.session.add(Nomina(empleado_id=empleado.id, mes=mes, año=hoy.year, total_devengado=Decimal('1500.00')))
+
+    for i in range(5):
+        db.session.add(DiaFestivo(fecha=hoy + timedelta(days=7 * i + 1), nombre=f'Festivo {i}', activo=True))
+
+    db.session.commit()
+    return supervisor.id, clientes[0].id
+
+
+def argumentos_ruta(regla):
+    """Valores para los parámetros de la URL: los datos sembrados tienen id 1 en todas las tablas"""
+    valores = {}
+    for nombre in regla.arguments:
+        if regla.defaults and nombre in regla.defaults:
+            continue
+        convertidor = regla._converters.get(nombre)
+        valores[nombre] = 1 if type(convertidor).__name__ == 'IntegerConverter' else 'inexistente.jpg'
+    return valores
+
+
+def medir_rutas(usuario_id, cliente_web_id):
+    """Visitar cada ruta GET y devolver {endpoint: (consultas, código de estado)}"""
+    contador = {'consultas': 0}
+
+    def contar(*args):
+        contador['consultas'] += 1
+
+    resultados = {}
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', contar)
+    try:
+        reglas = sorted(app.url_map.iter_rules(), key=lambda r: r.endpoint)
+        for regla in reglas:
+            if 'GET' not in regla.methods or regla.endpoint in RUTAS_EXCLUIDAS:
+                continue
+            with app.test_request_context():
+                from flask import url_for
+                url = url_for(regla.endpoint, **argumentos_ruta(regla))
+
+            cliente = app.test_client()
+            with cliente.session_transaction() as sesion:
+                if regla.endpoint.startswith('cliente_web.'):
+                    sesion['_user_id'] = f'cliente_{cliente_web_id}'
+                else:
+                    sesion['_user_id'] = str(usuario_id)
+                sesion['_fresh'] = True
+
+            limpiar_caches()
+            contador['consultas'] = 0
+            try:
+                respuesta = cliente.get(url)
+                estado = respuesta.status_code
+                # Leer el cuerpo: las respuestas en streaming (exportaciones) consultan al enviarse
+                respuesta.get_data()
+                respuesta.close()
+            except Exception as e:
+                estado = f'error: {e}'
+            resultados[regla.endpoint] = (contador['consultas'], estado)
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', contar)
+    return resultados
+
+
+def es_fallo(estado):
+    """True si la vista ha dado error (5xx o excepción): sus consultas no sirven de referencia"""
+    return not isinstance(estado, int) or estado >= 500
+
+
+def informe(resultados, presupuesto, detallado=False):
+    """Mostrar las diferencias con el presupuesto; devuelve True si todo está dentro"""
+    superadas, nuevas, mejoradas = [], [], []
+    for endpoint, (consultas, estado) in sorted(resultados.items()):
+        maximo = presupuesto.get(endpoint)
+        if maximo is None:
+            nuevas.append((endpoint, consultas, estado))
+        elif consultas > maximo:
+            superadas.append((endpoint, maximo, consultas, estado))
+        elif consultas < maximo:
+            mejoradas.append((endpoint, maximo, consultas, estado))
+        elif detallado:
+            print(f"  = {endpoint:<55} {consultas:>4}   ({estado})")
+    desaparecidas = sorted(set(presupuesto) - set(resultados))
+
+    if superadas:
+        print("\nVistas que SUPERAN su presupuesto de consultas:")
+        print(f"  {'endpoint':<55} {'máx.':>5} {'actual':>7} {'dif.':>5}")
+        for endpoint, maximo, consultas, estado in superadas:
+            print(f"  {endpoint:<55} {maximo:>5} {consultas:>7} {consultas - maximo:>+5}   ({estado})")
+    if nuevas:
+        print("\nVistas sin presupuesto (ejecutar con --actualizar para añadirlas):")
+        for endpoint, consultas, estado in nuevas:
+            print(f"  + {endpoint:<55} {consultas:>4}   ({estado})")
+    if mejoradas:
+        print("\nVistas por debajo de su presupuesto (se puede ajustar con --actualizar):")
+        for endpoint, maximo, consultas, estado in mejoradas:
+            print(f"  - {endpoint:<55} {maximo:>4} -> {consultas}")
+    if desaparecidas:
+        print("\nEndpoints del presupuesto que ya no existen:")
+        for endpoint in desaparecidas:
+            print(f"  ? {endpoint}")
+
+    errores = [(e, s) for e, (c, s) in resultados.items() if es_fallo(s)]
+    if errores:
+        print("\nVistas que han fallado al medir:")
+        for endpoint, estado in sorted(errores):
+            print(f"  ! {endpoint:<55} ({estado})")
+
+    correcto = not superadas and not nuevas and not errores
+    print(f"\n{len(resultados)} vistas medidas: {len(superadas)} superan el presupuesto, "
+          f"{len(nuevas)} sin presupuesto, {len(mejoradas)} mejoradas, {len(errores)} con error")
+    return correcto
+
+
+def main():
+    actualizar = '--actualizar' in sys.argv
+    detallado = '-v' in sys.argv
+
+    with app.app_context():
+        usuario_id, cliente_web_id = sembrar_datos()
+    resultados = medir_rutas(usuario_id, cliente_web_id)
+
+    if actualizar:
+        # Las vistas con error no entran: sus consultas son las del camino del fallo
+        presupuesto = {e: c for e, (c, s) in sorted(resultados.items()) if not es_fallo(s)}
+        with open(ARCHIVO_PRESUPUESTO, 'w', encoding='utf-8') as f:
+            json.dump(presupuesto, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"Presupuesto actualizado en {ARCHIVO_PRESUPUESTO} ({len(presupuesto)} vistas)")
+        fallidas = sorted(e for e, (c, s) in resultados.items() if es_fallo(s))
+        if fallidas:
+            print(f"Vistas con error, sin presupuesto: {', '.join(fallidas)}")
+            return 1
+        return 0
+
+    try:
+        with open(ARCHIVO_PRESUPUESTO, encoding='utf-8') as f:
+            presupuesto = json.load(f)
+    except FileNotFoundError:
+        print(f"No existe {ARCHIVO_PRESUPUESTO}: ejecutar primero con --actualizar")
+        return 1
+
+    return 0 if informe(resultados, presupuesto, detallado) else 1
+
+
+if __name__ == '__main__':
+    try:
+        codigo = main()
+    finally:
+        shutil.rmtree(_directorio_temporal, ignore_errors=True)
+    sys.exit(codigo)